@@ -0,0 +1,118 @@
+import copy
+import hashlib
+
+import numpy as np
+
+
+class ClusterIndex():
+
+    """
+    Groups spike indices by cluster ID using a single stable argsort (CSR layout)
+
+    The spikes belonging to cluster i are spike_order[offsets[i]:offsets[i+1]],
+    in the same order as they appear in the original spike_clusters array
+
+    """
+
+    def __init__(self, spike_clusters, total_units = 0):
+
+        """
+        spike_clusters : numpy.ndarray (num_spikes x 0)
+            Cluster IDs for each spike
+        total_units : Int (optional)
+            Minimum number of clusters to index (IDs without spikes are empty)
+        """
+
+        spike_clusters = np.squeeze(spike_clusters).astype('int64')
+
+        self.spike_order = np.argsort(spike_clusters, kind='stable')
+        self.counts = np.bincount(spike_clusters, minlength = total_units)
+        self.offsets = np.concatenate(([0], np.cumsum(self.counts)))
+
+    @property
+    def cluster_ids(self):
+
+        """ IDs of all clusters with at least one spike (same as np.unique(spike_clusters)) """
+
+        return np.flatnonzero(self.counts)
+
+    def select(self, cluster_ids = None):
+
+        """ IDs from cluster_ids that have at least one spike (all clusters with spikes if None) """
+
+        if cluster_ids is None:
+            return self.cluster_ids
+
+        cluster_ids = np.unique(np.asarray(cluster_ids, dtype='int64'))
+        cluster_ids = cluster_ids[(cluster_ids >= 0) & (cluster_ids < self.counts.size)]
+
+        return cluster_ids[self.counts[cluster_ids] > 0]
+
+    def count(self, cluster_id):
+
+        """ Number of spikes for one cluster """
+
+        if cluster_id >= self.counts.size:
+            return 0
+
+        return self.counts[cluster_id]
+
+    def spikes_for(self, cluster_id):
+
+        """ Indices of all spikes for one cluster, in ascending order """
+
+        if cluster_id >= self.counts.size:
+            return self.spike_order[:0]
+
+        return self.spike_order[self.offsets[cluster_id]:self.offsets[cluster_id + 1]]
+
+    def grouped(self, cluster_ids):
+
+        """ Spike indices of several clusters, concatenated in the order of cluster_ids
+
+        Returns (spike_indices, groups), where groups gives the position in cluster_ids
+        of the cluster each spike belongs to
+
+        """
+
+        cluster_ids = np.asarray(cluster_ids, dtype='int64')
+
+        indexed = (cluster_ids >= 0) & (cluster_ids < self.counts.size)
+
+        counts = np.zeros(cluster_ids.shape, dtype='int64')
+        counts[indexed] = self.counts[cluster_ids[indexed]]
+
+        starts = np.zeros(cluster_ids.shape, dtype='int64')
+        starts[indexed] = self.offsets[cluster_ids[indexed]]
+
+        groups = np.repeat(np.arange(cluster_ids.size), counts)
+
+        # position in spike_order of each spike: start of its cluster plus its rank within the cluster
+        positions = np.arange(groups.size) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(starts, counts)
+
+        return self.spike_order[positions], groups
+
+    def remapped(self, spike_indices):
+
+        """ Copy of this index that returns spike_indices[i] in place of spike i
+
+        Used to index rows of a larger array (e.g. pc_features in file order) without
+        reordering it; spikes_for then returns the mapped indices, which need not be ascending
+
+        """
+
+        index = copy.copy(self)
+        index.spike_order = np.asarray(spike_indices)[self.spike_order]
+
+        return index
+
+    def fingerprints(self):
+
+        """ SHA-1 hash of the spike indices of each cluster ('' for clusters without spikes)
+
+        Clusters whose fingerprint is unchanged between two sortings contain exactly the same spikes
+
+        """
+
+        return [hashlib.sha1(self.spikes_for(cluster_id).astype('int64').tobytes()).hexdigest()
+                if self.counts[cluster_id] > 0 else '' for cluster_id in range(self.counts.size)]
@@ -0,0 +1,45 @@
+from collections import OrderedDict
+
+
+class LRUCache():
+
+    """
+    Keeps the results of expensive computations, discarding the least recently used
+    entry once more than max_entries are stored
+
+    """
+
+    def __init__(self, max_entries):
+
+        """
+        max_entries : Int
+            Maximum number of results to keep in memory (at least 1)
+        """
+
+        self.max_entries = max(int(max_entries), 1)
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, build):
+
+        """ Returns the value for key, calling build() to create it if it is not stored """
+
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+        self.misses += 1
+        value = build()
+
+        self.entries[key] = value
+
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+        return value
+
+    def __len__(self):
+
+        return len(self.entries)
@@ -0,0 +1,194 @@
+import os
+import sys
+import time
+import threading
+import functools
+import contextlib
+
+try:
+    import resource
+except ImportError: # not available on Windows
+    resource = None
+
+
+_active = threading.local()
+
+
+class Profiler():
+
+    """
+    Records wall time, CPU time, peak memory and disk I/O for named stages of a module
+
+    CPU time, peak memory and I/O are counters for the whole process (including
+    finished child processes), so stages running concurrently in other threads are
+    included in each other's numbers
+
+    """
+
+    def __init__(self):
+
+        self.stages = []
+        self.stack = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+
+        """ Measures the code inside the with block; nested stages are named 'outer/inner' """
+
+        self.stack.append(name)
+        full_name = '/'.join(self.stack)
+
+        start = resource_usage()
+
+        try:
+            yield
+        finally:
+            self.stack.pop()
+            self.stages.append(dict(stage=full_name, **usage_difference(start, resource_usage())))
+
+    def summary(self, total):
+
+        """
+        Profile block for the output manifest
+
+        Inputs:
+        -------
+        total : dict
+            Usage for the whole run (from usage_difference)
+
+        Outputs:
+        --------
+        profile : dict
+            'total' and 'stages' (list of dicts, in the order the stages finished)
+
+        """
+
+        return {'total' : total,
+                'stages' : self.stages}
+
+
+def active_profiler():
+
+    """ Profiler of the module running in this thread (None if profiling is off) """
+
+    return getattr(_active, 'profiler', None)
+
+
+@contextlib.contextmanager
+def profile_stage(name):
+
+    """
+    Records a stage of the module running in this thread; does nothing if profiling is off
+
+    Example:
+    --------
+    with profile_stage('loading'):
+        data = load_kilosort_data(...)
+
+    """
+
+    profiler = active_profiler()
+
+    if profiler is None:
+        yield
+    else:
+        with profiler.stage(name):
+            yield
+
+
+def profiled(run):
+
+    """
+    Decorator for module entry points: if args['profile'] is True, the stages of the
+    run are recorded and a 'profile' block is added to the output manifest
+
+    """
+
+    @functools.wraps(run)
+    def wrapper(args, *run_args, **run_kwargs):
+
+        if not args.get('profile', False) or active_profiler() is not None:
+            return run(args, *run_args, **run_kwargs)
+
+        profiler = Profiler()
+        _active.profiler = profiler
+
+        start = resource_usage()
+
+        try:
+            output = run(args, *run_args, **run_kwargs)
+        finally:
+            _active.profiler = None
+
+        output['profile'] = profiler.summary(usage_difference(start, resource_usage()))
+
+        return output
+
+    return wrapper
+
+
+def resource_usage():
+
+    """ Current wall clock, CPU time, peak memory and I/O counters of this process """
+
+    times = os.times()
+    read_bytes, write_bytes = io_counters()
+
+    return {'wall_time' : time.perf_counter(),
+            'cpu_time' : times.user + times.system + times.children_user + times.children_system,
+            'peak_rss' : peak_rss(),
+            'read_bytes' : read_bytes,
+            'write_bytes' : write_bytes}
+
+
+def usage_difference(start, end):
+
+    """ Usage between two calls to resource_usage; counters that are not available are None """
+
+    def difference(key):
+        if start[key] is None or end[key] is None:
+            return None
+        return end[key] - start[key]
+
+    return {'wall_time_s' : difference('wall_time'),
+            'cpu_time_s' : difference('cpu_time'),
+            'peak_rss_mb' : None if end['peak_rss'] is None else end['peak_rss'] / 1e6,
+            'read_bytes' : difference('read_bytes'),
+            'write_bytes' : difference('write_bytes')}
+
+
+def peak_rss():
+
+    """ Largest resident set size (in bytes) of this process or any finished child process so far """
+
+    if resource is None:
+        try:
+            import psutil
+            return psutil.Process().memory_info().peak_wset
+        except (ImportError, AttributeError):
+            return None
+
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def io_counters():
+
+    """ Bytes read from and written to storage by this process so far (None if not available) """
+
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+        return int(counters['read_bytes']), int(counters['write_bytes'])
+    except (OSError, KeyError, ValueError):
+        pass
+
+    try:
+        import psutil
+        counters = psutil.Process().io_counters()
+        return counters.read_bytes, counters.write_bytes
+    except (ImportError, AttributeError):
+        return None, None
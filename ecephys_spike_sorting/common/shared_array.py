@@ -0,0 +1,165 @@
+import os
+import mmap
+import uuid
+import tempfile
+
+import numpy as np
+
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError: # Python < 3.8
+    shared_memory = None
+
+
+class SharedArray():
+
+    """
+    Makes a numpy array available to worker processes without pickling its contents
+
+    Arrays backed by a file (np.memmap) are re-opened read-only in each worker;
+    in-memory arrays are copied once into a named shared memory block (or, before
+    Python 3.8, into a temporary file that the workers memory-map)
+
+    Each instance has a unique key, so workers can keep several shared arrays attached
+
+    """
+
+    def __init__(self, array):
+
+        """
+        array : numpy.ndarray or numpy.memmap
+            Data to share with worker processes
+        """
+
+        self.shape = array.shape
+        self.dtype = array.dtype
+        self.key = uuid.uuid4().hex
+        self.filename = None
+        self.offset = 0
+        self.shm_name = None
+        self._shm = None
+        self._owner = False
+        self._temp_file = None
+
+        location = get_memmap_location(array)
+
+        if location is None and shared_memory is None:
+            handle, self._temp_file = tempfile.mkstemp(suffix='.npy')
+            os.close(handle)
+            copy = np.lib.format.open_memmap(self._temp_file, mode='w+', dtype=self.dtype, shape=self.shape)
+            copy[...] = array
+            copy.flush()
+            location = get_memmap_location(copy)
+            del copy
+
+        if location is not None:
+            self.filename, self.offset = location
+        else:
+            self._shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            self._owner = True
+            self.shm_name = self._shm.name
+            np.ndarray(self.shape, dtype=self.dtype, buffer=self._shm.buf)[...] = array
+
+    def __getstate__(self):
+
+        state = self.__dict__.copy()
+        state['_shm'] = None
+        state['_owner'] = False
+        state['_temp_file'] = None
+
+        return state
+
+    def attach(self):
+
+        """ Returns a read-only view of the shared data (call from the worker process) """
+
+        if self.filename is not None:
+            return np.memmap(self.filename, dtype=self.dtype, mode='r', offset=self.offset, shape=self.shape)
+
+        if self._shm is None:
+            self._shm = attach_shared_memory(self.shm_name)
+
+        data = np.ndarray(self.shape, dtype=self.dtype, buffer=self._shm.buf)
+        data.flags.writeable = False
+
+        return data
+
+    def release(self):
+
+        """ Closes the shared memory block, and frees it if this process created it """
+
+        if self._shm is not None:
+            self._shm.close()
+            if self._owner:
+                self._shm.unlink()
+            self._shm = None
+
+        if self._temp_file is not None:
+            try:
+                os.remove(self._temp_file)
+            except OSError:
+                pass
+            self._temp_file = None
+
+
+def attach_shared_memory(name):
+
+    """
+    Opens an existing shared memory block without registering it with this process's
+    resource tracker
+
+    Before Python 3.13, every process that opens a block registers it, and the tracker
+    unlinks it (with a "leaked shared_memory" warning) when that process exits, even
+    though the process that created it is still using it
+
+    """
+
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError: # Python < 3.13
+        pass
+
+    register = resource_tracker.register
+
+    def register_except_shared_memory(name, rtype):
+        if rtype != 'shared_memory':
+            register(name, rtype)
+
+    resource_tracker.register = register_except_shared_memory
+
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+
+def get_memmap_location(array):
+
+    """
+    Finds the file and byte offset holding the data of a memory-mapped array
+
+    Inputs:
+    -------
+    array : numpy.ndarray
+        Array to check (may be a contiguous slice of a np.memmap)
+
+    Outputs:
+    --------
+    location : tuple (String, Int) or None
+        File name and byte offset of the first element, or None if the
+        array is not a contiguous view onto a file
+
+    """
+
+    if not isinstance(array, np.memmap) or array.filename is None:
+        return None
+
+    buffer = getattr(array, '_mmap', None)
+
+    if buffer is None or not array.flags.c_contiguous:
+        return None
+
+    map_start = array.offset - array.offset % mmap.ALLOCATIONGRANULARITY
+    map_address = np.frombuffer(buffer, dtype='uint8').ctypes.data
+
+    return array.filename, map_start + array.ctypes.data - map_address
@@ -0,0 +1,82 @@
+import os
+import json
+
+import numpy as np
+
+
+STORE_VERSION = 1
+
+
+class SnippetStore():
+
+    """
+    Read access to the spike snippets saved by the mean_waveforms module (write_snippet_store : True)
+
+    The store holds int16 snippets of a random sample of spikes from each unit, on the
+    channels around its peak channel. The snippets are memory-mapped, so only the units
+    that are accessed are read from disk
+
+    Example:
+    --------
+    store = SnippetStore(os.path.join(kilosort_output_directory, 'snippet_store'))
+    snippets = store.snippets(cluster_id) # int16, (num_spikes x num_channels x num_samples)
+    channels = store.channels(cluster_id)
+
+    """
+
+    def __init__(self, store_dir):
+
+        store_info_file = os.path.join(store_dir, 'store.json')
+
+        if not os.path.exists(store_info_file):
+            raise IOError('No complete snippet store in ' + store_dir)
+
+        with open(store_info_file) as f:
+            info = json.load(f)
+
+        if info['version'] != STORE_VERSION:
+            raise IOError('Unsupported snippet store version: ' + str(info['version']))
+
+        self.samples_per_spike = info['samples_per_spike']
+        self.pre_samples = info['pre_samples']
+        self.sample_rate = info['sample_rate']
+        self.bit_volts = info['bit_volts']
+
+        self.all_snippets = np.load(os.path.join(store_dir, 'snippets.npy'), mmap_mode='r')
+        self.all_spike_times = np.load(os.path.join(store_dir, 'spike_times.npy'))
+        self.unit_offsets = np.load(os.path.join(store_dir, 'unit_offsets.npy'))
+        self.local_channels = np.load(os.path.join(store_dir, 'local_channels.npy'))
+
+    @property
+    def num_units(self):
+
+        return self.unit_offsets.size - 1
+
+    def snippets(self, cluster_id):
+
+        """ Raw int16 snippets of one cluster (num_spikes x num_channels x num_samples) """
+
+        return self.all_snippets[self.unit_offsets[cluster_id]:self.unit_offsets[cluster_id + 1]]
+
+    def spike_times(self, cluster_id):
+
+        """ Spike times (in samples) of the snippets of one cluster """
+
+        return self.all_spike_times[self.unit_offsets[cluster_id]:self.unit_offsets[cluster_id + 1]]
+
+    def channels(self, cluster_id):
+
+        """ Channels (rows of the raw data) included in the snippets of one cluster """
+
+        return self.local_channels[cluster_id]
+
+    def mean_waveform(self, cluster_id):
+
+        """ Mean waveform of one cluster in microvolts (num_channels x num_samples; NaN if there are no snippets) """
+
+        snippets = self.snippets(cluster_id)
+
+        if snippets.shape[0] == 0:
+            return np.zeros(snippets.shape[1:]) * np.nan
+
+        return np.mean(snippets, 0) * self.bit_volts
@@ -8,6 +8,8 @@ import time
 
 from git import Repo
 
+from .cluster_index import ClusterIndex
+
 
 def find_range(x,a,b,option='within'):
     
@@ -195,6 +197,103 @@ def read_cluster_group_tsv(filename):
 
     return cluster_ids, cluster_quality
 
+
+COLUMNAR_EXTENSIONS = {'parquet' : '.parquet', 'feather' : '.feather'}
+
+
+def columnar_metrics_file(filename, columnar_format):
+
+    """ Path of the columnar copy of a metrics CSV (same name, with a .parquet or .feather extension) """
+
+    return os.path.splitext(filename)[0] + COLUMNAR_EXTENSIONS[columnar_format]
+
+
+def write_metrics_table(metrics, filename, columnar_format = 'none'):
+
+    """
+    Writes a metrics table as CSV and, optionally, in a columnar format
+
+    The columnar copy has fixed column types (int64 for integers, float64 for
+    other numbers, bool for flags, string for text), so tables from different
+    runs can be concatenated without re-parsing; writing it requires pyarrow
+
+    Inputs:
+    -------
+    metrics : pandas.DataFrame
+        One row per unit (per epoch)
+    filename : String
+        Path of the CSV file
+    columnar_format : String
+        'none', 'parquet' or 'feather'
+
+    Outputs:
+    --------
+    CSV file, plus a .parquet or .feather file next to it (written to disk);
+    columnar copies in other formats are removed, as they no longer match the CSV
+
+    """
+
+    metrics.to_csv(filename)
+
+    for other_format in COLUMNAR_EXTENSIONS:
+        if other_format != columnar_format and os.path.exists(columnar_metrics_file(filename, other_format)):
+            os.remove(columnar_metrics_file(filename, other_format))
+
+    if columnar_format == 'none':
+        return
+
+    table = metrics.reset_index(drop=True)
+
+    for column in table.columns:
+        if pd.api.types.is_bool_dtype(table[column]):
+            table[column] = table[column].astype('bool')
+        elif pd.api.types.is_integer_dtype(table[column]):
+            table[column] = table[column].astype('int64')
+        elif pd.api.types.is_numeric_dtype(table[column]):
+            table[column] = table[column].astype('float64')
+        else:
+            table[column] = table[column].astype('string')
+
+    if columnar_format == 'parquet':
+        table.to_parquet(columnar_metrics_file(filename, columnar_format), index=False)
+    else:
+        table.to_feather(columnar_metrics_file(filename, columnar_format))
+
+
+def read_metrics_table(filename):
+
+    """
+    Reads a metrics table written by write_metrics_table
+
+    Uses the columnar copy if there is one at least as new as the CSV
+    (no parsing needed), otherwise the CSV
+
+    Inputs:
+    -------
+    filename : String
+        Path of the CSV file
+
+    Outputs:
+    --------
+    metrics : pandas.DataFrame
+        One row per unit (per epoch)
+
+    """
+
+    for columnar_format in COLUMNAR_EXTENSIONS:
+
+        columnar_file = columnar_metrics_file(filename, columnar_format)
+
+        if os.path.exists(columnar_file) and \
+            (not os.path.exists(filename) or os.path.getmtime(columnar_file) >= os.path.getmtime(filename)):
+
+            if columnar_format == 'parquet':
+                return pd.read_parquet(columnar_file)
+            else:
+                return pd.read_feather(columnar_file)
+
+    return pd.read_csv(filename, index_col=0)
+
 def read_cluster_amplitude_tsv(filename):
     
     """
@@ -220,7 +319,7 @@ def read_cluster_amplitude_tsv(filename):
 
     return cluster_amplitude
 
-def load(folder, filename):
+def load(folder, filename, mmap_mode = None):
 
     """
     Loads a numpy file from a folder.
@@ -231,6 +330,8 @@ def load(folder, filename):
         Directory containing the file to load
     filename : String
         Name of the numpy file
+    mmap_mode : String (optional)
+        Memory-map the file with this mode (e.g. 'r') instead of reading it
 
     Outputs:
     --------
@@ -239,7 +340,298 @@ def load(folder, filename):
 
     """
 
-    return np.load(os.path.join(folder, filename))
+    return np.load(os.path.join(folder, filename), mmap_mode = mmap_mode)
+
+
+def get_unwhitened_templates(folder, use_cache = True):
+
+    """
+    Unwhitens all templates in a Kilosort output directory and finds their peak channels
+
+    All templates are multiplied by the inverse whitening matrix in one batched matmul.
+    The results are cached in the same directory (templates_unwhitened.npy and
+    template_peak_channels.npy), and recomputed if any of the source files is newer
+
+    Inputs:
+    -------
+    folder : String
+        Location of Kilosort output directory
+    use_cache : bool (optional)
+        Flags whether to read and write the cached results
+
+    Outputs:
+    --------
+    unwhitened_templates : numpy.ndarray (M x samples x channels)
+        Unwhitened templates for M units (including zero padding)
+    peak_channels : numpy.ndarray (M x 0)
+        Original data channel with the largest peak-to-peak amplitude for each template
+
+    """
+
+    source_files = [os.path.join(folder, filename) for filename in \
+                    ('templates.npy', 'whitening_mat_inv.npy', 'channel_map.npy')]
+    cache_files = [os.path.join(folder, filename) for filename in \
+                   ('templates_unwhitened.npy', 'template_peak_channels.npy')]
+
+    if use_cache and all([os.path.exists(f) for f in cache_files]) and \
+        min([os.path.getmtime(f) for f in cache_files]) > max([os.path.getmtime(f) for f in source_files]):
+
+        return np.load(cache_files[0]), np.load(cache_files[1])
+
+    templates = np.load(source_files[0])
+    unwhitening_mat = np.load(source_files[1])
+    channel_map = np.squeeze(np.load(source_files[2]))
+
+    unwhitened_templates = np.matmul(templates, unwhitening_mat)
+
+    peak_chan_idx = np.argmax(np.max(unwhitened_templates,1) - np.min(unwhitened_templates,1),1)
+    peak_channels = channel_map[peak_chan_idx].astype('uint32')
+
+    if use_cache:
+        try:
+            np.save(cache_files[0], unwhitened_templates)
+            np.save(cache_files[1], peak_channels)
+        except OSError:
+            print('Unable to cache unwhitened templates in ' + folder)
+
+    return unwhitened_templates, peak_channels
+
+
+class lazy_property():
+
+    """
+    Decorator for attributes that are computed the first time they are accessed
+
+    The value is stored in the instance __dict__, so later accesses skip the
+    descriptor (like functools.cached_property, which requires Python 3.8)
+
+    """
+
+    def __init__(self, function):
+
+        self.function = function
+        self.__doc__ = function.__doc__
+
+    def __get__(self, instance, owner):
+
+        if instance is None:
+            return self
+
+        value = self.function(instance)
+        instance.__dict__[self.function.__name__] = value
+
+        return value
+
+
+class KilosortDataset():
+
+    """
+    Kilosort output files in one directory, loaded on demand
+
+    Each attribute is read from disk (or computed) the first time it is accessed,
+    and per-spike arrays are memory-mapped unless mmap_mode is None
+
+    """
+
+    def __init__(self,
+                 folder,
+                 sample_rate = None,
+                 convert_to_seconds = True,
+                 use_master_clock = False,
+                 template_zero_padding = 21,
+                 mmap_mode = 'r'):
+
+        """
+        folder : String
+            Location of Kilosort output directory
+        sample_rate : float (optional)
+            AP band sample rate in Hz
+        convert_to_seconds : bool (optional)
+            Flags whether to return spike times in seconds (requires sample_rate to be set)
+        use_master_clock : bool (optional)
+            Flags whether to load spike times that have been converted to the master clock timebase
+        template_zero_padding : int (default = 21)
+            Number of zeros added to the beginning of each template
+        mmap_mode : String or None (default = 'r')
+            Mode for memory-mapping .npy files; None reads them into memory
+        """
+
+        self.folder = folder
+        self.sample_rate = sample_rate
+        self.convert_to_seconds = convert_to_seconds
+        self.use_master_clock = use_master_clock
+        self.template_zero_padding = template_zero_padding
+        self.mmap_mode = mmap_mode
+
+    def load(self, filename):
+
+        return load(self.folder, filename, self.mmap_mode)
+
+    @lazy_property
+    def spike_times(self):
+
+        """ numpy.ndarray (N x 0) : Times for N spikes """
+
+        if self.use_master_clock:
+            spike_times = np.squeeze(self.load('spike_times_master_clock.npy'))
+        else:
+            spike_times = np.squeeze(self.load('spike_times.npy'))
+
+        if self.convert_to_seconds and self.sample_rate is not None:
+            spike_times = spike_times / self.sample_rate
+
+        return spike_times
+
+    @lazy_property
+    def spike_clusters(self):
+
+        """ numpy.ndarray (N x 0) : Cluster IDs for N spikes """
+
+        return np.squeeze(self.load('spike_clusters.npy'))
+
+    @lazy_property
+    def spike_templates(self):
+
+        """ numpy.ndarray (N x 0) : Template IDs for N spikes """
+
+        return self.load('spike_templates.npy')
+
+    @lazy_property
+    def amplitudes(self):
+
+        """ numpy.ndarray (N x 0) : Amplitudes for N spikes """
+
+        return self.load('amplitudes.npy')
+
+    @lazy_property
+    def unwhitened_templates(self):
+
+        """ (unwhitened templates including zero padding, peak channels) from get_unwhitened_templates """
+
+        return get_unwhitened_templates(self.folder)
+
+    @property
+    def templates(self):
+
+        """ numpy.ndarray (M x samples x channels) : Unwhitened templates for M units """
+
+        return self.unwhitened_templates[0][:,self.template_zero_padding:,:] # remove zeros
+
+    @property
+    def peak_channels(self):
+
+        """ numpy.ndarray (M x 0) : Channel with the largest peak-to-peak amplitude for each template """
+
+        return self.unwhitened_templates[1]
+
+    @lazy_property
+    def channel_map(self):
+
+        """ numpy.ndarray : Channels from original data file used for sorting """
+
+        return np.load(os.path.join(self.folder, 'channel_map.npy'))
+
+    @lazy_property
+    def channel_pos(self):
+
+        """ numpy.ndarray (channels x 2) : X and Z coordinates for each channel used in the sort """
+
+        return np.load(os.path.join(self.folder, 'channel_positions.npy'))
+
+    @lazy_property
+    def channel_shanks(self):
+
+        """ numpy.ndarray (channels x 0) : Shank index for each channel used in the sort """
+
+        return load_channel_shanks(self.folder, np.squeeze(self.channel_map).size)
+
+    @lazy_property
+    def cluster_groups(self):
+
+        """ (cluster_ids, cluster_quality) from cluster_group.tsv, or all clusters labeled 'unsorted' """
+
+        try:
+            return read_cluster_group_tsv(os.path.join(self.folder, 'cluster_group.tsv'))
+        except OSError:
+            cluster_ids = np.unique(self.spike_clusters)
+            return cluster_ids, ['unsorted'] * cluster_ids.size
+
+    @property
+    def cluster_ids(self):
+
+        """ Cluster IDs for M units """
+
+        return self.cluster_groups[0]
+
+    @property
+    def cluster_quality(self):
+
+        """ Quality ratings from cluster_group.tsv file """
+
+        return self.cluster_groups[1]
+
+    @lazy_property
+    def cluster_amplitude(self):
+
+        """ Average amplitude for each cluster from cluster_Amplitude.tsv file """
+
+        return read_cluster_amplitude_tsv(os.path.join(self.folder, 'cluster_Amplitude.tsv'))
+
+    @lazy_property
+    def pc_features(self):
+
+        """ numpy.ndarray (N x num_PCs x channels) : PC features for each spike """
+
+        return self.load('pc_features.npy')
+
+    @lazy_property
+    def pc_feature_ind(self):
+
+        """ numpy.ndarray (M x channels) : Channels used for PC calculation for each unit """
+
+        return np.load(os.path.join(self.folder, 'pc_feature_ind.npy'))
+
+    @lazy_property
+    def template_features(self):
+
+        """ numpy.ndarray (N x number of features) : Projections onto template features for each spike """
+
+        return self.load('template_features.npy')
+
+    @lazy_property
+    def cluster_index(self):
+
+        """ ClusterIndex : Spike indices grouped by cluster ID """
+
+        return ClusterIndex(self.spike_clusters)
+
+
+def load_channel_shanks(folder, num_channels):
+
+    """
+    Loads the shank index of each channel from channel_shanks.npy (written by the
+    kilosort_helper module for SpikeGLX data, in the same order as channel_map.npy)
+
+    Inputs:
+    -------
+    folder : String
+        Location of Kilosort output directory
+    num_channels : Int
+        Number of channels used in the sort
+
+    Outputs:
+    --------
+    channel_shanks : numpy.ndarray (num_channels x 0)
+        Shank index for each channel (all 0 if the file does not exist)
+
+    """
+
+    filename = os.path.join(folder, 'channel_shanks.npy')
+
+    if not os.path.exists(filename):
+        return np.zeros((num_channels,), dtype='int64')
+
+    return np.squeeze(np.load(filename)).astype('int64')
 
 
 def load_kilosort_data(folder, 
@@ -252,6 +644,9 @@ def load_kilosort_data(folder,
     """
     Loads Kilosort output files from a directory
 
+    All files are read into memory; use KilosortDataset to memory-map them
+    and load only the fields that are needed
+
     Inputs:
     -------
     folder : String
@@ -298,57 +693,22 @@ def load_kilosort_data(folder,
 
     """
 
-    if use_master_clock:
-        spike_times = load(folder,'spike_times_master_clock.npy')
-    else:
-        spike_times = load(folder,'spike_times.npy')
-        
-    spike_clusters = load(folder,'spike_clusters.npy')
-    spike_templates = load(folder, 'spike_templates.npy')
-    amplitudes = load(folder,'amplitudes.npy')
-    templates = load(folder,'templates.npy')
-    unwhitening_mat = load(folder,'whitening_mat_inv.npy')
-    channel_map = load(folder, 'channel_map.npy')
-    channel_pos = load(folder, 'channel_positions.npy')
-
-    if include_pcs:
-        pc_features = load(folder, 'pc_features.npy')
-        pc_feature_ind = load(folder, 'pc_feature_ind.npy')
-        print("loading template_features")
-        template_features = load(folder, 'template_features.npy') 
-
-                
-    templates = templates[:,template_zero_padding:,:] # remove zeros
-    spike_clusters = np.squeeze(spike_clusters) # fix dimensions
-    spike_times = np.squeeze(spike_times)# fix dimensions
-
-    if convert_to_seconds and sample_rate is not None:
-       spike_times = spike_times / sample_rate 
-                    
-    unwhitened_temps = np.zeros((templates.shape))
-    
-    for temp_idx in range(templates.shape[0]):
-        
-        unwhitened_temps[temp_idx,:,:] = np.dot(np.ascontiguousarray(templates[temp_idx,:,:]),np.ascontiguousarray(unwhitening_mat))
-                    
-    try:
-        cluster_ids, cluster_quality = read_cluster_group_tsv(os.path.join(folder, 'cluster_group.tsv'))
-    except OSError:
-        cluster_ids = np.unique(spike_clusters)
-        cluster_quality = ['unsorted'] * cluster_ids.size
-        
-    cluster_amplitude = read_cluster_amplitude_tsv(os.path.join(folder, 'cluster_Amplitude.tsv'))
-    
-        
-        
+    kilosort_data = KilosortDataset(folder, 
+                                    sample_rate, 
+                                    convert_to_seconds, 
+                                    use_master_clock, 
+                                    template_zero_padding, 
+                                    mmap_mode = None)
+
+    outputs = (kilosort_data.spike_times, kilosort_data.spike_clusters, kilosort_data.spike_templates, 
+               kilosort_data.amplitudes, kilosort_data.templates, kilosort_data.channel_map, 
+               kilosort_data.channel_pos, kilosort_data.cluster_ids, kilosort_data.cluster_quality, 
+               kilosort_data.cluster_amplitude)
 
     if not include_pcs:
-        return spike_times, spike_clusters, spike_templates, amplitudes, unwhitened_temps, \
-               channel_map, channel_pos, cluster_ids, cluster_quality, cluster_amplitude
+        return outputs
     else:
-        return spike_times, spike_clusters, spike_templates, amplitudes, unwhitened_temps, \
-               channel_map, channel_pos, cluster_ids, cluster_quality, cluster_amplitude, \
-               pc_features, pc_feature_ind, template_features
+        return outputs + (kilosort_data.pc_features, kilosort_data.pc_feature_ind, kilosort_data.template_features)
 
 
 def get_spike_depths(spike_clusters, pc_features, pc_feature_ind, channel_pos):
@@ -376,8 +736,7 @@ def get_spike_depths(spike_clusters, pc_features, pc_feature_ind, channel_pos):
 
     """
 
-    pc_features_copy = np.copy(pc_features)
-    pc_features_copy = np.squeeze(pc_features_copy[:,0,:])
+    pc_features_copy = np.squeeze(np.copy(pc_features[:,0,:])) # only the first PC is needed
     pc_features_copy[pc_features_copy < 0] = 0
     pc_power = pow(pc_features_copy, 2)
     
@@ -543,25 +902,9 @@ def getSortResults(output_dir):
     unqLabel, labelCounts = np.unique(cluLabel, return_counts = True)
     nTot = cluLabel.shape[0]
 
-    templates = np.load(os.path.join(output_dir, 'templates.npy'))
-    channel_map = np.load(os.path.join(output_dir, 'channel_map.npy'))
-    channel_map = np.squeeze(channel_map)
-    
-    # read in inverse of whitening matrix
-    w_inv = np.load((os.path.join(output_dir, 'whitening_mat_inv.npy')))
-    nTemplate = templates.shape[0]
-    
-    # initialize peak_channels array
-    peak_channels = np.zeros([nTemplate,],'uint32')
-    
-    # for each template (nt x nchan), multiply the the transpose (nchan x nt) by inverse of 
-    # the whitening matrix (nchan x nchan); get max and min along tthe time axis (1)
-    # to find the peak channel
-    for i in np.arange(0,nTemplate):
-        currT = templates[i,:].T
-        curr_unwh = np.matmul(w_inv, currT)
-        currdiff = np.max(curr_unwh,1) - np.min(curr_unwh,1)
-        peak_channels[i] = channel_map[np.argmax(currdiff)]
+    # peak channel of each unwhitened template (shared with the other modules)
+    unwhitened_templates, peak_channels = get_unwhitened_templates(output_dir)
+    nTemplate = unwhitened_templates.shape[0]
 
     clus_Table = np.zeros((nTemplate, 2), dtype='uint32')
     clus_Table[unqLabel, 0] = labelCounts
@@ -5,8 +5,9 @@ from scipy.signal import butter, filtfilt, medfilt
 
 from .utils import (get_spike_depths, 
                     get_spike_amplitudes,
-                    load_kilosort_data,
+                    KilosortDataset,
                     rms)
+from .snippet_store import SnippetStore
 
 
 def plotKsTemplates(ks_directory, raw_data_file, sample_rate = 30000, bit_volts = 0.195, time_range = [10, 11], exclude_noise=True, fig=None, output_path=None):
@@ -39,13 +40,18 @@ def plotKsTemplates(ks_directory, raw_data_file, sample_rate = 30000, bit_volts
 
     """
 
-    spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, \
-    channel_pos, clusterIDs, cluster_quality, cluster_amplitude, pc_features, pc_feature_ind, template_features= \
-                load_kilosort_data(ks_directory, 
+    kilosort_data = KilosortDataset(ks_directory, 
                     sample_rate, 
                     convert_to_seconds = False,
-                    use_master_clock = False,
-                    include_pcs = True)
+                    use_master_clock = False)
+
+    spike_times = kilosort_data.spike_times
+    spike_templates = kilosort_data.spike_templates
+    amplitudes = kilosort_data.amplitudes
+    templates = kilosort_data.templates
+    channel_map = kilosort_data.channel_map
+    clusterIDs = kilosort_data.cluster_ids
+    cluster_quality = kilosort_data.cluster_quality
 
     raw_data = np.memmap(raw_data_file, dtype='int16')
     data = np.reshape(raw_data, (int(raw_data.size / 384), 384))
@@ -141,15 +147,17 @@ def plotDriftmap(ks_directory, sample_rate = 30000, time_range = [0, np.inf], ex
 
     """
 
-    spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, \
-    channel_pos, clusterIDs, cluster_quality, cluster_amplitude, pc_features, pc_feature_ind, template_features = \
-                load_kilosort_data(ks_directory, 
+    kilosort_data = KilosortDataset(ks_directory, 
                     sample_rate, 
-                    use_master_clock = False,
-                    include_pcs = True)
+                    use_master_clock = False)
+
+    spike_times = kilosort_data.spike_times
+    spike_clusters = kilosort_data.spike_clusters
+    clusterIDs = kilosort_data.cluster_ids
+    cluster_quality = kilosort_data.cluster_quality
 
-    spike_depths = get_spike_depths(spike_clusters, pc_features, pc_feature_ind, channel_pos)
-    spike_amplitudes = get_spike_amplitudes(spike_templates, templates, amplitudes)
+    spike_depths = get_spike_depths(spike_clusters, kilosort_data.pc_features, kilosort_data.pc_feature_ind, kilosort_data.channel_pos)
+    spike_amplitudes = get_spike_amplitudes(kilosort_data.spike_templates, kilosort_data.templates, kilosort_data.amplitudes)
 
     if exclude_noise:
         good_units = clusterIDs[cluster_quality != 'noise']
@@ -353,13 +361,16 @@ def plotFullProbeTSNE(ks_directory, total_spikes=150000, exclude_noise = True, f
 
     from matplotlib.cm import get_cmap
 
-    spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, channel_pos, \
-    clusterIDs, cluster_quality, cluster_amplitude, pc_features, pc_feature_ind, template_features = \
-                load_kilosort_data(ks_directory, 
+    kilosort_data = KilosortDataset(ks_directory, 
                     30000., 
                     convert_to_seconds = False,
-                    use_master_clock = False,
-                    include_pcs = True)
+                    use_master_clock = False)
+
+    spike_clusters = kilosort_data.spike_clusters
+    clusterIDs = kilosort_data.cluster_ids
+    cluster_quality = kilosort_data.cluster_quality
+    pc_features = kilosort_data.pc_features
+    pc_feature_ind = kilosort_data.pc_feature_ind
 
     if exclude_noise:
         good_units = clusterIDs[cluster_quality != 'noise']
@@ -404,4 +415,61 @@ def plotFullProbeTSNE(ks_directory, total_spikes=150000, exclude_noise = True, f
     
     if output_path is not None:
        plt.savefig(output_path)
-       plt.close('all')
\ No newline at end of file
+       plt.close('all')
+
+
+def plotUnitSnippets(snippet_store_dir, cluster_ids, num_snippets = 50, fig=None, output_path=None):
+
+    """
+    Plots individual spike snippets and the mean waveform of each unit on its peak channel,
+    read from the snippet store saved by the mean_waveforms module (no raw data file needed)
+
+    Inputs:
+    ------
+    snippet_store_dir : str
+        Path to the snippet store
+    cluster_ids : list of int
+        Units to plot (one panel each)
+    num_snippets : int
+        Maximum number of snippets to plot for each unit
+    fig : matplotlib.pyplot.figure
+        Figure handle to use for plotting
+    output_path : str
+        Path for saving the image
+
+    Outputs:
+    --------
+    Saves image to output_path (optional)
+
+    """
+
+    store = SnippetStore(snippet_store_dir)
+
+    if fig is None:
+        fig = plt.figure(figsize=(3 * len(cluster_ids), 4))
+
+    t = (np.arange(store.samples_per_spike) - store.pre_samples) / store.sample_rate * 1000
+
+    for idx, cluster_id in enumerate(cluster_ids):
+
+        ax = plt.subplot(1, len(cluster_ids), idx + 1)
+
+        snippets = store.snippets(cluster_id)[:num_snippets] * store.bit_volts
+        mean_waveform = store.mean_waveform(cluster_id)
+
+        if snippets.shape[0] > 0:
+
+            peak = np.argmax(np.max(mean_waveform, 1) - np.min(mean_waveform, 1))
+
+            ax.plot(t, snippets[:, peak, :].T, color='gray', alpha=0.2, linewidth=0.5)
+            ax.plot(t, mean_waveform[peak, :], color='k')
+            ax.set_title('Unit ' + str(cluster_id) + ', channel ' + str(store.channels(cluster_id)[peak]))
+
+        ax.set_xlabel('Time (ms)')
+
+        if idx == 0:
+            ax.set_ylabel('Amplitude (uV)')
+
+    if output_path is not None:
+        plt.savefig(output_path)
+        plt.close('all')
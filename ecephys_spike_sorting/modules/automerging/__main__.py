@@ -6,9 +6,11 @@ import numpy as np
 
 from .automerging import automerging
 
-from ...common.utils import write_cluster_group_tsv, load_kilosort_data
+from ...common.utils import write_cluster_group_tsv, load_kilosort_data, load_channel_shanks
+from ...common.profiling import profiled
 
 
+@profiled
 def run_automerging(args):
 
     print('ecephys spike sorting: automerging module')
@@ -16,12 +18,15 @@ def run_automerging(args):
     start = time.time()
     
     spike_times, spike_clusters, spike_templates, amplitudes, templates, \
-    channel_map, channel_pos, clusterIDs, cluster_quality, cluster_amplitude, template_features = \
+    channel_map, channel_pos, clusterIDs, cluster_quality, cluster_amplitude = \
         load_kilosort_data(args['directories']['kilosort_output_directory'], \
             args['ephys_params']['sample_rate'], \
             convert_to_seconds = True)
     
-    spike_clusters, cluster_index, cluster_quality = automerging(spike_times, spike_clusters, clusterIDs, templates, args['automerging_params'])
+    channel_shanks = load_channel_shanks(args['directories']['kilosort_output_directory'], np.squeeze(channel_map).size)
+
+    spike_clusters, cluster_index, cluster_quality = automerging(spike_times, spike_clusters, clusterIDs, np.array(cluster_quality), templates, args['automerging_params'],
+                                                                 channel_shanks = channel_shanks)
 
     write_cluster_group_tsv(cluster_index, cluster_quality)
     np.save(os.path.join(args['directories']['kilosort_output_directory'], 'spike_clusters.npy'), spike_clusters)
@@ -6,7 +6,7 @@ from .metrics import compare_templates, make_interp_temp, compute_isi_score, com
 from .merges import compute_overall_score, ID_merge_groups, make_merges
 from ...common.spike_template_helpers import find_depth
 
-def automerging(spike_times, spike_clusters, clusterIDs, cluster_quality, templates, params):
+def automerging(spike_times, spike_clusters, clusterIDs, cluster_quality, templates, params, channel_shanks = None):
 
     min_t = np.min(spike_times)
     max_t = np.max(spike_times)
@@ -26,12 +26,20 @@ def automerging(spike_times, spike_clusters, clusterIDs, cluster_quality, templa
         depths = depths[sorted_by_depth]
         is_good = np.invert(is_noise[sorted_by_depth])
 
+    # units on different shanks are never merged, so only pairs on the same shank are compared
+    if channel_shanks is None:
+        shanks = np.zeros((depths.size,), dtype='int64')
+    else:
+        shanks = np.asarray(channel_shanks)[depths.astype('int64')]
+
     comparison_matrix = np.zeros((depths.size, depths.size, 5))
         
-    for i in range(0,depths.size):
-        for j in range(i+1,depths.size):
-            if np.abs(depths[i] - depths[j]) <= params['distance_to_compare'] and is_good[i] and is_good[j]:
-                comparison_matrix[i,j,0] = 1
+    for shank in np.unique(shanks):
+        on_shank = np.where(shanks == shank)[0]
+        for i in on_shank:
+            for j in on_shank[on_shank > i]:
+                if np.abs(depths[i] - depths[j]) <= params['distance_to_compare'] and is_good[i] and is_good[j]:
+                    comparison_matrix[i,j,0] = 1
             
     print('Total comparisons: ' + str(np.where(comparison_matrix[:,:,0] == 1)[0].size))
 
@@ -9,7 +9,9 @@ import numpy as np
 
 
 from ...common.utils import read_probe_json, get_repo_commit_date_and_hash, rms
+from ...common.profiling import profiled
 
+@profiled
 def run_CatGT(args):
 
     print('ecephys spike sorting: CatGT helper module')
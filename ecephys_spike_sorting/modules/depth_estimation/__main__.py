@@ -7,7 +7,9 @@ import numpy as np
 
 from .depth_estimation import compute_channel_offsets, find_surface_channel
 from ...common.utils import write_probe_json
+from ...common.profiling import profiled
 
+@profiled
 def run_depth_estimation(args):
 
     print('ecephys spike sorting: depth estimation module\n')
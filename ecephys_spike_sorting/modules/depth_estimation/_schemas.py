@@ -32,6 +32,7 @@ class InputParameters(ArgSchema):
     ephys_params = Nested(EphysParams)
     directories = Nested(Directories)
     common_files = Nested(CommonFiles)
+    profile = Bool(required=False, default=False, help='Record run time, CPU time, peak memory and disk I/O of each stage in the output manifest')
 
 class OutputSchema(DefaultSchema): 
 
@@ -45,4 +46,5 @@ class OutputParameters(OutputSchema):
     surface_channel = Int()
     air_channel = Int()
     probe_json = String()
-    execution_time = Float()  
\ No newline at end of file
+    execution_time = Float()  
+    profile = Dict(required=False, help='Run time, CPU time, peak memory and disk I/O of the whole run and of each stage (if profile is True)')
\ No newline at end of file
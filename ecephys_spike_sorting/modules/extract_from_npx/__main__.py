@@ -11,7 +11,9 @@ import io, json, os
 
 from .create_settings_json import create_settings_json
 from ...common.utils import get_repo_commit_date_and_hash
+from ...common.profiling import profiled
 
+@profiled
 def run_npx_extractor(args):
 
     print('ecephys spike sorting: npx extractor module')
@@ -1,6 +1,6 @@
 from argschema import ArgSchema, ArgSchemaParser 
 from argschema.schemas import DefaultSchema
-from argschema.fields import Nested, InputDir, String, Float, Dict, Int
+from argschema.fields import Nested, InputDir, String, Float, Dict, Int, Bool
 from ...common.schemas import EphysParams, Directories, CommonFiles
 
 class ExtractFromNpxParams(DefaultSchema):
@@ -13,6 +13,7 @@ class InputParameters(ArgSchema):
     extract_from_npx_params = Nested(ExtractFromNpxParams)
     directories = Nested(Directories)
     common_files = Nested(CommonFiles)
+    profile = Bool(required=False, default=False, help='Record run time, CPU time, peak memory and disk I/O of each stage in the output manifest')
 
 class OutputSchema(DefaultSchema): 
     input_parameters = Nested(InputParameters, 
@@ -25,4 +26,5 @@ class OutputParameters(OutputSchema):
     settings_json = String()
     npx_extractor_commit_hash = String()
     npx_extractor_commit_date = String()
+    profile = Dict(required=False, help='Run time, CPU time, peak memory and disk I/O of the whole run and of each stage (if profile is True)')
     
\ No newline at end of file
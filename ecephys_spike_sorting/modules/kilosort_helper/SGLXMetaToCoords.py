@@ -454,6 +454,7 @@ def CoordsToKSChanMap(chans, xCoord, yCoord, connected, shankInd, shankSep, base
 #   outType:  format for the output
 #   badChan:  channels other than reference channels to exclude
 #   destFullPath: 
+# Returns the shank index of each saved channel
     
 def MetaToCoords(metaFullPath, outType, badChan= np.zeros((0), dtype = 'int'), destFullPath = '', showPlot=False):
     
@@ -541,6 +542,9 @@ def MetaToCoords(metaFullPath, outType, badChan= np.zeros((0), dtype = 'int'), d
     
     writeFunc = outputSwitch.get(outType)
     writeFunc(chans, xCoord, yCoord, connected, shankInd, shankSep, baseName, savePath, buildPath )
+
+    # shank index of each saved channel, so later modules can process shanks separately
+    return shankInd
     
 # Sample calling program to get a metadata file from the user,
 # output a file set by outType
@@ -16,7 +16,9 @@ from scipy.signal import butter, filtfilt, medfilt
 from . import matlab_file_generator
 from .SGLXMetaToCoords import MetaToCoords
 from ...common.utils import read_probe_json, get_repo_commit_date_and_hash, rms, getSortResults
+from ...common.profiling import profiled
 
+@profiled
 def run_kilosort(args):
 
     print('ecephys spike sorting: kilosort helper module')
@@ -46,7 +48,7 @@ def run_kilosort(args):
 
        destFullPath = os.path.join(args['kilosort_helper_params']['matlab_home_directory'], 'chanMap.mat')
        MaskChannels = np.where(mask == False)[0]      
-       MetaToCoords( metaFullPath=metaFullPath, outType=1, badChan=MaskChannels, destFullPath=destFullPath)
+       shankInd = MetaToCoords( metaFullPath=metaFullPath, outType=1, badChan=MaskChannels, destFullPath=destFullPath)
        # end of SpikeGLX block
        
     else:
@@ -129,6 +131,10 @@ def run_kilosort(args):
 
     fix_phy_params(output_dir, dat_dir, args['ephys_params']['sample_rate'])
 
+    if args['kilosort_helper_params']['spikeGLX_data']:
+        # shank of each sorted channel, so later modules can process each shank separately
+        save_channel_shanks(output_dir, shankInd)
+
     # make a copy of the channel map to the data directory
     # see above: destFullPath specifiee destination for chanMap.mat
     shutil.copy(destFullPath, os.path.join(dat_dir, 'chanMap.mat'))
@@ -200,6 +206,11 @@ def get_noise_channels(raw_data_file, num_channels, sample_rate, bit_volts, nois
 
     return above_median < noise_threshold
 
+def save_channel_shanks(output_dir, shankInd):
+    # write channel_shanks.npy (one entry per channel in channel_map.npy, as used by phy)
+    channel_map = np.squeeze(np.load(os.path.join(output_dir, 'channel_map.npy'))).astype('int64')
+    np.save(os.path.join(output_dir, 'channel_shanks.npy'), np.asarray(shankInd)[channel_map])
+
 def fix_phy_params(output_dir, dat_path, sample_rate):
     # write a new params.py file with the relative path to the binary file
     # first make a copy of the original
@@ -69,6 +69,7 @@ class InputParameters(ArgSchema):
     directories = Nested(Directories)
     ephys_params = Nested(EphysParams)
     common_files = Nested(CommonFiles)
+    profile = Boolean(required=False, default=False, help='Record run time, CPU time, peak memory and disk I/O of each stage in the output manifest')
     
 
 class OutputSchema(DefaultSchema): 
@@ -85,4 +86,5 @@ class OutputParameters(OutputSchema):
     mask_channels = NumpyArray()
     nTemplate = Int()
     nTot = Int()
+    profile = Dict(required=False, help='Run time, CPU time, peak memory and disk I/O of the whole run and of each stage (if profile is True)')
     
\ No newline at end of file
@@ -6,10 +6,12 @@ import time
 
 import numpy as np
 
-from ...common.utils import load_kilosort_data, getSortResults
+from ...common.utils import KilosortDataset, getSortResults
+from ...common.profiling import profiled, profile_stage
 
 from .postprocessing import remove_double_counted_spikes
 
+@profiled
 def run_postprocessing(args):
 
     print('ecephys spike sorting: kilosort postprocessing module')
@@ -21,48 +23,50 @@ def run_postprocessing(args):
 
     start = time.time()
 
-    spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, \
-    channel_pos, clusterIDs, cluster_quality, cluster_amplitude, pc_features, pc_feature_ind, template_features = \
-                load_kilosort_data(args['directories']['kilosort_output_directory'], \
+    # per-spike files are overwritten below, so read them into memory instead of memory-mapping
+    kilosort_data = KilosortDataset(args['directories']['kilosort_output_directory'], \
                     args['ephys_params']['sample_rate'], \
                     convert_to_seconds = False,
                     use_master_clock = False,
-                    include_pcs = True)
-
-    spike_times, spike_clusters, spike_templates, amplitudes, pc_features, \
-    template_features, overlap_matrix, overlap_summary = \
-        remove_double_counted_spikes(spike_times, 
-                                     spike_clusters,
-                                     spike_templates, 
-                                     amplitudes, 
-                                     channel_map,
-                                     channel_pos,
-                                     templates, 
-                                     pc_features, 
-                                     pc_feature_ind, 
-                                     template_features,
-                                     cluster_amplitude,
-                                     args['ephys_params']['sample_rate'],
-                                     args['ks_postprocessing_params'])
+                    mmap_mode = None)
+
+    with profile_stage('remove_double_counted_spikes'):
+        spike_times, spike_clusters, spike_templates, amplitudes, pc_features, \
+        template_features, overlap_matrix, overlap_summary = \
+            remove_double_counted_spikes(kilosort_data.spike_times, 
+                                         kilosort_data.spike_clusters,
+                                         kilosort_data.spike_templates, 
+                                         kilosort_data.amplitudes, 
+                                         kilosort_data.channel_map,
+                                         kilosort_data.channel_pos,
+                                         kilosort_data.templates, 
+                                         kilosort_data.pc_features, 
+                                         kilosort_data.pc_feature_ind, 
+                                         kilosort_data.template_features,
+                                         kilosort_data.cluster_amplitude,
+                                         args['ephys_params']['sample_rate'],
+                                         args['ks_postprocessing_params'],
+                                         channel_shanks = kilosort_data.channel_shanks)
 
     print("Saving data...")
 
     # save data -- it's fine to overwrite existing files, because the original outputs are stored in rez.mat
     output_dir = args['directories']['kilosort_output_directory']
-    np.save(os.path.join(output_dir, 'spike_times.npy'), spike_times)
-    np.save(os.path.join(output_dir, 'amplitudes.npy'), amplitudes)
-    np.save(os.path.join(output_dir, 'spike_clusters.npy'), spike_clusters)
-    np.save(os.path.join(output_dir, 'spike_templates.npy'), spike_templates)
-    np.save(os.path.join(output_dir, 'pc_features.npy'), pc_features)
-    np.save(os.path.join(output_dir, 'template_features.npy'), template_features)
-    np.save(os.path.join(output_dir, 'overlap_matrix.npy'), overlap_matrix)
-    np.save(os.path.join(output_dir, 'overlap_summary.npy'), overlap_summary)
-
-    # save the overlap_summary as a text file -- allows user to easily understand what happened
-    np.savetxt(os.path.join(output_dir, 'overlap_summary.csv'), overlap_summary, fmt = '%d', delimiter = ',')
-
-    # remoake the clus_Table.npy with the new spike counts
-    getSortResults(output_dir)
+    with profile_stage('saving'):
+        np.save(os.path.join(output_dir, 'spike_times.npy'), spike_times)
+        np.save(os.path.join(output_dir, 'amplitudes.npy'), amplitudes)
+        np.save(os.path.join(output_dir, 'spike_clusters.npy'), spike_clusters)
+        np.save(os.path.join(output_dir, 'spike_templates.npy'), spike_templates)
+        np.save(os.path.join(output_dir, 'pc_features.npy'), pc_features)
+        np.save(os.path.join(output_dir, 'template_features.npy'), template_features)
+        np.save(os.path.join(output_dir, 'overlap_matrix.npy'), overlap_matrix)
+        np.save(os.path.join(output_dir, 'overlap_summary.npy'), overlap_summary)
+
+        # save the overlap_summary as a text file -- allows user to easily understand what happened
+        np.savetxt(os.path.join(output_dir, 'overlap_summary.csv'), overlap_summary, fmt = '%d', delimiter = ',')
+
+        # remoake the clus_Table.npy with the new spike counts
+        getSortResults(output_dir)
 
     execution_time = time.time() - start
 
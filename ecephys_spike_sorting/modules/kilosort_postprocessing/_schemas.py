@@ -1,6 +1,6 @@
 from argschema import ArgSchema, ArgSchemaParser 
 from argschema.schemas import DefaultSchema
-from argschema.fields import Nested, InputDir, String, Float, Dict, Int
+from argschema.fields import Nested, InputDir, String, Float, Dict, Int, Bool
 from ...common.schemas import EphysParams, Directories
 
 
@@ -15,6 +15,7 @@ class InputParameters(ArgSchema):
     ks_postprocessing_params = Nested(PostprocessingParams)
     directories = Nested(Directories)
     ephys_params = Nested(EphysParams)
+    profile = Bool(required=False, default=False, help='Record run time, CPU time, peak memory and disk I/O of each stage in the output manifest')
     
 
 class OutputSchema(DefaultSchema): 
@@ -26,4 +27,5 @@ class OutputSchema(DefaultSchema):
 class OutputParameters(OutputSchema): 
 
     execution_time = Float()
+    profile = Dict(required=False, help='Run time, CPU time, peak memory and disk I/O of the whole run and of each stage (if profile is True)')
     
\ No newline at end of file
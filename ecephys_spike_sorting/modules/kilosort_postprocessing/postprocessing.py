@@ -7,7 +7,7 @@ from ...common.utils import printProgressBar
 def remove_double_counted_spikes(spike_times, spike_clusters, spike_templates, 
                                  amplitudes, channel_map, channel_pos, templates, pc_features, 
                                  pc_feature_ind, template_features, cluster_amplitude, 
-                                 sample_rate, params, epochs = None):
+                                 sample_rate, params, epochs = None, channel_shanks = None):
 
     """ Remove putative double-counted spikes from Kilosort outputs
 
@@ -39,6 +39,8 @@ def remove_double_counted_spikes(spike_times, spike_clusters, spike_templates,
         'between_unit_channel_distance' : number of channels over which to search for overlapping spikes
     epochs : list of Epoch objects
         contains information on Epoch start and stop times
+    channel_shanks : numpy.ndarray (num_channels x 0) (optional)
+        Shank index for each channel; units on different shanks are never compared
 
     
     Outputs:
@@ -82,7 +84,7 @@ def remove_double_counted_spikes(spike_times, spike_clusters, spike_templates,
 
     print('Removing within-unit overlapping spikes...')
 
-    spikes_to_remove = np.zeros((0,))
+    spikes_to_remove = np.zeros((0,), dtype='int64')
 
     for idx1, unit_id1 in enumerate(sorted_unit_list):
 
@@ -106,22 +108,34 @@ def remove_double_counted_spikes(spike_times, spike_clusters, spike_templates,
 
     print('Removing between-unit overlapping spikes...')
 
-    spikes_to_remove = np.zeros((0,))
+    spikes_to_remove = np.zeros((0,), dtype='int64')
+
+    # each shank is scanned separately; pairs of units on different shanks are skipped
+    if channel_shanks is None:
+        unit_shanks = np.zeros((num_clusters,), dtype='int64')
+    else:
+        unit_shanks = np.squeeze(channel_shanks)[peak_chan_idx]
+
+    sorted_unit_shanks = unit_shanks[sorted_unit_list]
 
     for idx1, unit_id1 in enumerate(sorted_unit_list):
 
         printProgressBar(idx1+1, len(unit_list))
 
         for_unit1 = np.where(spike_clusters == unit_id1)[0]
+
+        same_shank = np.where(sorted_unit_shanks == sorted_unit_shanks[idx1])[0]
         
-        for idx2, unit_id2 in enumerate(unit_list[order]):
+        for idx2 in same_shank[same_shank > idx1]:
+
+            unit_id2 = sorted_unit_list[idx2]
             
             deltaX = np.squeeze(channel_pos[peak_chan_idx[unit_id2],0] - channel_pos[peak_chan_idx[unit_id1],0])
             deltaZ = np.squeeze(channel_pos[peak_chan_idx[unit_id2],1] - channel_pos[peak_chan_idx[unit_id1],1])
             
             dist = pow( (pow(deltaX,2) + pow(deltaZ,2)), 0.5 )
             
-            if idx2 > idx1 and dist < params['between_unit_dist_um']:
+            if dist < params['between_unit_dist_um']:
                 
                 amp1 = cluster_amplitude[unit_id1]
                 amp2 = cluster_amplitude[unit_id2]
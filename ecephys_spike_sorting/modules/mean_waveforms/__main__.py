@@ -5,19 +5,29 @@ import logging
 import time
 
 import numpy as np
-import pandas as pd
 
-from ...common.utils import load_kilosort_data
+from ...common.utils import KilosortDataset, write_metrics_table, read_metrics_table
+from ...common.profiling import profiled, profile_stage
 
 from .extract_waveforms import extract_waveforms, writeDataAsNpy
 from .waveform_metrics import calculate_waveform_metrics
 from .metrics_from_file import metrics_from_file
+from .parallel_waveforms import calculate_mean_waveforms_parallel
+from .snippet_store import SnippetStoreWriter, write_snippet_store
 
+@profiled
 def calculate_mean_waveforms(args):
 
     print('ecephys spike sorting: mean waveforms module')
     
     start = time.time()
+
+    output = {}
+
+    if args['mean_waveform_params']['write_snippet_store']:
+        output['snippet_store_dir'] = args['mean_waveform_params'].get('snippet_store_dir',
+                    os.path.join(args['directories']['kilosort_output_directory'], 'snippet_store'))
+        print('Saving spike snippets to ' + output['snippet_store_dir'])
     
     if args['mean_waveform_params']['use_C_Waves']:
         
@@ -45,38 +55,93 @@ def calculate_mean_waveforms(args):
         print(cwaves_cmd)
         
         # make the C_Waves call
-        subprocess.call(cwaves_cmd)
+        with profile_stage('C_Waves'):
+            subprocess.call(cwaves_cmd)
 
         
         # C_Waves writes out files of the waveforms and snr
         # call version of calculate_waveform_metrics that will use these files
         # load in kilosort output needed for these calculations
-        spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, \
-        channel_pos, clusterIDs, cluster_quality, cluster_amplitude = \
-                load_kilosort_data(args['directories']['kilosort_output_directory'], \
+        kilosort_data = KilosortDataset(args['directories']['kilosort_output_directory'], \
                     args['ephys_params']['sample_rate'], \
                     convert_to_seconds = False)
-                
-        # read in inverse of whitening matrix
-        w_inv = np.load((os.path.join(args['directories']['kilosort_output_directory'], 'whitening_mat_inv.npy')))
-        
+
                 
         mean_waveform_fullpath = os.path.join(dest, 'mean_waveforms.npy')
         snr_fullpath = os.path.join(dest, 'cluster_snr.npy')
                 
-        metrics = metrics_from_file(mean_waveform_fullpath, snr_fullpath, \
-                    spike_times, \
-                    spike_clusters, \
-                    templates, \
-                    channel_map, \
-                    args['ephys_params']['bit_volts'], \
-                    args['ephys_params']['sample_rate'], \
-                    args['ephys_params']['vertical_site_spacing'], \
-                    w_inv, \
-                    args['mean_waveform_params'])
+        with profile_stage('waveform_metrics'):
+            metrics = metrics_from_file(mean_waveform_fullpath, snr_fullpath, \
+                        kilosort_data.spike_times, \
+                        kilosort_data.spike_clusters, \
+                        kilosort_data.peak_channels, \
+                        kilosort_data.channel_map, \
+                        args['ephys_params']['bit_volts'], \
+                        args['ephys_params']['sample_rate'], \
+                        args['ephys_params']['vertical_site_spacing'], \
+                        args['mean_waveform_params'])
                 
-        metrics.to_csv(args['waveform_metrics']['waveform_metrics_file'])      
+        write_metrics_table(metrics, args['waveform_metrics']['waveform_metrics_file'], args['mean_waveform_params']['columnar_format'])
+
+        if 'snippet_store_dir' in output:
+
+            # C_Waves reads the raw data itself, so the store needs a pass of its own
+            rawData = np.memmap(args['ephys_params']['ap_band_file'], dtype='int16', mode='r')
+            data = np.reshape(rawData, (int(rawData.size/args['ephys_params']['num_channels']), args['ephys_params']['num_channels']))
+
+            with profile_stage('snippet_store'):
+                write_snippet_store(data, kilosort_data.spike_times, \
+                            kilosort_data.spike_clusters, \
+                            kilosort_data.peak_channels, \
+                            kilosort_data.channel_map, \
+                            args['ephys_params']['bit_volts'], \
+                            args['ephys_params']['sample_rate'], \
+                            args['mean_waveform_params'], \
+                            output['snippet_store_dir'])
         
+    elif args['mean_waveform_params']['use_parallel_waveforms']:
+
+        print('Calculating mean waveforms using ' + str(args['mean_waveform_params']['num_workers']) + ' python processes.')
+        dest, wavefile = os.path.split(args['mean_waveform_params']['mean_waveforms_file'])
+
+        kilosort_data = KilosortDataset(args['directories']['kilosort_output_directory'], \
+                    args['ephys_params']['sample_rate'], \
+                    convert_to_seconds = False)
+
+        num_samples = int(os.path.getsize(args['ephys_params']['ap_band_file']) / 2 / args['ephys_params']['num_channels'])
+        snippet_store = create_snippet_store(args, output, kilosort_data, num_samples)
+
+        # writes the same files as C_Waves
+        with profile_stage('waveforms'):
+            calculate_mean_waveforms_parallel(args['ephys_params']['ap_band_file'], \
+                        args['ephys_params']['num_channels'], \
+                        kilosort_data.spike_times, \
+                        kilosort_data.spike_clusters, \
+                        kilosort_data.peak_channels, \
+                        kilosort_data.channel_map, \
+                        args['ephys_params']['bit_volts'], \
+                        args['ephys_params']['sample_rate'], \
+                        args['mean_waveform_params'], \
+                        dest, \
+                        snippet_store = snippet_store)
+
+        if snippet_store is not None:
+            snippet_store.finish()
+
+        with profile_stage('waveform_metrics'):
+            metrics = metrics_from_file(os.path.join(dest, 'mean_waveforms.npy'), \
+                        os.path.join(dest, 'cluster_snr.npy'), \
+                        kilosort_data.spike_times, \
+                        kilosort_data.spike_clusters, \
+                        kilosort_data.peak_channels, \
+                        kilosort_data.channel_map, \
+                        args['ephys_params']['bit_volts'], \
+                        args['ephys_params']['sample_rate'], \
+                        args['ephys_params']['vertical_site_spacing'], \
+                        args['mean_waveform_params'])
+
+        write_metrics_table(metrics, args['waveform_metrics']['waveform_metrics_file'], args['mean_waveform_params']['columnar_format'])
+
     else:
         
         print('Calculating mean waveforms using python.')
@@ -85,43 +150,69 @@ def calculate_mean_waveforms(args):
         rawData = np.memmap(args['ephys_params']['ap_band_file'], dtype='int16', mode='r')
         data = np.reshape(rawData, (int(rawData.size/args['ephys_params']['num_channels']), args['ephys_params']['num_channels']))
     
-        spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, \
-        channel_pos, clusterIDs, cluster_quality, cluster_amplitude = \
-                load_kilosort_data(args['directories']['kilosort_output_directory'], \
+        kilosort_data = KilosortDataset(args['directories']['kilosort_output_directory'], \
                     args['ephys_params']['sample_rate'], \
                     convert_to_seconds = False)
     
+        snippet_store = create_snippet_store(args, output, kilosort_data, data.shape[0])
+
         print("Calculating mean waveforms...")
     
-        waveforms, spike_counts, coords, labels, metrics = extract_waveforms(data, spike_times, \
-                    spike_clusters,
-                    templates,
-                    channel_map,
-                    args['ephys_params']['bit_volts'], \
-                    args['ephys_params']['sample_rate'], \
-                    args['ephys_params']['vertical_site_spacing'], \
-                    args['mean_waveform_params'])
+        with profile_stage('waveforms'):
+            waveforms, spike_counts, coords, labels, metrics = extract_waveforms(data, kilosort_data.spike_times, \
+                        kilosort_data.spike_clusters,
+                        kilosort_data.templates,
+                        kilosort_data.channel_map,
+                        args['ephys_params']['bit_volts'], \
+                        args['ephys_params']['sample_rate'], \
+                        args['ephys_params']['vertical_site_spacing'], \
+                        args['mean_waveform_params'], \
+                        snippet_store = snippet_store)
+
+        if snippet_store is not None:
+            snippet_store.finish()
     
-        writeDataAsNpy(waveforms, args['mean_waveform_params']['mean_waveforms_file'])
-        metrics.to_csv(args['waveform_metrics']['waveform_metrics_file'])
+        with profile_stage('saving'):
+            writeDataAsNpy(waveforms, args['mean_waveform_params']['mean_waveforms_file'])
+            write_metrics_table(metrics, args['waveform_metrics']['waveform_metrics_file'], args['mean_waveform_params']['columnar_format'])
 
 
     # if the cluster metrics have already been run, merge the waveform metrics into that file
     if os.path.exists(args['cluster_metrics']['cluster_metrics_file']):
-        qmetrics = pd.read_csv(args['cluster_metrics']['cluster_metrics_file'])
-        qmetrics = qmetrics.drop(qmetrics.columns[0], axis='columns')
-        qmetrics = qmetrics.merge(pd.read_csv(args['waveform_metrics']['waveform_metrics_file'], index_col=0),
+        qmetrics = read_metrics_table(args['cluster_metrics']['cluster_metrics_file'])
+        qmetrics = qmetrics.merge(read_metrics_table(args['waveform_metrics']['waveform_metrics_file']),
                      on='cluster_id',
                      suffixes=('_quality_metrics','_waveform_metrics'))  
         print("Saving merged quality metrics ...")
-        qmetrics.to_csv(args['cluster_metrics']['cluster_metrics_file'])
+        write_metrics_table(qmetrics, args['cluster_metrics']['cluster_metrics_file'], args['mean_waveform_params']['columnar_format'])
         
     execution_time = time.time() - start
 
     print('total time: ' + str(np.around(execution_time,2)) + ' seconds')
     print()
     
-    return {"execution_time" : execution_time} # output manifest
+    output["execution_time"] = execution_time
+
+    return output # output manifest
+
+
+def create_snippet_store(args, output, kilosort_data, num_samples):
+
+    """ Snippet store to fill during the pass through the raw data (None if write_snippet_store is False) """
+
+    if 'snippet_store_dir' not in output:
+        return None
+
+    return SnippetStoreWriter(output['snippet_store_dir'], \
+                kilosort_data.spike_times, \
+                kilosort_data.spike_clusters, \
+                kilosort_data.peak_channels, \
+                kilosort_data.channel_map, \
+                num_samples, \
+                args['ephys_params']['num_channels'], \
+                args['ephys_params']['bit_volts'], \
+                args['ephys_params']['sample_rate'], \
+                args['mean_waveform_params'])
 
 
 def main():
@@ -1,6 +1,7 @@
 from argschema import ArgSchema, ArgSchemaParser 
 from argschema.schemas import DefaultSchema
 from argschema.fields import Nested, InputDir, String, Float, Dict, Int, Bool
+from marshmallow.validate import OneOf
 from ...common.schemas import EphysParams, Directories, WaveformMetricsFile, ClusterMetricsFile
 
 class MeanWaveformParams(DefaultSchema):
@@ -14,7 +15,14 @@ class MeanWaveformParams(DefaultSchema):
     cWaves_path = InputDir(require=False, help='directory containing the TPrime executable.')
     use_C_Waves = Bool(require=False, default=False, help='Use faster C routine to calculate mean waveforms')
     snr_radius = Int(require=False, default=8, help='disk radius (chans) about pk-chan for snr calculation in C_waves')
+    use_parallel_waveforms = Bool(require=False, default=False, help='Calculate mean waveforms and SNR like C_Waves, with Python processes that each read part of the binary file (runs on any platform)')
+    num_workers = Int(require=False, default=1, help='Number of processes for use_parallel_waveforms')
+    write_snippet_store = Bool(require=False, default=False, help='Also save int16 snippets of each unit on its local channels, so they can be read later without the raw data file (saved in the same pass as the waveforms, except with use_C_Waves)')
+    snippet_store_dir = String(required=False, help='Directory for the snippet store (default: snippet_store in the Kilosort output directory)')
+    snippets_per_unit = Int(require=False, default=200, help='Max number of snippets saved for each unit')
+    snippet_channels = Int(require=False, default=32, help='Number of channels around the peak channel saved for each unit')
     mean_waveforms_file = String(required=True, help='Path to mean waveforms file (.npy)')
+    columnar_format = String(required=False, default='none', validate=OneOf(['none', 'parquet', 'feather']), help='Also write metrics tables in this format, next to each CSV (requires pyarrow)')
 
 
 class InputParameters(ArgSchema):
@@ -24,6 +32,7 @@ class InputParameters(ArgSchema):
     cluster_metrics = Nested(ClusterMetricsFile)
     ephys_params = Nested(EphysParams)
     directories = Nested(Directories)
+    profile = Bool(required=False, default=False, help='Record run time, CPU time, peak memory and disk I/O of each stage in the output manifest')
 
 class OutputSchema(DefaultSchema): 
     input_parameters = Nested(InputParameters, 
@@ -35,4 +44,6 @@ class OutputParameters(OutputSchema):
 
     execution_time = Float()
     mean_waveforms_file = String()
+    snippet_store_dir = String(required=False, help='Directory of the snippet store (if write_snippet_store is True)')
+    profile = Dict(required=False, help='Run time, CPU time, peak memory and disk I/O of the whole run and of each stage (if profile is True)')
     
\ No newline at end of file
@@ -7,7 +7,7 @@ import pandas as pd
 
 import warnings
 
-from .waveform_metrics import calculate_waveform_metrics
+from .waveform_metrics import calculate_waveform_metrics_batch, calculate_snr_from_moments
 from ...common.epoch import Epoch
 from ...common.utils import printProgressBar
 
@@ -20,7 +20,8 @@ def extract_waveforms(raw_data,
                       sample_rate, 
                       site_spacing, 
                       params, 
-                      epochs=None):
+                      epochs=None,
+                      snippet_store=None):
     
     """
     Calculate mean waveforms for sorted units.
@@ -34,6 +35,8 @@ def extract_waveforms(raw_data,
     cluster_quality : 'noise' or 'good'
     sample_rate : Hz
     site_spacing : m
+    snippet_store : SnippetStoreWriter (optional)
+        Store to fill with the snippets of its spikes, read in the same pass
 
     Outputs:
     -------
@@ -86,70 +89,76 @@ def extract_waveforms(raw_data,
 
     peak_channels = np.squeeze(channel_map[np.argmax(np.max(templates,1) - np.min(templates,1),1)])
 
-    for epoch_idx, epoch in enumerate(epochs):
+    selected, group_offsets = select_spikes_for_waveforms(spike_times, spike_clusters, total_units, epochs, sample_rate, spikes_per_epoch)
 
-        print("Epoch: " + epoch.name)
+    # read all snippets in one pass through the file, in time order
+    read_spikes, selected_position, store_rows = spikes_to_read(spike_times, selected,
+                                                                None if snippet_store is None else snippet_store.spikes)
+
+    print("Reading " + str(read_spikes.size) + " spikes...")
 
-        in_epoch = ((spike_times / sample_rate) > epoch.start_time) * ((spike_times / sample_rate) < epoch.end_time)
+    # group of each spike that is read (-1 for spikes that are only in the snippet store)
+    spike_groups = np.append(np.repeat(np.arange(total_epochs * total_units), np.diff(group_offsets)), -1)[selected_position]
 
-        spike_times_in_epoch = spike_times[in_epoch]
+    accumulator = WaveformAccumulator(total_epochs * total_units, raw_data.shape[1], samples_per_spike)
 
-        for cluster_idx, cluster_id in enumerate(cluster_ids):
+    for positions, snippets in gather_waveforms(raw_data, spike_times[read_spikes], pre_samples, samples_per_spike):
 
-            printProgressBar(cluster_idx+1, total_units)
+        in_waveforms = spike_groups[positions] >= 0
+        accumulator.add(np.transpose(snippets[in_waveforms], (0, 2, 1)), spike_groups[positions][in_waveforms])
 
-            in_cluster = (spike_clusters[in_epoch] == cluster_id)
+        if snippet_store is not None:
+            in_store = store_rows[positions] >= 0
+            snippet_store.add(store_rows[positions][in_store], snippets[in_store])
 
-            if np.sum(in_cluster) > 0:
+        printProgressBar(positions[-1] + 1, read_spikes.size)
 
-                times_for_cluster = spike_times_in_epoch[in_cluster]
+    # units x epochs
+    total_waveforms = np.reshape(np.diff(group_offsets), (total_epochs, total_units)).T
+    num_spikes = np.reshape(accumulator.count, (total_epochs, total_units)).T
 
-                waveforms = np.empty(
-                    (spikes_per_epoch, raw_data.shape[1], samples_per_spike))
-                waveforms[:] = np.nan
+    # spikes at the start or end of the dataset are not included
+    means = np.transpose(np.reshape(accumulator.mean, (total_epochs, total_units) + accumulator.mean.shape[1:]), (1, 0, 2, 3)) * bit_volts
+    sums_of_squares = np.transpose(np.reshape(accumulator.sum_of_squares, (total_epochs, total_units) + accumulator.mean.shape[1:]), (1, 0, 2, 3)) * bit_volts ** 2
 
-                np.random.shuffle(times_for_cluster)
+    with warnings.catch_warnings():
 
-                total_waveforms = np.min(
-                    [times_for_cluster.size, spikes_per_epoch])
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        mean_waveforms[:, :, 0, :, :] = means
+        mean_waveforms[:, :, 1, :, :] = np.sqrt(sums_of_squares / num_spikes[:, :, np.newaxis, np.newaxis])
 
-                for wv_idx, peak_time in enumerate(times_for_cluster[:total_waveforms]):
-                    start = int(peak_time-pre_samples)
-                    end = start + samples_per_spike
-                    rawWaveform = raw_data[start:end, :].T
+    # units without any spikes stay at zero; units whose spikes could not be read are NaN
+    mean_waveforms[(total_waveforms > 0) * (num_spikes == 0)] = np.nan
+    mean_waveforms[total_waveforms == 0] = 0
 
-                    # in case spike was at start or end of dataset
-                    if rawWaveform.shape[1] == samples_per_spike:
-                        waveforms[wv_idx, :, :] = rawWaveform * bit_volts
+    for epoch_idx, epoch in enumerate(epochs):
+
+        print("Epoch: " + epoch.name)
 
-                # concatenate to existing dataframe
-                metrics = pd.concat([metrics, calculate_waveform_metrics(waveforms[:total_waveforms, :, :],
-                                                                         cluster_id, 
-                                                                         peak_channels[cluster_idx], 
-                                                                         channel_map,
-                                                                         sample_rate, 
-                                                                         upsampling_factor,
-                                                                         spread_threshold,
-                                                                         site_range,
-                                                                         site_spacing,
-                                                                         epoch.name
-                                                                         )])
+        units = np.flatnonzero(num_spikes[:, epoch_idx] > 0)
+        unit_peak_channels = peak_channels[units]
 
-                with warnings.catch_warnings():
+        snr = calculate_snr_from_moments(means[units, epoch_idx, unit_peak_channels, :],
+                                         sums_of_squares[units, epoch_idx, unit_peak_channels, :],
+                                         num_spikes[units, epoch_idx])
 
-                    warnings.simplefilter("ignore", category=RuntimeWarning)
-                    mean_waveforms[cluster_idx, epoch_idx,
-                                   0, :, :] = np.nanmean(waveforms, 0)
-                    mean_waveforms[cluster_idx, epoch_idx,
-                                   1, :, :] = np.nanstd(waveforms, 0)
+        metrics = pd.concat([metrics, calculate_waveform_metrics_batch(means[units, epoch_idx],
+                                                                       snr,
+                                                                       cluster_ids[units],
+                                                                       unit_peak_channels,
+                                                                       channel_map,
+                                                                       sample_rate,
+                                                                       upsampling_factor,
+                                                                       spread_threshold,
+                                                                       site_range,
+                                                                       site_spacing,
+                                                                       epoch.name
+                                                                       )])
 
-                    # remove offset
-                    for channel in range(0, mean_waveforms.shape[3]):
-                        mean_waveforms[cluster_idx, epoch_idx, 0, channel, :] = \
-                            mean_waveforms[cluster_idx, epoch_idx, 0, channel, :] - \
-                            mean_waveforms[cluster_idx, epoch_idx, 0, channel, 0]
+    # remove offset
+    mean_waveforms[:, :, 0, :, :] -= mean_waveforms[:, :, 0, :, :1]
 
-                spike_count[cluster_idx, epoch_idx] = total_waveforms
+    spike_count[:, :total_epochs] = total_waveforms
 
     dimCoords, dimLabels = generateDimLabels(
         cluster_ids, total_epochs, pre_samples, samples_per_spike, raw_data.shape[1], sample_rate)
@@ -157,6 +166,220 @@ def extract_waveforms(raw_data,
     return mean_waveforms, spike_count, dimCoords, dimLabels, metrics
 
 
+def select_spikes_for_waveforms(spike_times, spike_clusters, total_units, epochs, sample_rate, spikes_per_epoch):
+
+    """
+    Random sample of up to spikes_per_epoch spikes for each unit in each epoch
+
+    Inputs:
+    -------
+    spike_times : numpy.ndarray (num_spikes x 0)
+        Spike times in samples
+    spike_clusters : numpy.ndarray (num_spikes x 0)
+        Cluster IDs for each spike time
+    total_units : Int
+        Number of units (cluster IDs are 0 to total_units - 1)
+    epochs : list of Epoch objects
+        Start and end times (in seconds) of each epoch
+    sample_rate : Float
+        Sample rate in Hz
+    spikes_per_epoch : Int
+        Maximum number of spikes per unit per epoch
+
+    Outputs:
+    --------
+    selected : numpy.ndarray
+        Indices of the selected spikes, grouped by epoch and then by unit
+    group_offsets : numpy.ndarray (total_epochs * total_units + 1)
+        selected[group_offsets[g]:group_offsets[g + 1]] are the spikes of
+        unit g % total_units in epoch g // total_units
+
+    """
+
+    selected = []
+    counts = []
+
+    for epoch in epochs:
+
+        in_epoch = np.flatnonzero(((spike_times / sample_rate) > epoch.start_time) * ((spike_times / sample_rate) < epoch.end_time))
+        clusters = spike_clusters[in_epoch]
+
+        # spikes of each unit in random order
+        order = np.lexsort((np.random.random_sample(in_epoch.size), clusters))
+
+        cluster_counts = np.bincount(clusters, minlength=total_units)
+        rank = np.arange(order.size) - np.repeat(np.cumsum(cluster_counts) - cluster_counts, cluster_counts)
+
+        selected.append(in_epoch[order[rank < spikes_per_epoch]])
+        counts.append(np.minimum(cluster_counts, spikes_per_epoch))
+
+    selected = np.concatenate(selected)
+    group_offsets = np.concatenate(([0], np.cumsum(np.concatenate(counts))))
+
+    return selected, group_offsets
+
+
+def spikes_to_read(spike_times, selected, other_selected = None):
+
+    """
+    Combines two selections of spikes (e.g. for the mean waveforms and for the snippet store),
+    so the spikes of both can be read in the same pass through the raw data
+
+    Inputs:
+    -------
+    spike_times : numpy.ndarray (num_spikes x 0)
+        Spike times in samples
+    selected : numpy.ndarray
+        Indices of the spikes in the first selection
+    other_selected : numpy.ndarray (optional)
+        Indices of the spikes in the second selection
+
+    Outputs:
+    --------
+    read_spikes : numpy.ndarray
+        Indices of the spikes in either selection, in time order
+    position : numpy.ndarray (read_spikes.size x 0)
+        Position of each spike in selected (-1 if it is not selected)
+    other_position : numpy.ndarray (read_spikes.size x 0)
+        Position of each spike in other_selected (-1 if it is not selected)
+
+    """
+
+    if other_selected is None:
+        other_selected = selected[:0]
+
+    read_spikes = np.union1d(selected, other_selected).astype('int64')
+    read_spikes = read_spikes[np.argsort(spike_times[read_spikes], kind='stable')]
+
+    def positions_in(selection):
+
+        positions = np.full(read_spikes.shape, -1, dtype='int64')
+
+        if selection.size > 0:
+            order = np.argsort(selection, kind='stable')
+            index = np.minimum(np.searchsorted(selection[order], read_spikes), selection.size - 1)
+            found = selection[order][index] == read_spikes
+            positions[found] = order[index[found]]
+
+        return positions
+
+    return read_spikes, positions_in(selected), positions_in(other_selected)
+
+
+def gather_waveforms(raw_data, spike_times, pre_samples, samples_per_spike, samples_per_chunk = 300000, spikes_per_chunk = 256):
+
+    """
+    Reads spike snippets in one sequential pass through the raw data
+
+    Runs of nearby spikes are read as one block of up to samples_per_chunk samples,
+    so the file is read in order and the gaps between spikes are skipped
+
+    Inputs:
+    -------
+    raw_data : numpy.ndarray or numpy.memmap (num_samples x num_channels)
+        Continuous data
+    spike_times : numpy.ndarray
+        Spike times in samples (sorted)
+    pre_samples : Int
+        Number of samples before each spike time
+    samples_per_spike : Int
+        Number of samples in each snippet
+    samples_per_chunk : Int
+        Maximum number of samples to read at once
+    spikes_per_chunk : Int
+        Maximum number of snippets to return at once
+
+    Outputs:
+    --------
+    Yields (positions, snippets) for each block:
+    positions : numpy.ndarray
+        Indices into spike_times (snippets that would extend past the start or end
+        of the data are skipped)
+    snippets : numpy.ndarray (len(positions) x samples_per_spike x num_channels)
+        Raw data around each spike, in the dtype of raw_data
+
+    """
+
+    starts = spike_times.astype('int64') - pre_samples
+
+    positions = np.flatnonzero((starts >= 0) * (starts + samples_per_spike <= raw_data.shape[0]))
+    starts = starts[positions]
+
+    offsets = np.arange(samples_per_spike)
+
+    first = 0
+
+    while first < positions.size:
+
+        block_start = starts[first]
+        last = np.searchsorted(starts, block_start + samples_per_chunk - samples_per_spike, side='right')
+        last = np.min([np.max([last, first + 1]), first + spikes_per_chunk])
+
+        block = np.asarray(raw_data[block_start:starts[last - 1] + samples_per_spike, :])
+
+        yield positions[first:last], block[(starts[first:last] - block_start)[:, np.newaxis] + offsets]
+
+        first = last
+
+
+class WaveformAccumulator():
+
+    """
+    Running mean and sum of squared deviations of the spike snippets in each group
+    (e.g. each unit in each epoch), updated as snippets are read
+
+    Batches are combined with the parallel form of Welford's algorithm (Chan et al., 1979),
+    so memory use does not depend on the number of snippets
+
+    """
+
+    def __init__(self, num_groups, num_channels, num_samples):
+
+        self.count = np.zeros((num_groups,), dtype='int64')
+        self.mean = np.zeros((num_groups, num_channels, num_samples))
+        self.sum_of_squares = np.zeros((num_groups, num_channels, num_samples))
+
+    def add(self, snippets, groups):
+
+        """
+        snippets : numpy.ndarray (num_spikes x num_channels x num_samples)
+            Spike snippets (any numeric dtype)
+        groups : numpy.ndarray (num_spikes x 0)
+            Group of each snippet
+        """
+
+        if groups.size == 0:
+            return
+
+        order = np.argsort(groups, kind='stable')
+        groups = groups[order]
+
+        starts = np.flatnonzero(np.concatenate(([True], groups[1:] != groups[:-1])))
+        counts = np.diff(np.append(starts, groups.size))
+
+        snippets = snippets[order].astype('float64')
+
+        batch_mean = np.add.reduceat(snippets, starts, axis=0) / counts[:, np.newaxis, np.newaxis]
+        snippets -= np.repeat(batch_mean, counts, axis=0)
+        batch_sum_of_squares = np.add.reduceat(snippets ** 2, starts, axis=0)
+
+        self.merge(groups[starts], counts, batch_mean, batch_sum_of_squares)
+
+    def merge(self, groups, counts, mean, sum_of_squares):
+
+        """ Combines the moments of other snippets (for unique groups) with the stored moments """
+
+        previous_counts = self.count[groups]
+        total_counts = previous_counts + counts
+
+        delta = mean - self.mean[groups]
+        weight = (counts / total_counts)[:, np.newaxis, np.newaxis]
+
+        self.mean[groups] += delta * weight
+        self.sum_of_squares[groups] += sum_of_squares + delta ** 2 * weight * previous_counts[:, np.newaxis, np.newaxis]
+        self.count[groups] = total_counts
+
+
 def generateDimLabels(good_clusters, num_epochs, pre_samples, total_samples, num_channels, sample_rate):
     """ Generate dimension labels and coordinates for the xarray """
 
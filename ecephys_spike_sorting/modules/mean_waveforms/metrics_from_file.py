@@ -3,24 +3,21 @@ import os
 import glob
 
 import xarray as xr
-import pandas as pd
 
 import warnings
 
-from .waveform_metrics import calculate_waveform_metrics_from_avg
+from .waveform_metrics import calculate_waveform_metrics_batch
 from ...common.epoch import Epoch
-from ...common.utils import printProgressBar
 
 def metrics_from_file(mean_waveform_fullpath,
                       snr_fullpath,
                       spike_times, 
                       spike_clusters, 
-                      templates, 
+                      peak_channels, 
                       channel_map, 
                       bit_volts, 
                       sample_rate, 
                       site_spacing, 
-                      w_inv,
                       params):
                      
     
@@ -34,6 +31,7 @@ def metrics_from_file(mean_waveform_fullpath,
     snr_fullpath: path to snr npy file
     spike_times : spike times (in samples)
     spike_clusters : cluster IDs for each spike time []
+    peak_channels : peak channel of each unwhitened template (from get_unwhitened_templates)
     clusterIDs : all unique cluster ids
     cluster_quality : 'noise' or 'good'
     sample_rate : Hz
@@ -74,8 +72,6 @@ def metrics_from_file(mean_waveform_fullpath,
 
     # #############################################
 
-    metrics = pd.DataFrame()
-
     cluster_ids = np.arange(np.max(spike_clusters) + 1)
     total_units = len(cluster_ids)
     
@@ -83,41 +79,24 @@ def metrics_from_file(mean_waveform_fullpath,
     snr_array = np.load(snr_fullpath)
 
     channel_map = np.squeeze(channel_map)
-    
-    nTemplate = templates.shape[0]
-    
-    # initialize peak_channels array
-    peak_channels = np.zeros([nTemplate,],'uint32')
-    # for each template (nt x nchan), multiply the the transpose (nchan x nt) by inverse of 
-    # the whitening matrix (nchan x nchan); get max and min along tthe time axis (1)
-    # to find the peak channel
-    for i in np.arange(0,nTemplate):
-        currT = templates[i,:].T
-        curr_unwh = np.matmul(w_inv, currT)
-        currdiff = np.max(curr_unwh,1) - np.min(curr_unwh,1)
-        peak_channels[i] = channel_map[np.argmax(currdiff)]
-    
-    for cluster_idx, cluster_id in enumerate(cluster_ids):
-
-        printProgressBar(cluster_idx+1, total_units)
-
-        snr = snr_array[cluster_idx,0]
-        nSpike = snr_array[cluster_idx,1]
-        # if at least one spike, calculate metrics and concatenate to existing dataframe
-        if nSpike > 0:
-            metrics = pd.concat([metrics, calculate_waveform_metrics_from_avg(mean_waveforms[cluster_idx,:],
-                                                                     snr,
-                                                                     cluster_id, 
-                                                                     peak_channels[cluster_idx], 
-                                                                     channel_map,
-                                                                     sample_rate, 
-                                                                     upsampling_factor,
-                                                                     spread_threshold,
-                                                                     site_range,
-                                                                     site_spacing,                                                                     
-                                                                     )])
-
 
+    # clusters created after sorting (e.g. by merging in phy) have no template peak channel
+    if peak_channels.size < total_units:
+        peak_channels = np.append(peak_channels, np.zeros((total_units - peak_channels.size,))).astype('int64')
+    
+    # if at least one spike, calculate metrics
+    has_spikes = np.flatnonzero(snr_array[:total_units, 1] > 0)
+
+    metrics = calculate_waveform_metrics_batch(mean_waveforms[has_spikes],
+                                               snr_array[has_spikes, 0],
+                                               cluster_ids[has_spikes],
+                                               peak_channels[has_spikes],
+                                               channel_map,
+                                               sample_rate,
+                                               upsampling_factor,
+                                               spread_threshold,
+                                               site_range,
+                                               site_spacing)
 
     return metrics
 
@@ -0,0 +1,271 @@
+import os
+import multiprocessing
+
+import numpy as np
+
+from .extract_waveforms import WaveformAccumulator, gather_waveforms, select_spikes_for_waveforms, spikes_to_read
+from ...common.epoch import Epoch
+from ...common.utils import printProgressBar
+
+
+def calculate_mean_waveforms_parallel(raw_data_file,
+                                      num_channels,
+                                      spike_times,
+                                      spike_clusters,
+                                      peak_channels,
+                                      channel_map,
+                                      bit_volts,
+                                      sample_rate,
+                                      params,
+                                      dest,
+                                      snippet_store = None,
+                                      worker_memory_mb = 64):
+
+    """
+    Python implementation of C_Waves: mean waveform and SNR of each cluster,
+    calculated by several processes that each read part of the binary file
+
+    The spikes are split into one contiguous time range per process, so each part of the
+    file is read once, in order, through that process's own memmap. Each process keeps the
+    running moments of at most worker_memory_mb of clusters; when it needs room for more, it
+    sends them to this process, which merges them into one set of moments as they arrive
+
+    Inputs:
+    -------
+    raw_data_file : String
+        Path to the int16 AP band binary file (samples x channels)
+    num_channels : Int
+        Number of channels in the binary file
+    spike_times : numpy.ndarray (num_spikes x 0)
+        Spike times in samples
+    spike_clusters : numpy.ndarray (num_spikes x 0)
+        Cluster IDs for each spike time
+    peak_channels : numpy.ndarray (num_clusters x 0)
+        Peak channel of each cluster (as in clus_Table.npy)
+    channel_map : numpy.ndarray (num_channels x 0)
+        Channels used for spike sorting
+    bit_volts : Float
+        Scalar to convert int16 values into microvolts
+    sample_rate : Float
+        Sample rate in Hz
+    params : dict
+        mean_waveform_params ('samples_per_spike', 'pre_samples', 'spikes_per_epoch',
+        'snr_radius' and 'num_workers' are used)
+    dest : String
+        Directory for the output files
+    snippet_store : SnippetStoreWriter (optional)
+        Store to fill with the snippets of its spikes; each process adds the
+        snippets of the spikes in its time range
+    worker_memory_mb : Float
+        Approximate size of the moments kept by each process before they are sent
+
+    Outputs:
+    --------
+    Writes the same files as C_Waves:
+    mean_waveforms.npy : numpy.ndarray (num_clusters x num_channels x samples_per_spike)
+        Mean waveform of each cluster in microvolts (float32)
+    cluster_snr.npy : numpy.ndarray (num_clusters x 2)
+        SNR and number of spikes averaged for each cluster
+
+    """
+
+    samples_per_spike = params['samples_per_spike']
+    num_workers = np.max([params['num_workers'], 1])
+
+    total_units = np.max([np.max(spike_clusters) + 1, peak_channels.size])
+
+    # clusters created after sorting (e.g. by merging in phy) have no template peak channel
+    peak_channels = np.append(peak_channels, np.zeros((total_units - peak_channels.size,))).astype('int64')
+
+    selected, unit_offsets = select_spikes_for_waveforms(spike_times,
+                                                         spike_clusters,
+                                                         total_units,
+                                                         [Epoch('complete_session', 0, np.inf)],
+                                                         sample_rate,
+                                                         params['spikes_per_epoch'])
+
+    if snippet_store is None:
+        read_spikes, waveform_position, store_rows = spikes_to_read(spike_times, selected)
+    else:
+        read_spikes, waveform_position, store_rows = spikes_to_read(spike_times, selected, snippet_store.spikes)
+
+    # moments of one cluster are 16 bytes per channel and sample; a block of snippets can add up to 256 clusters
+    units_per_message = int(np.max([256, worker_memory_mb * 1e6 / (16 * num_channels * samples_per_spike)]))
+
+    ranges = [r for r in np.array_split(np.arange(read_spikes.size), num_workers) if r.size > 0]
+
+    tasks = [(raw_data_file, num_channels, spike_times[read_spikes[r]], spike_clusters[read_spikes[r]], waveform_position[r] >= 0,
+              store_rows[r], total_units, units_per_message, params, snippet_store) for r in ranges]
+
+    accumulator = WaveformAccumulator(total_units, num_channels, samples_per_spike)
+
+    use_pool = num_workers > 1 and len(tasks) > 1
+
+    if use_pool:
+        # partial moments are merged as they arrive, so at most one message per process is waiting
+        moments_queue = multiprocessing.Queue(len(tasks))
+        pool = multiprocessing.Pool(np.min([num_workers, multiprocessing.cpu_count(), len(tasks)]),
+                                    initializer = init_waveforms_worker,
+                                    initargs = (moments_queue,))
+
+        try:
+            result = pool.map_async(accumulate_time_range_in_worker, tasks)
+
+            finished = 0
+
+            while finished < len(tasks):
+
+                moments = moments_queue.get()
+
+                if moments is None:
+                    finished += 1
+                    printProgressBar(finished, len(tasks))
+                else:
+                    accumulator.merge(*moments)
+
+            result.get() # raises any error from the workers
+
+        finally:
+            pool.close()
+            pool.join()
+
+    else:
+        for idx, task in enumerate(tasks):
+            accumulate_time_range(task, lambda moments: accumulator.merge(*moments))
+            printProgressBar(idx + 1, len(tasks))
+
+    mean_waveforms = accumulator.mean * bit_volts
+    mean_waveforms[accumulator.count == 0] = np.nan
+
+    cluster_snr = np.zeros((total_units, 2))
+    cluster_snr[:, 0] = calculate_disk_snr(mean_waveforms,
+                                           accumulator.sum_of_squares * bit_volts ** 2,
+                                           accumulator.count,
+                                           peak_channels,
+                                           np.squeeze(channel_map),
+                                           params['snr_radius'])
+    cluster_snr[:, 1] = accumulator.count
+
+    np.save(os.path.join(dest, 'mean_waveforms.npy'), mean_waveforms.astype('float32'))
+    np.save(os.path.join(dest, 'cluster_snr.npy'), cluster_snr)
+
+
+def accumulate_time_range(task, send):
+
+    """
+    Moments of the snippets in one time range (and their snippets for the store)
+
+    The moments are kept for at most units_per_message clusters at a time; send is called
+    with (clusters, counts, means, sums_of_squares) each time room is needed, and at the end
+
+    """
+
+    raw_data_file, num_channels, spike_times, spike_clusters, in_waveforms, store_rows, \
+        total_units, units_per_message, params, snippet_store = task
+
+    rawData = np.memmap(raw_data_file, dtype='int16', mode='r')
+    data = np.reshape(rawData, (int(rawData.size/num_channels), num_channels))
+
+    # position of each cluster in the accumulator (-1 if it is not there)
+    slots = np.full((total_units,), -1, dtype='int64')
+    clusters = np.zeros((units_per_message,), dtype='int64')
+    accumulator = WaveformAccumulator(units_per_message, num_channels, params['samples_per_spike'])
+    num_slots = 0
+
+    def send_moments():
+        if num_slots > 0:
+            send((clusters[:num_slots].copy(), accumulator.count[:num_slots].copy(),
+                  accumulator.mean[:num_slots].copy(), accumulator.sum_of_squares[:num_slots].copy()))
+        slots[clusters[:num_slots]] = -1
+        return WaveformAccumulator(units_per_message, num_channels, params['samples_per_spike']), 0
+
+    for positions, snippets in gather_waveforms(data, spike_times, params['pre_samples'], params['samples_per_spike']):
+
+        block = in_waveforms[positions]
+        block_clusters = spike_clusters[positions][block].astype('int64')
+
+        new_clusters = np.unique(block_clusters[slots[block_clusters] < 0])
+
+        if num_slots + new_clusters.size > units_per_message:
+            accumulator, num_slots = send_moments()
+            new_clusters = np.unique(block_clusters)
+
+        slots[new_clusters] = np.arange(num_slots, num_slots + new_clusters.size)
+        clusters[num_slots:num_slots + new_clusters.size] = new_clusters
+        num_slots += new_clusters.size
+
+        accumulator.add(np.transpose(snippets[block], (0, 2, 1)), slots[block_clusters])
+
+        if snippet_store is not None:
+            block = store_rows[positions] >= 0
+            snippet_store.add(store_rows[positions][block], snippets[block])
+
+    send_moments()
+
+    if snippet_store is not None:
+        snippet_store.flush()
+
+
+# queue for the moments sent by the current worker process (set by init_waveforms_worker)
+worker_moments_queue = None
+
+
+def init_waveforms_worker(moments_queue):
+
+    global worker_moments_queue
+    worker_moments_queue = moments_queue
+
+
+def accumulate_time_range_in_worker(task):
+
+    """ Runs in a worker process: accumulate_time_range, sending the moments to the main process """
+
+    try:
+        accumulate_time_range(task, worker_moments_queue.put)
+    finally:
+        worker_moments_queue.put(None) # this range is finished
+
+
+def calculate_disk_snr(mean_waveforms, sum_of_squares, counts, peak_channels, channel_map, snr_radius):
+
+    """
+    SNR of each cluster, as calculated by C_Waves
+
+    snr = (Vmax - Vmin) on the peak channel / (2 * sqrt(variance)), where the variance
+    of the residuals (raw data - mean) is pooled over the channels within snr_radius of
+    the peak channel, with one degree of freedom per channel and sample for the mean
+
+    Inputs:
+    -------
+    mean_waveforms : numpy.ndarray (num_clusters x num_channels x num_samples)
+    sum_of_squares : numpy.ndarray (num_clusters x num_channels x num_samples)
+        Sum of squared residuals
+    counts : numpy.ndarray (num_clusters x 0)
+        Number of spikes averaged for each cluster
+    peak_channels : numpy.ndarray (num_clusters x 0)
+    channel_map : numpy.ndarray (num_channels x 0)
+        Channels included in the disk
+    snr_radius : Int
+        Radius of the disk (in channels)
+
+    Outputs:
+    --------
+    snr : numpy.ndarray (num_clusters x 0)
+        NaN for clusters with fewer than 2 spikes
+
+    """
+
+    num_clusters, num_channels, num_samples = mean_waveforms.shape
+
+    snr = np.zeros((num_clusters,)) * np.nan
+
+    for cluster_idx in np.flatnonzero(counts > 1):
+
+        peak = peak_channels[cluster_idx]
+        disk = channel_map[np.abs(channel_map.astype('int64') - peak) <= snr_radius]
+
+        variance = np.sum(sum_of_squares[cluster_idx, disk, :]) / ((counts[cluster_idx] - 1) * disk.size * num_samples)
+
+        snr[cluster_idx] = np.ptp(mean_waveforms[cluster_idx, peak, :]) / (2 * np.sqrt(variance))
+
+    return snr
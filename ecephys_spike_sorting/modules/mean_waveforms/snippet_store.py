@@ -0,0 +1,220 @@
+import os
+import json
+
+import numpy as np
+
+from .extract_waveforms import gather_waveforms, select_spikes_for_waveforms, spikes_to_read
+from ...common.epoch import Epoch
+from ...common.snippet_store import STORE_VERSION
+from ...common.utils import printProgressBar
+
+
+class SnippetStoreWriter():
+
+    """
+    Creates a snippet store (read with common.snippet_store.SnippetStore) and fills it in
+    as snippets are read, so it can share the pass through the raw data with the mean waveforms
+
+    The spikes and channels of each unit are chosen when the writer is created; the readers
+    add the snippets of these spikes (in any order, and from any process) and the parent
+    process calls finish() once all of them have been added
+
+    Files in store_dir:
+    -------------------
+    snippets.npy : numpy.ndarray (num_snippets x snippet_channels x samples_per_spike)
+        Raw int16 snippets, grouped by cluster
+    spike_times.npy : numpy.ndarray (num_snippets x 0)
+        Spike time (in samples) of each snippet
+    unit_offsets.npy : numpy.ndarray (num_clusters + 1 x 0)
+        Snippets of cluster i are snippets[unit_offsets[i]:unit_offsets[i + 1]]
+    local_channels.npy : numpy.ndarray (num_clusters x snippet_channels)
+        Channels included for each cluster
+    store.json
+        Snippet length, sample rate and bit_volts (written last, by finish())
+
+    """
+
+    def __init__(self,
+                 store_dir,
+                 spike_times,
+                 spike_clusters,
+                 peak_channels,
+                 channel_map,
+                 num_samples,
+                 num_channels,
+                 bit_volts,
+                 sample_rate,
+                 params):
+
+        """
+        store_dir : String
+            Directory for the store (created if it does not exist)
+        spike_times : numpy.ndarray (num_spikes x 0)
+            Spike times in samples
+        spike_clusters : numpy.ndarray (num_spikes x 0)
+            Cluster IDs for each spike time
+        peak_channels : numpy.ndarray (num_clusters x 0)
+            Peak channel of each cluster
+        channel_map : numpy.ndarray (num_channels x 0)
+            Channels used for spike sorting
+        num_samples : Int
+            Number of samples in the raw data
+        num_channels : Int
+            Number of channels in the raw data
+        bit_volts : Float
+            Scalar to convert int16 values into microvolts
+        sample_rate : Float
+            Sample rate in Hz
+        params : dict
+            mean_waveform_params ('samples_per_spike', 'pre_samples', 'snippets_per_unit'
+            and 'snippet_channels' are used)
+        """
+
+        self.store_dir = store_dir
+        self.info = {'version' : STORE_VERSION,
+                     'samples_per_spike' : int(params['samples_per_spike']),
+                     'pre_samples' : int(params['pre_samples']),
+                     'sample_rate' : float(sample_rate),
+                     'bit_volts' : float(bit_volts),
+                     'num_channels' : int(num_channels)}
+
+        channel_map = np.sort(np.squeeze(channel_map).astype('int64'))
+        num_local_channels = np.min([params['snippet_channels'], channel_map.size])
+
+        total_units = np.max([np.max(spike_clusters) + 1, peak_channels.size])
+
+        # clusters created after sorting (e.g. by merging in phy) have no template peak channel
+        peak_channels = np.append(peak_channels, np.zeros((total_units - peak_channels.size,))).astype('int64')
+
+        self.local_channels = np.zeros((total_units, num_local_channels), dtype='int64')
+
+        for cluster_idx, peak in enumerate(peak_channels):
+            nearest = np.argsort(np.abs(channel_map - peak), kind='stable')[:num_local_channels]
+            self.local_channels[cluster_idx, :] = np.sort(channel_map[nearest])
+
+        # only spikes with a complete snippet, so every slot in the store is filled
+        starts = spike_times.astype('int64') - params['pre_samples']
+        complete = np.flatnonzero((starts >= 0) * (starts + params['samples_per_spike'] <= num_samples))
+
+        selected, self.unit_offsets = select_spikes_for_waveforms(spike_times[complete],
+                                                                  spike_clusters[complete],
+                                                                  total_units,
+                                                                  [Epoch('complete_session', 0, np.inf)],
+                                                                  sample_rate,
+                                                                  params['snippets_per_unit'])
+        selected = complete[selected]
+
+        # snippets of each unit in time order
+        self.spikes = selected[np.lexsort((spike_times[selected], spike_clusters[selected]))]
+        self.clusters = np.asarray(spike_clusters[self.spikes]).astype('int64')
+
+        os.makedirs(store_dir, exist_ok=True)
+
+        if os.path.exists(os.path.join(store_dir, 'store.json')):
+            os.remove(os.path.join(store_dir, 'store.json'))
+
+        snippets = np.lib.format.open_memmap(os.path.join(store_dir, 'snippets.npy'),
+                                             mode='w+',
+                                             dtype='int16',
+                                             shape=(self.spikes.size, num_local_channels, params['samples_per_spike']))
+        del snippets
+
+        np.save(os.path.join(store_dir, 'spike_times.npy'), spike_times[self.spikes].astype('int64'))
+        np.save(os.path.join(store_dir, 'unit_offsets.npy'), self.unit_offsets.astype('int64'))
+        np.save(os.path.join(store_dir, 'local_channels.npy'), self.local_channels)
+
+        self._snippets = None
+
+    def __getstate__(self):
+
+        state = self.__dict__.copy()
+        state['_snippets'] = None
+
+        return state
+
+    def add(self, rows, snippets):
+
+        """
+        rows : numpy.ndarray (num_spikes x 0)
+            Positions in the store (indices into self.spikes)
+        snippets : numpy.ndarray (num_spikes x samples_per_spike x num_channels)
+            Raw data around each spike, as returned by gather_waveforms
+        """
+
+        if rows.size == 0:
+            return
+
+        if self._snippets is None:
+            self._snippets = np.load(os.path.join(self.store_dir, 'snippets.npy'), mmap_mode='r+')
+
+        channels = self.local_channels[self.clusters[rows]][:, np.newaxis, :]
+
+        self._snippets[rows] = np.transpose(np.take_along_axis(snippets, channels, axis=2), (0, 2, 1))
+
+    def flush(self):
+
+        """ Writes the snippets added by this process to disk """
+
+        if self._snippets is not None:
+            self._snippets.flush()
+            self._snippets = None
+
+    def finish(self):
+
+        """ Marks the store as complete, once all snippets have been added """
+
+        self.flush()
+
+        with open(os.path.join(self.store_dir, 'store.json'), 'w') as f:
+            json.dump(self.info, f, indent=2)
+
+
+def write_snippet_store(raw_data,
+                        spike_times,
+                        spike_clusters,
+                        peak_channels,
+                        channel_map,
+                        bit_volts,
+                        sample_rate,
+                        params,
+                        store_dir):
+
+    """
+    Saves a snippet store with its own pass through the raw data
+
+    Used when the mean waveforms are calculated by C_Waves, which reads the raw data
+    itself; the Python implementations fill the store during their own pass (see SnippetStoreWriter)
+
+    Inputs:
+    -------
+    raw_data : numpy.ndarray or numpy.memmap (num_samples x num_channels)
+        Continuous data
+    spike_times : numpy.ndarray (num_spikes x 0)
+        Spike times in samples
+    spike_clusters : numpy.ndarray (num_spikes x 0)
+        Cluster IDs for each spike time
+    peak_channels : numpy.ndarray (num_clusters x 0)
+        Peak channel of each cluster
+    channel_map : numpy.ndarray (num_channels x 0)
+        Channels used for spike sorting
+    bit_volts : Float
+        Scalar to convert int16 values into microvolts
+    sample_rate : Float
+        Sample rate in Hz
+    params : dict
+        mean_waveform_params (see SnippetStoreWriter)
+    store_dir : String
+        Directory for the store
+
+    """
+
+    writer = SnippetStoreWriter(store_dir, spike_times, spike_clusters, peak_channels, channel_map,
+                                raw_data.shape[0], raw_data.shape[1], bit_volts, sample_rate, params)
+
+    read_spikes, store_rows, _ = spikes_to_read(spike_times, writer.spikes)
+
+    for positions, snippets in gather_waveforms(raw_data, spike_times[read_spikes], params['pre_samples'], params['samples_per_spike']):
+        writer.add(store_rows[positions], snippets)
+        printProgressBar(positions[-1] + 1, read_spikes.size)
+
+    writer.finish()
@@ -1,5 +1,6 @@
 import numpy as np
 import random
+import warnings
 import pandas as pd
 
 from scipy.stats import linregress
@@ -96,7 +97,8 @@ def calculate_waveform_metrics_from_avg(avg_waveform,
                                         upsampling_factor, 
                                         spread_threshold,
                                         site_range,
-                                        site_spacing):
+                                        site_spacing,
+                                        epoch_name = 'complete_session'):
 
     """
     Calculate metrics for an array of waveforms for a single cluster.
@@ -128,6 +130,8 @@ def calculate_waveform_metrics_from_avg(avg_waveform,
         Number of sites to use for 2D waveform metrics
     site_spacing : float
         Average vertical distance between sites (m)
+    epoch_name : str
+        Epoch the waveforms were drawn from (C_waves uses the whole session)
 
     Outputs:
     -------
@@ -138,9 +142,6 @@ def calculate_waveform_metrics_from_avg(avg_waveform,
 
     # snr = calculate_snr(waveforms[:, peak_channel, :])
     
-    # calulating from average waveforms drawn from whole session
-    epoch_name = 'complete_session'
-    
     # all metric calculations are restricted to the channesl in the map
     mean_2D_waveform = np.squeeze(avg_waveform[channel_map, :])
     local_peak = np.argmin(np.abs(channel_map - peak_channel))
@@ -174,6 +175,99 @@ def calculate_waveform_metrics_from_avg(avg_waveform,
 
     return metrics
 
+def calculate_waveform_metrics_batch(mean_waveforms,
+                                     snr,
+                                     cluster_ids,
+                                     peak_channels,
+                                     channel_map,
+                                     sample_rate,
+                                     upsampling_factor,
+                                     spread_threshold,
+                                     site_range,
+                                     site_spacing,
+                                     epoch_name = 'complete_session'):
+
+    """
+    Calculate metrics for the mean waveforms of many units at once.
+
+    Gives the same results as calculate_waveform_metrics_from_avg for each unit, but
+    resamples all peak-channel waveforms with one FFT and calculates each feature
+    for all units with array operations.
+
+
+    Inputs:
+    -------
+    mean_waveforms : numpy.ndarray (num_units x num_channels x num_samples)
+        Mean waveform of each unit
+    snr : numpy.ndarray (num_units x 0)
+        SNR of each unit
+    cluster_ids : numpy.ndarray (num_units x 0)
+        ID of each unit
+    peak_channels : numpy.ndarray (num_units x 0)
+        Location of the waveform peak of each unit
+    channel_map : numpy.ndarray
+        Channels used for spike sorting
+    sample_rate : float
+        Sample rate in Hz
+    upsampling_factor : float
+        Relative rate at which to upsample the spike waveform
+    spread_threshold : float
+        Threshold for computing spread of 2D waveform
+    site_range : float
+        Number of sites to use for 2D waveform metrics
+    site_spacing : float
+        Average vertical distance between sites (m)
+    epoch_name : str
+        Epoch the waveforms were drawn from
+
+    Outputs:
+    -------
+    metrics : pandas.DataFrame
+        One row per unit, containing all metrics
+
+    """
+
+    channel_map = np.squeeze(channel_map).astype('int64')
+    peak_channels = np.asarray(peak_channels)
+
+    num_units, num_channels, num_samples = mean_waveforms.shape
+    new_sample_count = int(num_samples * upsampling_factor)
+
+    timestamps = np.linspace(0, num_samples / sample_rate, new_sample_count)
+
+    # all metric calculations are restricted to the channels in the map
+    local_peaks = np.argmin(np.abs(channel_map[np.newaxis, :] - peak_channels.astype('int64')[:, np.newaxis]), 1)
+
+    if num_units > 0:
+        mean_1D_waveforms = resample(mean_waveforms[np.arange(num_units), channel_map[local_peaks], :], new_sample_count, axis=1)
+    else:
+        mean_1D_waveforms = np.zeros((0, new_sample_count))
+
+    duration = batch_waveform_duration(mean_1D_waveforms, timestamps)
+    halfwidth = batch_waveform_halfwidth(mean_1D_waveforms, timestamps)
+    PT_ratio = batch_waveform_PT_ratio(mean_1D_waveforms)
+    repolarization_slope = batch_waveform_repolarization_slope(mean_1D_waveforms, timestamps)
+    recovery_slope = batch_waveform_recovery_slope(mean_1D_waveforms, timestamps)
+
+    amplitude, spread, velocity_above, velocity_below = batch_2D_features(
+        mean_waveforms, timestamps, local_peaks, spread_threshold, site_range, site_spacing, channel_map)
+
+    metrics = pd.DataFrame({'cluster_id' : cluster_ids,
+                            'epoch_name' : [epoch_name] * num_units,
+                            'peak_channel' : peak_channels,
+                            'snr' : snr,
+                            'duration' : duration,
+                            'halfwidth' : halfwidth,
+                            'PT_ratio' : PT_ratio,
+                            'repolarization_slope' : repolarization_slope,
+                            'recovery_slope' : recovery_slope,
+                            'amplitude' : amplitude,
+                            'spread' : spread,
+                            'velocity_above' : velocity_above,
+                            'velocity_below' : velocity_below})
+
+    return metrics
+
 # ==========================================================
 
 # EXTRACTING 1D FEATURES
@@ -207,6 +301,30 @@ def calculate_snr(W):
     return snr
 
 
+def calculate_snr_from_moments(mean_waveform, sum_of_squares, num_spikes):
+
+    """
+    Calculate SNR of spike waveforms from their running mean and sum of squared
+    deviations (same result as calculate_snr on the individual waveforms)
+
+    Input:
+    -------
+    mean_waveform : mean of N waveforms (samples), or of each unit (units x samples)
+    sum_of_squares : sum over waveforms of squared deviations from the mean (same shape)
+    num_spikes : number of waveforms (N), or of each unit
+
+    Output:
+    snr : signal-to-noise ratio for unit (scalar), or of each unit
+
+    """
+
+    A = np.max(mean_waveform, -1) - np.min(mean_waveform, -1)
+    e_std = np.sqrt(np.sum(sum_of_squares, -1) / (num_spikes * mean_waveform.shape[-1]))
+    snr = A/(2*e_std)
+
+    return snr
+
+
 def calculate_waveform_duration(waveform, timestamps):
     
     """ 
@@ -515,3 +633,209 @@ def isnot_outlier(points, thresh=1.5):
     modified_z_score = 0.6745 * diff / med_abs_deviation
 
     return modified_z_score <= thresh
+
+
+# ==========================================================
+
+# BATCHED FEATURES (one row per waveform):
+
+# ==========================================================
+
+
+def batch_waveform_duration(waveforms, timestamps):
+
+    """ calculate_waveform_duration for each row of waveforms (N waveforms x M samples) """
+
+    rows = np.arange(waveforms.shape[0])
+
+    trough_idx = np.argmin(waveforms, 1)
+    peak_idx = np.argmax(waveforms, 1)
+
+    # to avoid detecting peak before trough
+    peak_first = waveforms[rows, peak_idx] > np.abs(waveforms[rows, trough_idx])
+    start = np.where(peak_first, peak_idx, trough_idx)
+
+    # after the peak, find the trough; after the trough, find the peak
+    signed = np.where(peak_first[:, np.newaxis], waveforms, -waveforms)
+    after_start = np.arange(waveforms.shape[1])[np.newaxis, :] >= start[:, np.newaxis]
+    end = np.argmin(np.where(after_start, signed, np.inf), 1)
+
+    return (timestamps[end] - timestamps[start]) * 1e3
+
+
+def batch_waveform_halfwidth(waveforms, timestamps):
+
+    """ calculate_waveform_halfwidth for each row of waveforms (N waveforms x M samples) """
+
+    rows = np.arange(waveforms.shape[0])
+
+    trough_idx = np.argmin(waveforms, 1)
+    peak_idx = np.argmax(waveforms, 1)
+
+    peak_first = waveforms[rows, peak_idx] > np.abs(waveforms[rows, trough_idx])
+    extremum = np.where(peak_first, peak_idx, trough_idx)
+
+    # for troughs, flip the sign so both cases look for a peak
+    signed = np.where(peak_first[:, np.newaxis], waveforms, -waveforms)
+    threshold = signed[rows, extremum][:, np.newaxis] * 0.5
+
+    samples = np.arange(waveforms.shape[1])[np.newaxis, :]
+    crossing_1 = (signed > threshold) * (samples < extremum[:, np.newaxis])
+    crossing_2 = (signed < threshold) * (samples >= extremum[:, np.newaxis])
+
+    halfwidth = timestamps[np.argmax(crossing_2, 1)] - timestamps[np.argmax(crossing_1, 1)]
+    halfwidth[~(np.any(crossing_1, 1) * np.any(crossing_2, 1))] = np.nan
+
+    return halfwidth * 1e3
+
+
+def batch_waveform_PT_ratio(waveforms):
+
+    """ calculate_waveform_PT_ratio for each row of waveforms (N waveforms x M samples) """
+
+    rows = np.arange(waveforms.shape[0])
+
+    return np.abs(waveforms[rows, np.argmax(waveforms, 1)] / waveforms[rows, np.argmin(waveforms, 1)])
+
+
+def batch_waveform_repolarization_slope(waveforms, timestamps, window=20):
+
+    """ calculate_waveform_repolarization_slope for each row of waveforms (N waveforms x M samples) """
+
+    rows = np.arange(waveforms.shape[0])
+
+    max_point = np.argmax(np.abs(waveforms), 1)
+
+    waveforms = - waveforms * np.sign(waveforms[rows, max_point])[:, np.newaxis] # invert if we're using the peak
+
+    samples = np.arange(waveforms.shape[1])[np.newaxis, :]
+    in_window = (samples >= max_point[:, np.newaxis]) * (samples < max_point[:, np.newaxis] + window)
+
+    return batch_slope(timestamps[np.newaxis, :], waveforms, in_window) * 1e-6
+
+
+def batch_waveform_recovery_slope(waveforms, timestamps, window=20):
+
+    """ calculate_waveform_recovery_slope for each row of waveforms (N waveforms x M samples) """
+
+    rows = np.arange(waveforms.shape[0])
+
+    max_point = np.argmax(np.abs(waveforms), 1)
+
+    waveforms = - waveforms * np.sign(waveforms[rows, max_point])[:, np.newaxis] # invert if we're using the peak
+
+    samples = np.arange(waveforms.shape[1])[np.newaxis, :]
+    peak_idx = np.argmax(np.where(samples >= max_point[:, np.newaxis], waveforms, -np.inf), 1)
+
+    in_window = (samples >= peak_idx[:, np.newaxis]) * (samples < peak_idx[:, np.newaxis] + window)
+
+    return batch_slope(timestamps[np.newaxis, :], waveforms, in_window) * 1e-6
+
+
+def batch_2D_features(waveforms, timestamps, peak_channels, spread_threshold = 0.12, site_range=16, site_spacing=10e-6, channel_map=None):
+
+    """
+    calculate_2D_features for each waveform in a stack
+
+    Inputs:
+    ------
+    waveforms : numpy.ndarray (N waveforms x C channels x M samples)
+    timestamps : numpy.ndarray (M samples)
+    peak_channels : numpy.ndarray (N waveforms)
+        Peak of each waveform, as an index into channel_map
+    spread_threshold : float
+    site_range: int
+    site_spacing : float
+    channel_map : numpy.ndarray (optional)
+        Rows of waveforms that form the 2D waveform (default: all rows)
+
+    Outputs:
+    --------
+    amplitude : uV
+    spread : um
+    velocity_above : s / m
+    velocity_below : s / m
+    (one value per waveform)
+
+    """
+
+    assert site_range % 2 == 0 # must be even
+
+    if channel_map is None:
+        channel_map = np.arange(waveforms.shape[1])
+
+    rows = np.arange(waveforms.shape[0])
+
+    channels = np.arange(-site_range, site_range+1, 2)[np.newaxis, :]
+    sites_to_sample = channels + peak_channels[:, np.newaxis]
+
+    valid_sites = (sites_to_sample > 0) * (sites_to_sample < channel_map.size)
+
+    wv = waveforms[rows[:, np.newaxis], channel_map[np.where(valid_sites, sites_to_sample, 0)], :]
+
+    trough_idx = np.argmin(wv, 2)
+    overall_amplitude = np.where(valid_sites, np.max(wv, 2) - np.min(wv, 2), -np.inf)
+
+    amplitude = np.max(overall_amplitude, 1)
+    max_chan = np.argmax(overall_amplitude, 1)
+
+    points_above_thresh = overall_amplitude > (amplitude * spread_threshold)[:, np.newaxis]
+
+    # same as isnot_outlier for units with more than one point (sites are consecutive, so
+    # positions along the site axis differ from positions in the list by a constant)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        points = np.where(points_above_thresh, np.arange(channels.size)[np.newaxis, :], np.nan)
+        diff = np.abs(points - np.nanmedian(points, 1)[:, np.newaxis])
+        modified_z_score = 0.6745 * diff / np.nanmedian(diff, 1)[:, np.newaxis]
+
+    single_point = np.sum(points_above_thresh, 1) <= 1
+    points_above_thresh *= (modified_z_score <= 1.5) + single_point[:, np.newaxis]
+
+    spread = np.sum(points_above_thresh, 1) * site_spacing * 1e6
+
+    trough_times = timestamps[trough_idx] - timestamps[trough_idx[rows, max_chan]][:, np.newaxis]
+
+    channels = np.broadcast_to(channels, trough_times.shape)
+
+    velocity_above = batch_slope(channels, trough_times, points_above_thresh * (channels >= 0)) / site_spacing
+    velocity_below = batch_slope(channels, trough_times, points_above_thresh * (channels <= 0)) / site_spacing
+
+    return amplitude, spread, velocity_above, velocity_below
+
+
+def batch_slope(x, y, mask):
+
+    """
+    Least-squares slope of y against x for each row, using only the points where mask is True
+
+    Inputs:
+    -------
+    x : numpy.ndarray (N x M) or (1 x M)
+    y : numpy.ndarray (N x M)
+    mask : numpy.ndarray (N x M)
+
+    Outputs:
+    --------
+    slope : numpy.ndarray (N)
+        NaN for rows with fewer than 2 points
+
+    """
+
+    x = np.broadcast_to(x, y.shape)
+    num_points = np.sum(mask, 1)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+
+        x_mean = np.sum(np.where(mask, x, 0), 1) / num_points
+        y_mean = np.sum(np.where(mask, y, 0), 1) / num_points
+
+        dx = np.where(mask, x - x_mean[:, np.newaxis], 0)
+        dy = np.where(mask, y - y_mean[:, np.newaxis], 0)
+
+        slope = np.sum(dx * dy, 1) / np.sum(dx ** 2, 1)
+
+    slope[num_points < 2] = np.nan
+
+    return slope
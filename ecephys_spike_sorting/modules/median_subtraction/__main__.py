@@ -7,7 +7,9 @@ import glob
 import numpy as np
 
 from ...common.utils import read_probe_json, get_repo_commit_date_and_hash
+from ...common.profiling import profiled
 
+@profiled
 def run_median_subtraction(args):
 
     print('ecephys spike sorting: median subtraction module')
@@ -1,6 +1,6 @@
 from argschema import ArgSchema, ArgSchemaParser 
 from argschema.schemas import DefaultSchema
-from argschema.fields import Nested, InputDir, String, Float, Dict, Int
+from argschema.fields import Nested, InputDir, String, Float, Dict, Int, Bool
 from ...common.schemas import EphysParams, Directories, CommonFiles
 
 class MedianSubtractionParams(ArgSchema):
@@ -13,6 +13,7 @@ class InputParameters(ArgSchema):
     common_files = Nested(CommonFiles)
     directories = Nested(Directories)
     ephys_params = Nested(EphysParams)
+    profile = Bool(required=False, default=False, help='Record run time, CPU time, peak memory and disk I/O of each stage in the output manifest')
     
 class OutputSchema(DefaultSchema): 
     input_parameters = Nested(InputParameters, 
@@ -24,4 +25,5 @@ class OutputParameters(OutputSchema):
     median_subtraction_execution_time = Float()
     median_subtraction_commit_hash = String()
     median_subtraction_commit_date = String()
+    profile = Dict(required=False, help='Run time, CPU time, peak memory and disk I/O of the whole run and of each stage (if profile is True)')
     
\ No newline at end of file
@@ -8,8 +8,10 @@ import numpy as np
 from .id_noise_templates import id_noise_templates, id_noise_templates_rf
 
 from ...common.utils import write_cluster_group_tsv, load_kilosort_data
+from ...common.profiling import profiled
 
 
+@profiled
 def classify_noise_templates(args):
 
     print('ecephys spike sorting: noise templates module')
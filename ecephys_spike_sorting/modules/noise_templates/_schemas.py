@@ -36,6 +36,7 @@ class InputParameters(ArgSchema):
     noise_waveform_params = Nested(NoiseWaveformParams)
     ephys_params = Nested(EphysParams)
     directories = Nested(Directories)
+    profile = Boolean(required=False, default=False, help='Record run time, CPU time, peak memory and disk I/O of each stage in the output manifest')
     
 class OutputSchema(DefaultSchema): 
 
@@ -47,4 +48,5 @@ class OutputSchema(DefaultSchema):
 class OutputParameters(OutputSchema): 
 
     execution_time = Float()
+    profile = Dict(required=False, help='Run time, CPU time, peak memory and disk I/O of the whole run and of each stage (if profile is True)')
     
\ No newline at end of file
@@ -5,10 +5,12 @@ import subprocess
 import time
 import shutil
 from ...common.utils import catGT_ex_params_from_str
+from ...common.profiling import profiled
 
 import numpy as np
 
 
+@profiled
 def get_psth_events(args):
 
     # simple function to read in extracted edges file created by CatGT
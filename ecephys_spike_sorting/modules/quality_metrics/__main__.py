@@ -2,17 +2,25 @@ from argschema import ArgSchemaParser
 import os
 import logging
 import time
+import json
+import hashlib
+from io import StringIO
 
 import numpy as np
 import pandas as pd
 
-from ...common.utils import load_kilosort_data
+from ...common.utils import KilosortDataset, write_metrics_table, read_metrics_table
 from ...common.epoch import get_epochs_from_nwb_file
+from ...common.profiling import profiled, profile_stage
 
 from .metrics import calculate_metrics
+from .streaming import calculate_metrics_streaming
 
 
-def calculate_quality_metrics(args):
+@profiled
+def calculate_quality_metrics(args, pool = None):
+
+    """ Calculates quality metrics for one probe; pool is an optional worker pool shared with other probes """
 
     print('ecephys spike sorting: quality metrics module')
 
@@ -20,15 +28,57 @@ def calculate_quality_metrics(args):
 
     print("Loading data...")
 
+    output_file = args['cluster_metrics']['cluster_metrics_file']
+    state_file = os.path.splitext(output_file)[0] + '_incremental.json'
+
+    params = args['quality_metrics_params']
+
     try:
-        spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, \
-        channel_pos, clusterIDs, cluster_quality, cluster_amplitude, pc_features, pc_feature_ind, template_features = \
-                load_kilosort_data(args['directories']['kilosort_output_directory'], \
+        kilosort_data = KilosortDataset(args['directories']['kilosort_output_directory'], \
                     args['ephys_params']['sample_rate'], \
-                    use_master_clock = False,
-                    include_pcs = True)
-
-        metrics = calculate_metrics(spike_times, spike_clusters, amplitudes, channel_map, channel_pos, pc_features, pc_feature_ind, args['quality_metrics_params'])
+                    use_master_clock = False)
+
+        if params['streaming']:
+
+            if params['incremental']:
+                logging.warning('incremental is not supported in streaming mode; metrics are calculated for all units')
+
+            metrics = calculate_metrics_streaming(kilosort_data.spike_times, 
+                                                  kilosort_data.spike_clusters, 
+                                                  kilosort_data.amplitudes, 
+                                                  kilosort_data.channel_map, 
+                                                  kilosort_data.channel_pos, 
+                                                  kilosort_data.pc_features, 
+                                                  kilosort_data.pc_feature_ind, 
+                                                  params,
+                                                  pool = pool,
+                                                  channel_shanks = kilosort_data.channel_shanks)
+
+        else:
+
+            previous_metrics = None
+            changed_units = None
+
+            if params['incremental']:
+                session = session_fingerprint(kilosort_data.spike_times, params)
+                fingerprints = kilosort_data.cluster_index.fingerprints()
+                previous_metrics, changed_units = load_previous_run(state_file, session, fingerprints)
+
+            metrics = calculate_metrics(kilosort_data.spike_times, 
+                                        kilosort_data.spike_clusters, 
+                                        kilosort_data.amplitudes, 
+                                        kilosort_data.channel_map, 
+                                        kilosort_data.channel_pos, 
+                                        kilosort_data.pc_features, 
+                                        kilosort_data.pc_feature_ind, 
+                                        params,
+                                        previous_metrics = previous_metrics,
+                                        changed_units = changed_units,
+                                        pool = pool,
+                                        channel_shanks = kilosort_data.channel_shanks)
+
+            if params['incremental']:
+                save_run_state(state_file, session, fingerprints, metrics)
 
     except FileNotFoundError:
         
@@ -40,17 +90,15 @@ def calculate_quality_metrics(args):
             "quality_metrics_output_file" : None} 
 
 
-    output_file = args['cluster_metrics']['cluster_metrics_file']
-
     if os.path.exists(args['waveform_metrics']['waveform_metrics_file']):
-        metrics = metrics.merge(pd.read_csv(args['waveform_metrics']['waveform_metrics_file'], index_col=0),
+        metrics = metrics.merge(read_metrics_table(args['waveform_metrics']['waveform_metrics_file']),
                      on='cluster_id',
                      suffixes=('_quality_metrics','_waveform_metrics'))
 
     print("Saving data...")
    
-
-    metrics.to_csv(output_file)
+    with profile_stage('saving'):
+        write_metrics_table(metrics, output_file, params['columnar_format'])
 
     execution_time = time.time() - start
 
@@ -61,6 +109,74 @@ def calculate_quality_metrics(args):
             "quality_metrics_output_file" : output_file} # output manifest
 
 
+def session_fingerprint(spike_times, params):
+
+    """ Hash of all spike times and the metric parameters; previous results are only reused if this matches """
+
+    settings = {key: value for key, value in params.items() if key not in ('incremental', 'num_workers', 'columnar_format')}
+
+    digest = hashlib.sha1(np.ascontiguousarray(spike_times).tobytes())
+    digest.update(json.dumps(settings, sort_keys=True).encode())
+
+    return digest.hexdigest()
+
+
+def load_previous_run(state_file, session, fingerprints):
+
+    """
+    Finds the units whose spikes changed since the last incremental run (e.g. after merging or splitting in phy)
+
+    Inputs:
+    -------
+    state_file : String
+        Path to the saved state of the previous run
+    session : String
+        Output of session_fingerprint for the current data
+    fingerprints : list of Strings
+        Fingerprint of the spikes of each unit (from ClusterIndex.fingerprints)
+
+    Outputs:
+    --------
+    previous_metrics : pandas.DataFrame or None
+        Metrics from the previous run (None if all units must be calculated)
+    changed_units : numpy.ndarray or None
+        IDs of units whose spikes are different
+
+    """
+
+    if not os.path.exists(state_file):
+        return None, None
+
+    with open(state_file) as f:
+        state = json.load(f)
+
+    if state['session'] != session:
+        print(' Spike times or parameters changed; calculating metrics for all units.')
+        return None, None
+
+    previous_fingerprints = state['fingerprints']
+
+    num_units = max(len(fingerprints), len(previous_fingerprints))
+    current = np.array(fingerprints + [''] * (num_units - len(fingerprints)))
+    previous = np.array(previous_fingerprints + [''] * (num_units - len(previous_fingerprints)))
+
+    changed_units = np.flatnonzero(current != previous)
+
+    print(' Recalculating metrics for ' + str(changed_units.size) + ' changed units.')
+
+    return pd.read_json(StringIO(state['metrics']), orient='split'), changed_units
+
+
+def save_run_state(state_file, session, fingerprints, metrics):
+
+    """ Saves the fingerprints and metrics needed for the next incremental run """
+
+    with open(state_file, 'w') as f:
+        json.dump({'session' : session,
+                   'fingerprints' : fingerprints,
+                   'metrics' : metrics.to_json(orient='split', double_precision=15)}, f)
+
+
 def main():
 
     from ._schemas import InputParameters, OutputParameters
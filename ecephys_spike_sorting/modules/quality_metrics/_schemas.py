@@ -1,6 +1,7 @@
 from argschema import ArgSchema, ArgSchemaParser 
 from argschema.schemas import DefaultSchema
-from argschema.fields import Nested, InputDir, String, Float, Dict, Int
+from argschema.fields import Nested, InputDir, String, Float, Dict, Int, Bool, List
+from marshmallow.validate import OneOf
 from ...common.schemas import EphysParams, Directories, WaveformMetricsFile, ClusterMetricsFile
 
 
@@ -12,6 +13,13 @@ class QualityMetricsParams(DefaultSchema):
     max_spikes_for_nn = Int(required=False, default=10000, help='Further subsampling for NearestNeighbor calculation')
     n_neighbors = Int(required=False, default=4, help='Number of neighbors to use for NearestNeighbor calculation')
     n_silhouette = Int(required=False, default=10000, help='Number of spikes to use for calculating silhouette score')
+    silhouette_neighbors_only = Bool(required=False, default=False, help='Only compare units whose PC channels overlap when calculating silhouette score')
+    num_workers = Int(required=False, default=1, help='Number of processes to use for computing PC metrics (1 = serial)')
+    precision = String(required=False, default='float64', validate=OneOf(['float32', 'float64']), help='Floating point precision for PC-based metrics and silhouette score (float32 halves memory use)')
+    streaming = Bool(required=False, default=False, help='Read spikes in time-ordered chunks and calculate PC-based metrics on a per-unit random sample, for recordings that do not fit in memory')
+    memory_budget_mb = Float(required=False, default=4096, help='Approximate memory limit (in MB) for chunks and samples in streaming mode')
+    columnar_format = String(required=False, default='none', validate=OneOf(['none', 'parquet', 'feather']), help='Also write metrics tables in this format, next to each CSV (requires pyarrow)')
+    incremental = Bool(required=False, default=False, help='Only recalculate metrics for units whose spikes changed since the last incremental run (e.g. after curation in phy); silhouette score is recalculated for all units unless silhouette_neighbors_only is set; not supported with streaming')
 
     drift_metrics_min_spikes_per_interval = Int(required=False, default=10, help='Minimum number of spikes for computing depth')
     drift_metrics_interval_s = Float(required=False, default=100, help='Interval length is seconds for computing spike depth')
@@ -24,7 +32,23 @@ class InputParameters(ArgSchema):
     directories = Nested(Directories)
     waveform_metrics = Nested(WaveformMetricsFile)
     cluster_metrics = Nested(ClusterMetricsFile)
+    profile = Bool(required=False, default=False, help='Record run time, CPU time, peak memory and disk I/O of each stage in the output manifest')
     
+class ProbeInputParameters(DefaultSchema):
+
+    ephys_params = Nested(EphysParams)
+    directories = Nested(Directories)
+    waveform_metrics = Nested(WaveformMetricsFile)
+    cluster_metrics = Nested(ClusterMetricsFile)
+
+
+class MultiProbeInputParameters(ArgSchema):
+
+    quality_metrics_params = Nested(QualityMetricsParams)
+    probes = Nested(ProbeInputParameters, many=True, required=True, help='Kilosort output and metrics files for each probe')
+    num_workers = Int(required=False, default=4, help='Number of processes shared by all probes for computing PC metrics')
+    profile = Bool(required=False, default=False, help='Record run time, CPU time, peak memory and disk I/O of each stage in the output manifest')
+
 class OutputSchema(DefaultSchema): 
     input_parameters = Nested(InputParameters, 
                               description=("Input parameters the module " 
@@ -35,4 +59,16 @@ class OutputParameters(OutputSchema):
 
     execution_time = Float()
     quality_metrics_output_file = String()
+    profile = Dict(required=False, help='Run time, CPU time, peak memory and disk I/O of the whole run and of each stage (if profile is True)')
+
+class MultiProbeOutputParameters(DefaultSchema):
+
+    input_parameters = Nested(MultiProbeInputParameters,
+                              description=("Input parameters the module "
+                                           "was run with"),
+                              required=True)
+    execution_time = Float()
+    quality_metrics_output_files = List(String)
+    probe_profiles = List(Dict, required=False, help='Profile block of each probe (if profile is True)')
+    profile = Dict(required=False, help='Run time, CPU time, peak memory and disk I/O of the whole run and of each stage (if profile is True)')
     
\ No newline at end of file
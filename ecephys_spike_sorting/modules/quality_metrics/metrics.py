@@ -2,28 +2,37 @@ import numpy as np
 import pandas as pd
 from collections import OrderedDict
 
-import warnings
+import multiprocessing
+from functools import partial
 
 from sklearn.discriminant_analysis import LinearDiscriminantAnalysis as LDA
 from sklearn.neighbors import NearestNeighbors
-from sklearn.metrics import silhouette_score
+from sklearn.metrics.pairwise import euclidean_distances
 
-from scipy.spatial.distance import cdist
+from scipy import sparse
+from scipy.linalg import solve_triangular
 from scipy.stats import chi2
 from scipy.ndimage.filters import gaussian_filter1d
 
 from ...common.epoch import Epoch
+from ...common.cluster_index import ClusterIndex
+from ...common.shared_array import SharedArray
+from ...common.lru_cache import LRUCache
+from ...common.profiling import profile_stage
 from ...common.utils import printProgressBar, get_spike_depths
 
 
-def calculate_metrics(spike_times, spike_clusters, amplitudes, channel_map, channel_pos, pc_features, pc_feature_ind, params, epochs = None):
+def calculate_metrics(spike_times, spike_clusters, amplitudes, channel_map, channel_pos, pc_features, pc_feature_ind, params, epochs = None,
+                      previous_metrics = None, changed_units = None, pool = None, channel_shanks = None):
 
     """ Calculate metrics for all units on one probe
 
     Inputs:
     ------
     spike_times : numpy.ndarray (num_spikes x 0)
-        Spike times in seconds (same timebase as epochs)
+        Spike times in seconds (same timebase as epochs); if these are not sorted,
+        the other per-spike arrays are reordered once (except pc_features, which are
+        read through the sort order, so they are never copied)
     spike_clusters : numpy.ndarray (num_spikes x 0)
         Cluster IDs for each spike time
     amplitudes : numpy.ndarray (num_spikes x 0)
@@ -40,6 +49,19 @@ def calculate_metrics(spike_times, spike_clusters, amplitudes, channel_map, chan
         contains information on Epoch start and stop times
     params : dict of parameters
         'isi_threshold' : minimum time for isi violations
+    previous_metrics : pandas.DataFrame (optional)
+        Output of a previous run on the same spikes; metrics of units that
+        are not recalculated are copied from this table
+    changed_units : numpy.ndarray (optional)
+        IDs of units whose spikes changed since previous_metrics was calculated;
+        PC-based metrics are also recalculated for units that share PC channels
+        with these units (silhouette score is recalculated for all units, unless
+        params['silhouette_neighbors_only'] is set)
+    pool : multiprocessing.Pool (optional)
+        Worker pool for PC-based metrics (e.g. shared between probes); if None,
+        a pool with params['num_workers'] processes is created when needed
+    channel_shanks : numpy.ndarray (num_channels x 0) (optional)
+        Shank index for each channel; units on different shanks are never compared
 
     
     Outputs:
@@ -61,56 +83,113 @@ def calculate_metrics(spike_times, spike_clusters, amplitudes, channel_map, chan
     [total_units, dummy] = pc_feature_ind.shape
     total_epochs = len(epochs)
 
+    # row of pc_features for each time-sorted spike (None if the spikes are already sorted)
+    pc_rows = None
+
+    if np.any(np.diff(spike_times) < 0):
+        pc_rows = np.argsort(spike_times, kind='stable')
+        spike_times = spike_times[pc_rows]
+        spike_clusters = spike_clusters[pc_rows]
+        amplitudes = amplitudes[pc_rows]
+
+    if changed_units is None:
+        units_to_update = None
+        pc_units_to_update = None
+    else:
+        units_to_update = np.asarray(changed_units, dtype='int64')
+        units_to_update = units_to_update[(units_to_update >= 0) & (units_to_update < total_units)]
+        neighbors = find_channel_neighbors(pc_feature_ind)
+        pc_units_to_update = np.flatnonzero(np.asarray(neighbors[units_to_update, :].sum(0)).ravel())
+
+    # the worst silhouette score of a unit can come from a pair with any other unit,
+    # so it only stays valid for units far from the changed units if non-neighbors are never compared
+    if params['silhouette_neighbors_only']:
+        silhouette_units_to_update = pc_units_to_update
+    else:
+        silhouette_units_to_update = None
+
     for epoch in epochs:
 
-        in_epoch = (spike_times > epoch.start_time) * (spike_times < epoch.end_time)
+        # contiguous range of time-sorted spikes, so per-spike arrays are views (not copies)
+        in_epoch = get_epoch_slice(spike_times, epoch)
+
+        cluster_index = ClusterIndex(spike_clusters[in_epoch], total_units)
+
+        if pc_rows is None:
+            epoch_pc_features = pc_features[in_epoch,:,:]
+            epoch_pc_rows = None
+            pc_cluster_index = cluster_index
+        else:
+            epoch_pc_features = pc_features
+            epoch_pc_rows = pc_rows[in_epoch]
+            pc_cluster_index = cluster_index.remapped(epoch_pc_rows)
 
         print("Calculating isi violations")
-        isi_viol = calculate_isi_violations(spike_times[in_epoch], spike_clusters[in_epoch], total_units, params['isi_threshold'], params['min_isi'])
+        with profile_stage('isi_violations'):
+            isi_viol = calculate_isi_violations(spike_times[in_epoch], spike_clusters[in_epoch], total_units, params['isi_threshold'], params['min_isi'], cluster_index, units_to_update)
         
         print("Calculating presence ratio")
-        presence_ratio = calculate_presence_ratio(spike_times[in_epoch], spike_clusters[in_epoch], total_units)
+        with profile_stage('presence_ratio'):
+            presence_ratio = calculate_presence_ratio(spike_times[in_epoch], spike_clusters[in_epoch], total_units, cluster_index, units_to_update)
 
         print("Calculating firing rate")
-        firing_rate = calculate_firing_rate(spike_times[in_epoch], spike_clusters[in_epoch], total_units)
+        with profile_stage('firing_rate'):
+            firing_rate = calculate_firing_rate(spike_times[in_epoch], spike_clusters[in_epoch], total_units, cluster_index, units_to_update)
         
         print("Calculating amplitude cutoff")
-        amplitude_cutoff = calculate_amplitude_cutoff(spike_clusters[in_epoch], amplitudes[in_epoch], total_units)
+        with profile_stage('amplitude_cutoff'):
+            amplitude_cutoff = calculate_amplitude_cutoff(spike_clusters[in_epoch], amplitudes[in_epoch], total_units, cluster_index, units_to_update)
         
         print("Calculating PC-based metrics")
-        isolation_distance, l_ratio, d_prime, nn_hit_rate, nn_miss_rate = calculate_pc_metrics(spike_clusters[in_epoch], 
-                                                                                                total_units,
-                                                                                                pc_features[in_epoch,:,:],
-                                                                                                pc_feature_ind,
-                                                                                                params['num_channels_to_compare'],
-                                                                                                params['max_spikes_for_unit'],
-                                                                                                params['max_spikes_for_nn'],
-                                                                                                params['n_neighbors'])
+        with profile_stage('pc_metrics'):
+            isolation_distance, l_ratio, d_prime, nn_hit_rate, nn_miss_rate = calculate_pc_metrics(spike_clusters[in_epoch], 
+                                                                                                    total_units,
+                                                                                                    epoch_pc_features,
+                                                                                                    pc_feature_ind,
+                                                                                                    params['num_channels_to_compare'],
+                                                                                                    params['max_spikes_for_unit'],
+                                                                                                    params['max_spikes_for_nn'],
+                                                                                                    params['n_neighbors'],
+                                                                                                    pc_cluster_index,
+                                                                                                    params['num_workers'],
+                                                                                                    pc_units_to_update,
+                                                                                                    params['precision'],
+                                                                                                    pool,
+                                                                                                    channel_shanks)
   
         print("Calculating silhouette score")
-        nSpikes = spike_times[in_epoch].size
-        the_silhouette_score = calculate_silhouette_score(spike_clusters[in_epoch], 
-                                                       total_units,
-                                                       pc_features[in_epoch,:,:],
-                                                       pc_feature_ind,
-                                                       min(nSpikes, params['n_silhouette']))
+        with profile_stage('silhouette_score'):
+            nSpikes = spike_times[in_epoch].size
+            the_silhouette_score = calculate_silhouette_score(spike_clusters[in_epoch], 
+                                                           total_units,
+                                                           epoch_pc_features,
+                                                           pc_feature_ind,
+                                                           min(nSpikes, params['n_silhouette']),
+                                                           params['silhouette_neighbors_only'],
+                                                           silhouette_units_to_update,
+                                                           params['precision'],
+                                                           epoch_pc_rows)
 
 
         print("Calculating drift metrics")
-        max_drift, cumulative_drift = calculate_drift_metrics(spike_times[in_epoch],
-                                                       spike_clusters[in_epoch], 
-                                                       total_units,
-                                                       pc_features[in_epoch,:,:],
-                                                       pc_feature_ind,
-                                                       channel_pos,
-                                                       params['drift_metrics_interval_s'],
-                                                       params['drift_metrics_min_spikes_per_interval'])
+        with profile_stage('drift_metrics'):
+            max_drift, cumulative_drift = calculate_drift_metrics(spike_times[in_epoch],
+                                                           spike_clusters[in_epoch], 
+                                                           total_units,
+                                                           epoch_pc_features,
+                                                           pc_feature_ind,
+                                                           channel_pos,
+                                                           params['drift_metrics_interval_s'],
+                                                           params['drift_metrics_min_spikes_per_interval'],
+                                                           cluster_index,
+                                                           units_to_update,
+                                                           epoch_pc_rows)
 
         cluster_ids = np.arange(total_units)
 
         epoch_name = [epoch.name] * len(cluster_ids)
 
-        metrics = pd.concat((metrics, pd.DataFrame(data= OrderedDict((('cluster_id', cluster_ids),
+        epoch_metrics = pd.DataFrame(data= OrderedDict((('cluster_id', cluster_ids),
                                 ('firing_rate' , firing_rate),
                                 ('presence_ratio' , presence_ratio),
                                 ('isi_viol' , isi_viol),
@@ -124,57 +203,114 @@ def calculate_metrics(spike_times, spike_clusters, amplitudes, channel_map, chan
                                 ('max_drift', max_drift),
                                 ('cumulative_drift', cumulative_drift),
                                 ('epoch_name' , epoch_name),
-                                )))))
+                                )))
+
+        if previous_metrics is not None and changed_units is not None:
+            epoch_metrics = reuse_previous_metrics(epoch_metrics, previous_metrics, units_to_update,
+                    ['firing_rate', 'presence_ratio', 'isi_viol', 'amplitude_cutoff', 'max_drift', 'cumulative_drift'])
+            epoch_metrics = reuse_previous_metrics(epoch_metrics, previous_metrics, pc_units_to_update,
+                    ['isolation_distance', 'l_ratio', 'd_prime', 'nn_hit_rate', 'nn_miss_rate'])
+            if silhouette_units_to_update is not None:
+                epoch_metrics = reuse_previous_metrics(epoch_metrics, previous_metrics, silhouette_units_to_update,
+                        ['silhouette_score'])
+
+        metrics = pd.concat((metrics, epoch_metrics))
 
     return metrics 
 
+
+def reuse_previous_metrics(epoch_metrics, previous_metrics, updated_units, columns):
+
+    """ Copies metrics of units that were not recalculated from the output of a previous run
+
+    Inputs:
+    -------
+    epoch_metrics : pandas.DataFrame
+        Metrics for one epoch (one row per unit)
+    previous_metrics : pandas.DataFrame
+        Metrics from a previous run (matched on 'cluster_id' and 'epoch_name')
+    updated_units : numpy.ndarray
+        IDs of units that were recalculated
+    columns : list of strings
+        Metrics to copy
+
+    Outputs:
+    --------
+    epoch_metrics : pandas.DataFrame
+        Metrics with previous values filled in
+
+    """
+
+    previous = previous_metrics[previous_metrics['epoch_name'] == epoch_metrics['epoch_name'].iloc[0]]
+    previous = previous.drop_duplicates('cluster_id').set_index('cluster_id')
+
+    cluster_ids = epoch_metrics['cluster_id'].values
+    reuse = ~np.isin(cluster_ids, updated_units) & np.isin(cluster_ids, previous.index.values)
+
+    epoch_metrics.loc[reuse, columns] = previous.loc[cluster_ids[reuse], columns].values
+
+    return epoch_metrics
+
 # ===============================================================
 
 # HELPER FUNCTIONS TO LOOP THROUGH CLUSTERS:
 
 # ===============================================================
 
-def calculate_isi_violations(spike_times, spike_clusters, total_units, isi_threshold, min_isi):
+def calculate_isi_violations(spike_times, spike_clusters, total_units, isi_threshold, min_isi, cluster_index = None, cluster_ids = None):
+
+    if cluster_index is None:
+        cluster_index = ClusterIndex(spike_clusters, total_units)
 
-    cluster_ids = np.unique(spike_clusters)
+    cluster_ids = cluster_index.select(cluster_ids)
 
     viol_rates = np.zeros((total_units,))
 
-    for idx, cluster_id in enumerate(cluster_ids):
+    min_time = np.min(spike_times)
+    max_time = np.max(spike_times)
 
-        printProgressBar(idx+1, len(cluster_ids))
+    spike_indices, groups = cluster_index.grouped(cluster_ids)
 
-        for_this_cluster = (spike_clusters == cluster_id)
-        viol_rates[cluster_id], num_violations = isi_violations(spike_times[for_this_cluster], 
-                                                       min_time = np.min(spike_times), 
-                                                       max_time = np.max(spike_times), 
-                                                       isi_threshold=isi_threshold, 
-                                                       min_isi = min_isi)
+    viol_rates[cluster_ids], num_violations = grouped_isi_violations(spike_times[spike_indices], 
+                                                                     groups, 
+                                                                     cluster_ids.size,
+                                                                     min_time = min_time, 
+                                                                     max_time = max_time, 
+                                                                     isi_threshold = isi_threshold, 
+                                                                     min_isi = min_isi)
 
     return viol_rates
 
-def calculate_presence_ratio(spike_times, spike_clusters, total_units):
+def calculate_presence_ratio(spike_times, spike_clusters, total_units, cluster_index = None, cluster_ids = None):
 
-    cluster_ids = np.unique(spike_clusters)
+    if cluster_index is None:
+        cluster_index = ClusterIndex(spike_clusters, total_units)
+
+    cluster_ids = cluster_index.select(cluster_ids)
 
     ratios = np.zeros((total_units,))
 
-    for idx, cluster_id in enumerate(cluster_ids):
+    min_time = np.min(spike_times)
+    max_time = np.max(spike_times)
 
-        printProgressBar(idx + 1, len(cluster_ids))
+    spike_indices, groups = cluster_index.grouped(cluster_ids)
 
-        for_this_cluster = (spike_clusters == cluster_id)
-        ratios[cluster_id] = presence_ratio(spike_times[for_this_cluster], 
-                                                       min_time = np.min(spike_times), 
-                                                       max_time = np.max(spike_times))
+    ratios[cluster_ids] = grouped_presence_ratios(spike_times[spike_indices], 
+                                                  groups, 
+                                                  cluster_ids.size,
+                                                  min_time = min_time, 
+                                                  max_time = max_time)
 
     return ratios
 
 
 
-def calculate_firing_rate(spike_times, spike_clusters, total_units):
+def calculate_firing_rate(spike_times, spike_clusters, total_units, cluster_index = None, cluster_ids = None):
+
+    if cluster_index is None:
+        cluster_index = ClusterIndex(spike_clusters, total_units)
 
-    cluster_ids = np.unique(spike_clusters)
+    cluster_ids = cluster_index.select(cluster_ids)
 
     firing_rates = np.zeros((total_units,))
 
@@ -185,27 +321,40 @@ def calculate_firing_rate(spike_times, spike_clusters, total_units):
 
         printProgressBar(idx + 1, len(cluster_ids))
 
-        for_this_cluster = (spike_clusters == cluster_id)
+        for_this_cluster = cluster_index.spikes_for(cluster_id)
         firing_rates[cluster_id] = firing_rate(spike_times[for_this_cluster], 
-                                        min_time = np.min(spike_times),
-                                        max_time = np.max(spike_times))
+                                        min_time = min_time,
+                                        max_time = max_time)
 
     return firing_rates
 
 
-def calculate_amplitude_cutoff(spike_clusters, amplitudes, total_units):
+def calculate_amplitude_cutoff(spike_clusters, amplitudes, total_units, cluster_index = None, cluster_ids = None, num_histogram_bins = 500):
+
+    if cluster_index is None:
+        cluster_index = ClusterIndex(spike_clusters, total_units)
 
-    cluster_ids = np.unique(spike_clusters)
+    cluster_ids = cluster_index.select(cluster_ids)
 
     amplitude_cutoffs = np.zeros((total_units,))
 
-    for idx, cluster_id in enumerate(cluster_ids):
+    if cluster_ids.size == 0:
+        return amplitude_cutoffs
 
-        printProgressBar(idx + 1, len(cluster_ids))
+    # amplitudes grouped by unit, one row of the histogram matrix per unit
+    spike_counts = cluster_index.counts[cluster_ids]
+    spike_indices, rows = cluster_index.grouped(cluster_ids)
+    values = np.ravel(amplitudes)[spike_indices]
 
+    starts = np.concatenate(([0], np.cumsum(spike_counts)[:-1]))
+    bin_edges = amplitude_histogram_edges(np.minimum.reduceat(values, starts), 
+                                          np.maximum.reduceat(values, starts), 
+                                          num_histogram_bins)
 
-        for_this_cluster = (spike_clusters == cluster_id)
-        amplitude_cutoffs[cluster_id] = amplitude_cutoff(amplitudes[for_this_cluster])
+    indices = amplitude_histogram_indices(values, rows, bin_edges)
+    counts = np.bincount(rows * num_histogram_bins + indices, minlength = cluster_ids.size * num_histogram_bins)
+
+    amplitude_cutoffs[cluster_ids] = amplitude_cutoffs_from_histograms(np.reshape(counts, (cluster_ids.size, num_histogram_bins)), bin_edges)
 
     return amplitude_cutoffs
 
@@ -217,12 +366,20 @@ def calculate_pc_metrics(spike_clusters,
                          num_channels_to_compare, 
                          max_spikes_for_cluster, 
                          max_spikes_for_nn, 
-                         n_neighbors):
+                         n_neighbors,
+                         cluster_index = None,
+                         num_workers = 1,
+                         cluster_ids = None,
+                         dtype = 'float64',
+                         pool = None,
+                         channel_shanks = None,
+                         unit_spike_counts = None):
 
     assert(num_channels_to_compare % 2 == 1)
     half_spread = int((num_channels_to_compare - 1) / 2)
 
-    cluster_ids = np.unique(spike_clusters)
+    if cluster_index is None:
+        cluster_index = ClusterIndex(spike_clusters, total_units)
 
     peak_channels = np.zeros((total_units,), dtype='uint16')
     isolation_distances = np.zeros((total_units,))
@@ -231,139 +388,561 @@ def calculate_pc_metrics(spike_clusters,
     nn_hit_rates = np.zeros((total_units,))
     nn_miss_rates = np.zeros((total_units,))
 
-    for idx, cluster_id in enumerate(cluster_ids):
-        for_unit = np.squeeze(spike_clusters == cluster_id)
+    for idx, cluster_id in enumerate(cluster_index.cluster_ids):
+        for_unit = cluster_index.spikes_for(cluster_id)
         pc_max = np.argmax(np.mean(pc_features[for_unit, 0, :],0))
         peak_channels[cluster_id] = pc_feature_ind[cluster_id, pc_max]
 
-    for idx, cluster_id in enumerate(cluster_ids):
+    # units on different shanks are never compared, so each shank is processed independently
+    if channel_shanks is None:
+        unit_shanks = np.zeros((total_units,), dtype='int64')
+    else:
+        unit_shanks = np.asarray(channel_shanks)[peak_channels]
+
+    # peak channels of all units are needed to find the neighbors of the selected units
+    cluster_ids = cluster_index.select(cluster_ids)
+
+    # units with the same peak channel are compared with the same units and channels, so each
+    # of these neighborhoods is one task (and units that use the same spikes share one nearest-neighbor search)
+    cluster_ids = cluster_ids[np.lexsort((peak_channels[cluster_ids], unit_shanks[cluster_ids]))]
+    neighborhoods = np.split(cluster_ids, np.flatnonzero(np.diff(peak_channels[cluster_ids].astype('int64'))) + 1)
+
+    neighborhood_selections = ([select_pcs_for_unit(cluster_id, 
+                                                    peak_channels, 
+                                                    pc_feature_ind, 
+                                                    half_spread, 
+                                                    max_spikes_for_cluster, 
+                                                    cluster_index,
+                                                    unit_shanks,
+                                                    unit_spike_counts) for cluster_id in neighborhood]
+                               for neighborhood in neighborhoods if neighborhood.size > 0)
+
+    use_pool = pool is not None or num_workers > 1
+
+    if use_pool:
+        # workers read pc_features from shared memory (or the original memmap)
+        shared_pc_features = SharedArray(pc_features)
+        own_pool = pool is None
+        if own_pool:
+            pool = multiprocessing.Pool(np.min([num_workers, multiprocessing.cpu_count()]))
+        neighborhood_metrics = pool.imap(partial(pc_metrics_for_shared_neighborhood, shared_pc_features, max_spikes_for_nn, n_neighbors, dtype),
+                                         neighborhood_selections)
+    else:
+        neighborhood_metrics = map(partial(pc_metrics_for_neighborhood, pc_features, max_spikes_for_nn, n_neighbors, dtype),
+                                   neighborhood_selections)
+
+    unit_metrics = (values for neighborhood in neighborhood_metrics for values in neighborhood)
+
+    try:
+        for idx, (cluster_id, num_pcs, values) in enumerate(unit_metrics):
+
+            printProgressBar(idx + 1, len(cluster_ids))
+
+            num_pcs_str = 'cluster_id: ' + repr(cluster_id) + '; num pcs: ' + repr(num_pcs)
+            print(num_pcs_str)
+
+            if values is not None:
+
+                isolation_distances[cluster_id], l_ratios[cluster_id], d_primes[cluster_id], \
+                    nn_hit_rates[cluster_id], nn_miss_rates[cluster_id] = values
+
+            else:
+
+                isolation_distances[cluster_id] = np.nan
+                d_primes[cluster_id] = np.nan
+                nn_hit_rates[cluster_id] = np.nan
+                nn_miss_rates[cluster_id] = np.nan
+
+    finally:
+        if use_pool:
+            if own_pool:
+                pool.close()
+                pool.join()
+            shared_pc_features.release()
+
+    return isolation_distances, l_ratios, d_primes, nn_hit_rates, nn_miss_rates 
 
-        printProgressBar(idx + 1, len(cluster_ids))
 
-        peak_channel = peak_channels[cluster_id]
+def select_pcs_for_unit(cluster_id, peak_channels, pc_feature_ind, half_spread, max_spikes_for_cluster, cluster_index,
+                        unit_shanks = None, unit_spike_counts = None):
 
-        half_spread_down = peak_channel \
-            if peak_channel < half_spread \
-            else half_spread
+    """ Choose the spikes and channels of this unit and its neighbors used for the PC-based metrics
 
-        half_spread_up = np.max(pc_feature_ind) - peak_channel \
-            if peak_channel + half_spread > np.max(pc_feature_ind) \
-            else half_spread
+    Inputs:
+    -------
+    unit_shanks : numpy.ndarray (num_units x 0) (optional)
+        Shank of each unit; only units on the same shank are compared
+    unit_spike_counts : numpy.ndarray (num_units x 0) (optional)
+        Total number of spikes of each unit, if cluster_index only holds a sample of
+        them (e.g. in streaming mode); units are drawn in proportion to these counts
+
+    Outputs:
+    --------
+    cluster_id : Int
+        ID for this unit
+    selections : list of (Int, numpy.ndarray, numpy.ndarray)
+        Unit ID, spike indices and channel indices for each unit on the same channels
+    num_channels : Int
+        Number of channels used
+    all_spikes : Bool
+        True if every spike of every unit is selected (then units with the same peak channel
+        have identical selections)
+
+    """
+
+    peak_channel = peak_channels[cluster_id]
+
+    half_spread_down = peak_channel \
+        if peak_channel < half_spread \
+        else half_spread
+
+    half_spread_up = np.max(pc_feature_ind) - peak_channel \
+        if peak_channel + half_spread > np.max(pc_feature_ind) \
+        else half_spread
+
+    units_for_channel, channel_index = np.unravel_index(np.where(pc_feature_ind.flatten() == peak_channel)[0], pc_feature_ind.shape)
+    
+    units_in_range = (peak_channels[units_for_channel] >= peak_channel - half_spread_down) * \
+                     (peak_channels[units_for_channel] <= peak_channel + half_spread_up)
+
+    if unit_shanks is not None:
+        units_in_range *= unit_shanks[units_for_channel] == unit_shanks[cluster_id]
+    
+    units_for_channel = units_for_channel[units_in_range]
+    channel_index = channel_index[units_in_range]
 
-        units_for_channel, channel_index = np.unravel_index(np.where(pc_feature_ind.flatten() == peak_channel)[0], pc_feature_ind.shape)
+    channels_to_use = np.arange(peak_channel - half_spread_down, peak_channel + half_spread_up + 1)
+
+    sample_counts = np.array([cluster_index.count(cluster_id2) for cluster_id2 in units_for_channel], dtype='float64')
+
+    if unit_spike_counts is None:
+        spike_counts = sample_counts
+    else:
+        spike_counts = np.asarray(unit_spike_counts, dtype='float64')[units_for_channel]
         
-        units_in_range = (peak_channels[units_for_channel] >= peak_channel - half_spread_down) * \
-                         (peak_channels[units_for_channel] <= peak_channel + half_spread_up)
+    this_unit_idx = np.where(units_for_channel == cluster_id)[0]
+
+    if spike_counts[this_unit_idx] > max_spikes_for_cluster:
+        relative_counts = spike_counts / spike_counts[this_unit_idx] * max_spikes_for_cluster
+    else:
+        relative_counts = spike_counts
+
+    relative_counts = fit_counts_to_sample(relative_counts, sample_counts)
+
+    selections = []
         
-        units_for_channel = units_for_channel[units_in_range]
-        channel_index = channel_index[units_in_range]
+    for idx2, cluster_id2 in enumerate(units_for_channel):
+
+        try:
+            channel_mask = make_channel_mask(cluster_id2, pc_feature_ind, channels_to_use)
+        except IndexError:
+            # Occurs when pc_feature_ind does not contain all channels of interest
+            # In that case, we will exclude this unit for the calculation
+            pass
+        else:
+            subsample = int(relative_counts[idx2])
+            index_mask = make_index_subset(cluster_index, cluster_id2, min_num = 0, max_num = subsample)
+            selections.append((cluster_id2, index_mask, channel_mask))
 
-        channels_to_use = np.arange(peak_channel - half_spread_down, peak_channel + half_spread_up + 1)
+    all_spikes = all(index_mask.size == cluster_index.count(cluster_id2) for cluster_id2, index_mask, channel_mask in selections)
 
-        spike_counts = np.zeros(units_for_channel.shape)
+    return cluster_id, selections, channels_to_use.size, all_spikes
 
-        for idx2, cluster_id2 in enumerate(units_for_channel):
-            spike_counts[idx2] = np.sum(spike_clusters == cluster_id2)
-            
-        this_unit_idx = np.where(units_for_channel == cluster_id)[0]
 
-        if spike_counts[this_unit_idx] > max_spikes_for_cluster:
-            relative_counts = spike_counts / spike_counts[this_unit_idx] * max_spikes_for_cluster
-        else:
-            relative_counts = spike_counts
-            
-        all_pcs = np.zeros((0, pc_features.shape[1], channels_to_use.size))
-        all_labels = np.zeros((0,))
-            
-        for idx2, cluster_id2 in enumerate(units_for_channel):
+def fit_counts_to_sample(counts, sample_counts):
 
-            try:
-                channel_mask = make_channel_mask(cluster_id2, pc_feature_ind, channels_to_use)
-            except IndexError:
-                # Occurs when pc_feature_ind does not contain all channels of interest
-                # In that case, we will exclude this unit for the calculation
-                pass
-            else:
-                subsample = int(relative_counts[idx2])
-                index_mask = make_index_mask(spike_clusters, cluster_id2, min_num = 0, max_num = subsample)
-                pcs = get_unit_pcs(pc_features, index_mask, channel_mask)
-                labels = np.ones((pcs.shape[0],)) * cluster_id2
-                
-                all_pcs = np.concatenate((all_pcs, pcs),0)
-                all_labels = np.concatenate((all_labels, labels),0)
-            
-        all_pcs = np.reshape(all_pcs, (all_pcs.shape[0], pc_features.shape[1]*channels_to_use.size))
+    """ Scales the numbers of spikes to draw from each unit so that none needs more spikes than it has,
+    keeping their proportions (this only changes anything if the spikes are a sample, as in streaming mode)
+
+    Inputs:
+    -------
+    counts : numpy.ndarray (num_units x 0)
+        Number of spikes to draw from each unit
+    sample_counts : numpy.ndarray (num_units x 0)
+        Number of spikes available for each unit
+
+    Outputs:
+    --------
+    counts : numpy.ndarray (num_units x 0)
+
+    """
+
+    needed = counts > sample_counts
+
+    if not np.any(needed):
+        return counts
+
+    limiting = np.flatnonzero(needed)[np.argmin(sample_counts[needed] / counts[needed])]
+
+    return np.minimum(counts * sample_counts[limiting] / counts[limiting], sample_counts)
+
+
+def pc_metrics_for_neighborhood(pc_features, max_spikes_for_nn, n_neighbors, dtype, unit_selections):
+
+    """ Computes the PC-based metrics for all units with the same peak channel
+
+    Units whose selections contain every spike of their neighbors (see select_pcs_for_unit) use
+    the same spikes, so one ball tree is built for them and its nearest neighbors are shared
+
+    Inputs:
+    -------
+    pc_features : numpy.ndarray (num_spikes x num_pcs x num_channels)
+        Pre-computed PCs for blocks of channels around each spike
+    max_spikes_for_nn : Int
+        Number of spikes to use for NearestNeighbor calculation
+    n_neighbors : Int
+        Number of neighbors to use for NearestNeighbor calculation
+    dtype : String or numpy.dtype
+        Floating point type for the PCs ('float32' or 'float64')
+    unit_selections : list of tuples
+        Output of select_pcs_for_unit for each unit
+
+    Outputs:
+    --------
+    unit_metrics : list of tuples
+        Output of pc_metrics_for_unit for each unit
+
+    """
+
+    shared_neighbors = {}
+
+    return [pc_metrics_for_unit(pc_features, max_spikes_for_nn, n_neighbors, dtype, unit_selection, shared_neighbors)
+            for unit_selection in unit_selections]
+
+
+def pc_metrics_for_unit(pc_features, max_spikes_for_nn, n_neighbors, dtype, unit_selection, shared_neighbors = None):
+
+    """ Computes isolation distance, L-ratio, d-prime and nearest-neighbor metrics for one unit
+
+    Inputs:
+    -------
+    pc_features : numpy.ndarray (num_spikes x num_pcs x num_channels)
+        Pre-computed PCs for blocks of channels around each spike
+    max_spikes_for_nn : Int
+        Number of spikes to use for NearestNeighbor calculation
+    n_neighbors : Int
+        Number of neighbors to use for NearestNeighbor calculation
+    dtype : String or numpy.dtype
+        Floating point type for the PCs ('float32' or 'float64')
+    unit_selection : tuple
+        Output of select_pcs_for_unit
+    shared_neighbors : dict (optional)
+        Nearest neighbors of the selections that contain all spikes, shared by the units
+        with the same peak channel; updated in place
+
+    Outputs:
+    --------
+    cluster_id : Int
+        ID for this unit
+    num_pcs : Int
+        Number of spikes used for the calculation
+    values : tuple or None
+        (isolation_distance, l_ratio, d_prime, nn_hit_rate, nn_miss_rate), or None if too few spikes
+        or no neighboring units
+
+    """
+
+    cluster_id, selections, num_channels, all_spikes = unit_selection
+
+    spike_counts = [index_mask.size for cluster_id2, index_mask, channel_mask in selections]
+    bounds = np.concatenate(([0], np.cumsum(spike_counts))).astype('int64')
+
+    all_pcs = np.empty((bounds[-1], pc_features.shape[1], num_channels), dtype=dtype)
+    all_labels = np.repeat(np.array([cluster_id2 for cluster_id2, index_mask, channel_mask in selections], dtype='float64'),
+                           spike_counts)
+
+    for idx, (cluster_id2, index_mask, channel_mask) in enumerate(selections):
+
+        all_pcs[bounds[idx]:bounds[idx + 1]] = get_unit_pcs(pc_features, index_mask, channel_mask)
         
-        num_pcs = all_pcs.shape[0];
-        num_pcs_str = 'cluster_id: ' + repr(cluster_id) + '; num pcs: ' + repr(num_pcs)
-        print(num_pcs_str)
+    all_pcs = np.reshape(all_pcs, (all_pcs.shape[0], pc_features.shape[1]*num_channels))
+    
+    num_pcs = all_pcs.shape[0]
 
-        if all_pcs.shape[0] > 10:
+    if num_pcs <= 10 or np.unique(all_labels).size < 2: # too few spikes, or no other units to compare with
+        return cluster_id, num_pcs, None
 
-            isolation_distances[cluster_id], l_ratios[cluster_id] = mahalanobis_metrics(all_pcs, all_labels, cluster_id)
+    isolation_distance, l_ratio = mahalanobis_metrics(all_pcs, all_labels, cluster_id)
 
-            d_primes[cluster_id] = lda_metrics(all_pcs, all_labels, cluster_id)
+    d_prime = lda_metrics(all_pcs, all_labels, cluster_id)
 
-            nn_hit_rates[cluster_id], nn_miss_rates[cluster_id] = nearest_neighbors_metrics(all_pcs, all_labels, cluster_id, max_spikes_for_nn, n_neighbors)
+    if all_spikes and num_pcs <= max_spikes_for_nn and shared_neighbors is not None:
+        # no subsampling, so the result only depends on the (shared) spikes, not on which unit is measured
+        if 'indices' not in shared_neighbors:
+            shared_neighbors['indices'] = nearest_neighbor_indices(all_pcs, n_neighbors)
+        nn_hit_rate, nn_miss_rate = neighborhood_hit_miss_rates(all_labels, shared_neighbors['indices'], cluster_id)
+    else:
+        nn_hit_rate, nn_miss_rate = nearest_neighbors_metrics(all_pcs, all_labels, cluster_id, max_spikes_for_nn, n_neighbors)
 
-        else:
+    return cluster_id, num_pcs, (isolation_distance, l_ratio, d_prime, nn_hit_rate, nn_miss_rate)
 
-            isolation_distances[cluster_id] = np.nan
-            d_primes[cluster_id] = np.nan
-            nn_hit_rates[cluster_id] = np.nan
-            nn_miss_rates[cluster_id] = np.nan
 
+# pc_features of the most recently used probes in the current worker process
+worker_probes = LRUCache(4)
 
-    return isolation_distances, l_ratios, d_primes, nn_hit_rates, nn_miss_rates 
+
+def pc_metrics_for_shared_neighborhood(shared_pc_features, max_spikes_for_nn, n_neighbors, dtype, unit_selections):
+
+    """ Calculates PC-based metrics for one neighborhood in a worker process (see pc_metrics_for_neighborhood)
+
+    Workers may be shared between probes, so pc_features are attached the first time
+    each SharedArray is seen (the SharedArray is kept so its memory stays mapped)
+
+    """
+
+    def attach():
+        return shared_pc_features, shared_pc_features.attach()
+
+    _, pc_features = worker_probes.get(shared_pc_features.key, attach)
+
+    return pc_metrics_for_neighborhood(pc_features, max_spikes_for_nn, n_neighbors, dtype, unit_selections)
+
+
+def nearest_neighbor_indices(all_pcs, n_neighbors):
+
+    """ Builds one ball tree for a set of spikes and finds the nearest neighbors of every spike
+
+    Inputs:
+    -------
+    all_pcs : numpy.ndarray (num_spikes x PCs)
+        2D array of PCs for all spikes
+    n_neighbors : Int
+        Number of neighbors to use (including the spike itself)
+
+    Outputs:
+    --------
+    indices : numpy.ndarray (num_spikes x n_neighbors)
+        Indices of the nearest spikes (the first column is the spike itself)
+
+    """
+
+    nbrs = NearestNeighbors(n_neighbors=np.min([n_neighbors, all_pcs.shape[0]]), algorithm='ball_tree').fit(all_pcs)
+    distances, indices = nbrs.kneighbors(all_pcs)
+
+    return indices
+
+
+def neighborhood_hit_miss_rates(labels, indices, this_unit_id):
+
+    """ Calculates the nearest-neighbor hit and miss rates of one unit from the neighbors of all spikes
+
+    Same as nearest_neighbors_metrics (without subsampling), for neighbors that are shared between units
+
+    Inputs:
+    -------
+    labels : numpy.ndarray (num_spikes x 0)
+        Cluster ID of each spike
+    indices : numpy.ndarray (num_spikes x n_neighbors)
+        Output of nearest_neighbor_indices
+    this_unit_id : Int
+        number corresponding to unit for which these metrics will be calculated
+
+    Outputs:
+    --------
+    hit_rate : float
+        Fraction of neighbors for target cluster that are also in target cluster
+    miss_rate : float
+        Fraction of neighbors outside target cluster that are in target cluster
+
+    """
+
+    this_unit = labels == this_unit_id
+    neighbor_in_unit = this_unit[indices[:, 1:]]
+
+    hit_rate = np.mean(neighbor_in_unit[this_unit, :]) if np.any(this_unit) else np.nan
+    miss_rate = np.mean(neighbor_in_unit[np.invert(this_unit), :]) if not np.all(this_unit) else np.nan
+
+    return hit_rate, miss_rate
 
 
 def calculate_silhouette_score(spike_clusters, 
                                  total_units,
                                  pc_features, 
                                  pc_feature_ind,
-                                 total_spikes):
+                                 total_spikes,
+                                 neighbors_only = False,
+                                 cluster_ids = None,
+                                 dtype = 'float64',
+                                 spike_rows = None):
 
     random_spike_inds = np.random.permutation(spike_clusters.size)
-    random_spike_inds = random_spike_inds[:total_spikes]
-    num_pc_features = pc_features.shape[1]
+    random_spike_inds = np.sort(random_spike_inds[:total_spikes]) # read pc_features in order
 
-    all_pcs = np.zeros((total_spikes, np.max(pc_feature_ind) * num_pc_features + 1))
+    # rows of pc_features for the sampled spikes, if these are not the first spike_clusters.size rows
+    pc_rows = random_spike_inds if spike_rows is None else spike_rows[random_spike_inds]
+    num_pc_features = pc_features.shape[1]
+    max_channel = np.max(pc_feature_ind)
 
-    for idx, i in enumerate(random_spike_inds):
-        
-        unit_id = spike_clusters[i]
-        channels = pc_feature_ind[unit_id,:]
-        
-        for j in range(0,num_pc_features):
-            all_pcs[idx, channels + np.max(pc_feature_ind) * j] = pc_features[i,j,:]
+    all_pcs = np.zeros((total_spikes, max_channel * num_pc_features + 1), dtype=dtype)
 
     cluster_labels = spike_clusters[random_spike_inds]
 
-    cluster_ids = np.unique(cluster_labels)
+    # column for each (spike, PC, channel) entry is channel + max_channel * PC
+    columns = pc_feature_ind[cluster_labels, np.newaxis, :].astype('int64') + \
+              max_channel * np.arange(num_pc_features)[np.newaxis, :, np.newaxis]
+    rows = np.arange(total_spikes)[:, np.newaxis, np.newaxis]
 
-    SS = np.empty((total_units, total_units))
-    SS[:] = np.nan
+    all_pcs[rows, columns] = pc_features[pc_rows, :, :]
 
-    for idx1, i in enumerate(cluster_ids):
+    sampled_ids = np.unique(cluster_labels)
 
-        printProgressBar(idx1+1, len(cluster_ids))
-        
-        for idx2, j in enumerate(cluster_ids):
-            
-            if j > i:
-                inds = np.in1d(cluster_labels, np.array([i,j]))
-                X = all_pcs[inds,:]
-                labels = cluster_labels[inds]
-                
-                if len(labels) > 2:
-                    SS[i,j] = silhouette_score(X, labels)
+    if neighbors_only:
+        neighbors = find_channel_neighbors(pc_feature_ind[sampled_ids, :])
+    else:
+        neighbors = None
+
+    if cluster_ids is not None:
+        # only compare pairs that include at least one of the selected units
+        selected = np.isin(sampled_ids, cluster_ids)
+        pairs = sparse.csr_matrix(np.logical_or.outer(selected, selected))
+        neighbors = pairs if neighbors is None else neighbors.multiply(pairs)
+
+    sampled_ids, pair_scores = pairwise_silhouette_scores(all_pcs, cluster_labels, neighbors)
+
+    SS = sparse.coo_matrix((pair_scores.data, (sampled_ids[pair_scores.row], sampled_ids[pair_scores.col])),
+                           shape=(total_units, total_units))
+
+    # worst (lowest) score over all pairs that include each unit
+    unit_scores = np.empty((total_units,))
+    unit_scores[:] = np.nan
+
+    np.fmin.at(unit_scores, SS.row, SS.data)
+    np.fmin.at(unit_scores, SS.col, SS.data)
+
+    if cluster_ids is not None:
+        # scores of the other units are missing the pairs that were skipped
+        unit_scores[~np.isin(np.arange(total_units), cluster_ids)] = np.nan
+
+    return unit_scores
+
+
+def pairwise_silhouette_scores(all_pcs, cluster_labels, neighbors = None, max_distances_per_chunk = 4000000):
+
+    """ Calculates the silhouette score for pairs of clusters from one pass over the pairwise distances
+
+    For each spike, the summed distance to all spikes in every compared cluster is computed once;
+    the score for a pair of clusters (same as sklearn.metrics.silhouette_score on the
+    spikes of those two clusters) is then derived from these sums
+
+    Inputs:
+    -------
+    all_pcs : numpy.ndarray (num_spikes x PCs)
+        2D array of PCs for all spikes
+    cluster_labels : numpy.ndarray (num_spikes x 0)
+        1D array of cluster labels for all spikes
+    neighbors : numpy.ndarray or scipy.sparse matrix (num_clusters x num_clusters) (optional)
+        Nonzero for pairs of clusters (in order of cluster ID) to compare; default is all pairs
+    max_distances_per_chunk : Int
+        Maximum number of pairwise distances to hold in memory at once
+
+    Outputs:
+    --------
+    cluster_ids : numpy.ndarray (num_clusters x 0)
+        Sorted IDs of all clusters
+    pair_scores : scipy.sparse.coo_matrix (num_clusters x num_clusters)
+        Silhouette score for each compared pair of clusters i < j
+
+    """
+
+    cluster_ids, labels, counts = np.unique(cluster_labels, return_inverse=True, return_counts=True)
+    num_clusters = cluster_ids.size
+
+    order = np.argsort(labels, kind='stable')
+    X = all_pcs[order, :]
+    bounds = np.concatenate(([0], np.cumsum(counts)))
+
+    squared_norms = np.einsum('ij,ij->i', X, X)[np.newaxis, :]
+
+    if neighbors is not None:
+        neighbors = sparse.csr_matrix(neighbors, dtype='bool')
+        neighbors = (neighbors + neighbors.T + sparse.identity(num_clusters, dtype='bool', format='csr')).tocsr()
+        neighbors.sort_indices()
+
+    sum_rows = []
+    sum_cols = []
+    sum_values = []
+
+    for i in range(num_clusters):
+
+        printProgressBar(i + 1, num_clusters)
+
+        if neighbors is None:
+            targets = np.arange(num_clusters)
+            columns = slice(None)
+        else:
+            targets = neighbors.indices[neighbors.indptr[i]:neighbors.indptr[i + 1]]
+            columns = np.concatenate([np.arange(bounds[j], bounds[j + 1]) for j in targets])
+
+        X_targets = X[columns, :]
+        target_norms = squared_norms[:, columns]
+        target_offsets = np.concatenate(([0], np.cumsum(counts[targets])[:-1]))
+
+        num_rows = counts[i]
+        chunk_size = int(np.max([1, max_distances_per_chunk // X_targets.shape[0]]))
+
+        distance_sums = np.zeros((num_rows, targets.size))
+
+        for start in range(0, num_rows, chunk_size):
+
+            rows = slice(bounds[i] + start, bounds[i] + np.min([start + chunk_size, num_rows]))
+            distances = euclidean_distances(X[rows, :], X_targets, Y_norm_squared = target_norms)
+            distance_sums[start:start + chunk_size, :] = np.add.reduceat(distances, target_offsets, axis=1)
 
-    with warnings.catch_warnings():
-      warnings.simplefilter("ignore")
-      a = np.nanmin(SS, 0)
-      b = np.nanmin(SS, 1)
+        # mean distance to the spike's own cluster (a) and to each other cluster (b)
+        intra = distance_sums[:, np.searchsorted(targets, i)] / np.max([num_rows - 1, 1])
+        inter = distance_sums / counts[np.newaxis, targets]
 
-    return np.array([np.nanmin([a,b]) for a, b in zip(a,b)])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sample_scores = (inter - intra[:, np.newaxis]) / np.maximum(intra[:, np.newaxis], inter)
+
+        if num_rows == 1:
+            sample_scores[:] = 0
+
+        # summed scores of the spikes of cluster i when compared against each target cluster
+        sum_rows.append(np.full(targets.shape, i))
+        sum_cols.append(targets)
+        sum_values.append(np.sum(np.nan_to_num(sample_scores), 0))
+
+    sum_rows = np.concatenate(sum_rows)
+    sum_cols = np.concatenate(sum_cols)
+    sum_values = np.concatenate(sum_values)
+
+    # combine the sums for (i, j) and (j, i); every compared pair is present in both orders
+    keys = sum_rows * num_clusters + sum_cols
+    upper = (sum_rows < sum_cols) & (counts[sum_rows] + counts[sum_cols] > 2)
+
+    pair_rows = sum_rows[upper]
+    pair_cols = sum_cols[upper]
+    reverse = np.searchsorted(keys, pair_cols * num_clusters + pair_rows)
+
+    pair_values = (sum_values[upper] + sum_values[reverse]) / (counts[pair_rows] + counts[pair_cols])
+
+    return cluster_ids, sparse.coo_matrix((pair_values, (pair_rows, pair_cols)), shape=(num_clusters, num_clusters))
+
+
+def find_channel_neighbors(pc_feature_ind):
+
+    """ Finds pairs of units whose PC channels overlap
+
+    Inputs:
+    -------
+    pc_feature_ind : numpy.ndarray (num_units x num_channels)
+        Channel indices of PCs for each unit
+
+    Outputs:
+    --------
+    neighbors : scipy.sparse.csr_matrix (num_units x num_units)
+        True for each pair of units with at least one channel in common
+
+    """
+
+    num_units, num_channels = pc_feature_ind.shape
+
+    unit_channels = sparse.csr_matrix((np.ones((pc_feature_ind.size,), dtype='int32'),
+                                       (np.repeat(np.arange(num_units), num_channels), pc_feature_ind.flatten())),
+                                      shape=(num_units, np.max(pc_feature_ind) + 1))
+
+    return (unit_channels @ unit_channels.T) > 0
 
 
 def calculate_drift_metrics(spike_times,
@@ -373,45 +952,125 @@ def calculate_drift_metrics(spike_times,
                             pc_feature_ind,
                             channel_pos,
                             interval_length,
-                            min_spikes_per_interval):
+                            min_spikes_per_interval,
+                            cluster_index = None,
+                            cluster_ids = None,
+                            spike_rows = None):
+
+    if cluster_index is None:
+        cluster_index = ClusterIndex(spike_clusters, total_units)
 
     max_drift = np.zeros((total_units,))
     cumulative_drift = np.zeros((total_units,))
 
+    if spike_rows is not None:
+        # only the first PC is used for depths, so only that one is gathered
+        pc_features = pc_features[:, :1, :][spike_rows]
+
     depths = get_spike_depths(spike_clusters, pc_features, pc_feature_ind, channel_pos)
     
     interval_starts = np.arange(np.min(spike_times), np.max(spike_times), interval_length)
     interval_ends = interval_starts + interval_length
 
-    cluster_ids = np.unique(spike_clusters)
+    cluster_ids = cluster_index.select(cluster_ids)
 
-    for idx, cluster_id in enumerate(cluster_ids):
+    median_depths = median_depths_by_interval(spike_times,
+                                              spike_clusters,
+                                              depths,
+                                              interval_starts,
+                                              interval_ends,
+                                              min_spikes_per_interval,
+                                              total_units)[cluster_ids, :]
 
-        printProgressBar(idx+1, len(cluster_ids))
+    max_drift[cluster_ids], cumulative_drift[cluster_ids] = drift_from_median_depths(median_depths)
 
-        in_cluster = spike_clusters == cluster_id
-        times_for_cluster = spike_times[in_cluster]
-        depths_for_cluster = depths[in_cluster]
+    return max_drift, cumulative_drift
 
-        median_depths = []
 
-        for t1, t2 in zip(interval_starts, interval_ends):
+def drift_from_median_depths(median_depths):
 
-            in_range = (times_for_cluster > t1) * (times_for_cluster < t2)
-            
-            if np.sum(in_range) >= min_spikes_per_interval:
-                median_depths.append(np.median(depths_for_cluster[in_range]))
-            else:
-                median_depths.append(np.nan)
-            
-        median_depths = np.array(median_depths)
-            
-        max_drift[cluster_id] = np.around(np.nanmax(median_depths) - np.nanmin(median_depths),2)
-        cumulative_drift[cluster_id] = np.around(np.nansum(np.abs(np.diff(median_depths))),2)
+    """ Maximum and cumulative drift (in um) of each unit from its median depth in each interval """
+
+    max_drift = np.around(np.nanmax(median_depths, 1) - np.nanmin(median_depths, 1),2)
+    cumulative_drift = np.around(np.nansum(np.abs(np.diff(median_depths, axis=1)), 1),2)
 
     return max_drift, cumulative_drift
 
 
+def median_depths_by_interval(spike_times,
+                              spike_clusters,
+                              depths,
+                              interval_starts,
+                              interval_ends,
+                              min_spikes_per_interval,
+                              total_units):
+
+    """ Calculates the median spike depth of every unit in every time interval in one grouped pass
+
+    Spikes are sorted once by (cluster, interval, depth), so the median of each
+    group can be read directly from its middle element(s)
+
+    Inputs:
+    -------
+    spike_times : numpy.ndarray (num_spikes x 0)
+        Spike times in seconds
+    spike_clusters : numpy.ndarray (num_spikes x 0)
+        Cluster IDs for each spike time
+    depths : numpy.ndarray (num_spikes x 0)
+        Depth of each spike in um
+    interval_starts : numpy.ndarray (num_intervals x 0)
+        Start time of each interval (spikes must be later than this)
+    interval_ends : numpy.ndarray (num_intervals x 0)
+        End time of each interval (spikes must be earlier than this)
+    min_spikes_per_interval : Int
+        Minimum number of spikes for computing a median
+    total_units : Int
+        Number of rows in the output
+
+    Outputs:
+    --------
+    median_depths : numpy.ndarray (total_units x num_intervals)
+        Median depth for each unit and interval (NaN if too few spikes)
+
+    """
+
+    num_intervals = interval_starts.size
+
+    median_depths = np.empty((total_units, num_intervals))
+    median_depths[:] = np.nan
+
+    interval = np.searchsorted(interval_starts, spike_times, side='left') - 1
+    in_range = (interval >= 0)
+    in_range[in_range] = spike_times[in_range] < interval_ends[interval[in_range]]
+
+    clusters = spike_clusters[in_range].astype('int64')
+    interval = interval[in_range]
+    depths = depths[in_range]
+
+    order = np.lexsort((depths, interval, clusters))
+    group_keys = (clusters * num_intervals + interval)[order]
+    depths = depths[order]
+
+    group_starts = np.flatnonzero(np.diff(group_keys, prepend=-1))
+    group_counts = np.diff(np.append(group_starts, group_keys.size))
+
+    enough = group_counts >= min_spikes_per_interval
+    group_starts = group_starts[enough]
+    group_counts = group_counts[enough]
+
+    lower = group_starts + (group_counts - 1) // 2
+    upper = group_starts + group_counts // 2
+    medians = (depths[lower] + depths[upper]) / 2
+
+    # NaN depths sort last; np.median would return NaN for these groups
+    medians[np.isnan(depths[group_starts + group_counts - 1])] = np.nan
+
+    group_keys = group_keys[group_starts]
+    median_depths[group_keys // num_intervals, group_keys % num_intervals] = medians
+
+    return median_depths
+
+
 # ==========================================================
 
 # IMPLEMENTATION OF ACTUAL METRICS:
@@ -480,6 +1139,85 @@ def presence_ratio(spike_train, min_time, max_time, num_bins=100):
     return np.sum(h > 0) / num_bins
 
 
+def grouped_isi_violations(spike_times, groups, num_groups, min_time, max_time, isi_threshold, min_isi=0):
+
+    """Calculate ISI violations for many spike trains at once (see isi_violations)
+
+    Inputs:
+    -------
+    spike_times : array of spike times, grouped by spike train (each train in time order)
+    groups : spike train (0 to num_groups - 1) for each spike, in non-decreasing order
+    num_groups : number of spike trains
+    min_time : minimum time for potential spikes
+    max_time : maximum time for potential spikes
+    isi_threshold : threshold for isi violation
+    min_isi : threshold for duplicate spikes
+
+    Outputs:
+    --------
+    fpRate : rate of contaminating spikes as a fraction of overall rate, for each spike train
+    num_violations : total number of violations for each spike train
+
+    """
+
+    same_train = groups[1:] == groups[:-1]
+
+    # a spike is a duplicate if it follows the previous spike of the same train within min_isi
+    duplicate = np.zeros(spike_times.shape, dtype=bool)
+    duplicate[1:] = same_train & (np.diff(spike_times) <= min_isi)
+
+    spike_times = spike_times[~duplicate]
+    groups = groups[~duplicate]
+
+    isis = np.diff(spike_times)
+    violation = (groups[1:] == groups[:-1]) & (isis < isi_threshold)
+
+    num_spikes = np.bincount(groups, minlength=num_groups)
+    num_violations = np.bincount(groups[1:][violation], minlength=num_groups)
+
+    violation_time = 2*num_spikes*(isi_threshold - min_isi)
+    total_rate = num_spikes / (max_time - min_time)
+    violation_rate = num_violations/violation_time
+    fpRate = violation_rate/total_rate
+
+    return fpRate, num_violations
+
+
+def grouped_presence_ratios(spike_times, groups, num_groups, min_time, max_time, num_bins=100):
+
+    """Calculate presence ratios for many spike trains at once (see presence_ratio)
+
+    Inputs:
+    -------
+    spike_times : array of spike times
+    groups : spike train (0 to num_groups - 1) for each spike
+    num_groups : number of spike trains
+    min_time : minimum time for potential spikes
+    max_time : maximum time for potential spikes
+
+    Outputs:
+    --------
+    presence_ratio : fraction of time bins in which each spike train is spiking
+
+    """
+
+    bin_edges = np.linspace(min_time, max_time, num_bins)
+    num_histogram_bins = bin_edges.size - 1
+
+    # same bins as np.histogram (the last bin includes its right edge)
+    in_range = (spike_times >= bin_edges[0]) & (spike_times <= bin_edges[-1])
+    spike_times = spike_times[in_range]
+    groups = groups[in_range]
+
+    indices = np.searchsorted(bin_edges, spike_times, side='right') - 1
+    indices[indices == num_histogram_bins] -= 1
+
+    counts = np.bincount(groups * num_histogram_bins + indices, minlength=num_groups * num_histogram_bins)
+    counts = np.reshape(counts, (num_groups, num_histogram_bins))
+
+    return np.sum(counts > 0, 1) / num_bins
+
+
 def firing_rate(spike_train, min_time = None, max_time = None):
     """Calculate firing rate for a spike train.
 
@@ -534,6 +1272,27 @@ def amplitude_cutoff(amplitudes, num_histogram_bins = 500, histogram_smoothing_v
 
 
     h,b = np.histogram(amplitudes, num_histogram_bins, density=True)
+
+    return amplitude_cutoff_from_histogram(h, b, histogram_smoothing_value)
+
+
+def amplitude_cutoff_from_histogram(h, b, histogram_smoothing_value = 3):
+
+    """ Calculate the amplitude cutoff from a normalized amplitude histogram (see amplitude_cutoff)
+
+    Input:
+    ------
+    h : numpy.ndarray
+        Amplitude histogram (probability density)
+    b : numpy.ndarray
+        Bin edges of the histogram
+
+    Output:
+    -------
+    fraction_missing : float
+        Fraction of missing spikes (0-0.5)
+
+    """
     
     pdf = gaussian_filter1d(h,histogram_smoothing_value)
     support = b[:-1]
@@ -549,6 +1308,112 @@ def amplitude_cutoff(amplitudes, num_histogram_bins = 500, histogram_smoothing_v
     return fraction_missing
 
 
+def amplitude_histogram_edges(min_amplitude, max_amplitude, num_histogram_bins = 500):
+
+    """ Bin edges of one amplitude histogram per unit, the same as those used by np.histogram
+
+    Input:
+    ------
+    min_amplitude, max_amplitude : numpy.ndarray (num_units x 0)
+        Range of amplitudes of each unit (non-finite for units without spikes)
+    num_histogram_bins : Int
+        Number of bins per histogram
+
+    Output:
+    -------
+    bin_edges : numpy.ndarray (num_units x num_histogram_bins + 1)
+        Bin edges for each unit
+
+    """
+
+    first_edge = np.array(min_amplitude, dtype='float64')
+    last_edge = np.array(max_amplitude, dtype='float64')
+
+    # np.histogram widens empty ranges by 0.5 on each side
+    empty_range = first_edge == last_edge
+    first_edge[empty_range] -= 0.5
+    last_edge[empty_range] += 0.5
+
+    first_edge[~np.isfinite(first_edge)] = 0
+    last_edge[~np.isfinite(last_edge)] = 1
+
+    return np.linspace(first_edge, last_edge, num_histogram_bins + 1, axis=1)
+
+
+def amplitude_histogram_indices(values, rows, bin_edges):
+
+    """ Histogram bin of each amplitude, assigned in the same way as np.histogram
+
+    Input:
+    ------
+    values : numpy.ndarray (num_spikes x 0)
+        Amplitude of each spike
+    rows : numpy.ndarray (num_spikes x 0)
+        Row of bin_edges (unit) for each spike
+    bin_edges : numpy.ndarray (num_units x num_bins + 1)
+        Output of amplitude_histogram_edges
+
+    Output:
+    -------
+    indices : numpy.ndarray (num_spikes x 0)
+        Bin index (0 to num_bins - 1) of each spike
+
+    """
+
+    num_histogram_bins = bin_edges.shape[1] - 1
+    first_edge = bin_edges[rows, 0]
+    norm = num_histogram_bins / (bin_edges[rows, -1] - first_edge)
+
+    indices = ((values - first_edge) * norm).astype(np.intp)
+    indices[indices == num_histogram_bins] -= 1
+
+    # correct for rounding errors at the bin edges
+    decrement = values < bin_edges[rows, indices]
+    indices[decrement] -= 1
+
+    increment = (values >= bin_edges[rows, indices + 1]) & (indices != num_histogram_bins - 1)
+    indices[increment] += 1
+
+    return indices
+
+
+def amplitude_cutoffs_from_histograms(counts, bin_edges, histogram_smoothing_value = 3):
+
+    """ Calculate the amplitude cutoffs of many units at once (see amplitude_cutoff)
+
+    Input:
+    ------
+    counts : numpy.ndarray (num_units x num_bins)
+        Amplitude histogram of each unit (spike counts)
+    bin_edges : numpy.ndarray (num_units x num_bins + 1)
+        Bin edges of each histogram
+
+    Output:
+    -------
+    fraction_missing : numpy.ndarray (num_units x 0)
+        Fraction of missing spikes for each unit (0-0.5)
+
+    """
+
+    h = counts / np.diff(bin_edges, axis=1) / np.sum(counts, 1, keepdims=True)
+
+    pdf = gaussian_filter1d(h, histogram_smoothing_value, axis=1)
+    support = bin_edges[:, :-1]
+
+    bins = np.arange(pdf.shape[1])[np.newaxis, :]
+
+    peak_index = np.argmax(pdf, 1)[:, np.newaxis]
+
+    distance_to_first_bin = np.abs(pdf - pdf[:, :1])
+    distance_to_first_bin[bins < peak_index] = np.inf
+    G = np.argmin(distance_to_first_bin, 1)[:, np.newaxis]
+
+    bin_size = np.mean(np.diff(support, axis=1), 1)
+    fraction_missing = np.sum(np.where(bins >= G, pdf, 0), 1) * bin_size
+
+    return np.minimum(fraction_missing, 0.5)
+
+
 def mahalanobis_metrics(all_pcs, all_labels, this_unit_id):
 
     """ Calculates isolation distance and L-ratio (metrics computed from Mahalanobis distance)
@@ -573,32 +1438,24 @@ def mahalanobis_metrics(all_pcs, all_labels, this_unit_id):
 
     """
     
-    pcs_for_this_unit = all_pcs[all_labels == this_unit_id,:]
-    pcs_for_other_units = all_pcs[all_labels != this_unit_id, :]
-    
-    mean_value = np.expand_dims(np.mean(pcs_for_this_unit,0),0)
-    
-    try:
-        VI = np.linalg.inv(np.cov(pcs_for_this_unit.T))
-    except np.linalg.linalg.LinAlgError: # case of singular matrix
-        return np.nan, np.nan
+    this_unit = all_labels == this_unit_id
 
-    mahalanobis_other = np.sort(cdist(mean_value,
-                       pcs_for_other_units,
-                       'mahalanobis', VI = VI)[0])
-    
-    mahalanobis_self = np.sort(cdist(mean_value,
-                             pcs_for_this_unit,
-                             'mahalanobis', VI = VI)[0])
+    pcs_for_this_unit = all_pcs[this_unit,:]
+
+    # squared distances of all other spikes (from a single triangular solve)
+    mahalanobis_other = squared_mahalanobis_distances(all_pcs[np.invert(this_unit),:], pcs_for_this_unit)
+
+    if mahalanobis_other is None:
+        return np.nan, np.nan
     
-    n = np.min([pcs_for_this_unit.shape[0], pcs_for_other_units.shape[0]]) # number of spikes
+    n = np.min([pcs_for_this_unit.shape[0], mahalanobis_other.shape[0]]) # number of spikes
 
     if n >= 2:
         
         dof = pcs_for_this_unit.shape[1] # number of features
         
-        l_ratio = np.sum(1 - chi2.cdf(pow(mahalanobis_other,2), dof)) / mahalanobis_other.shape[0]
-        isolation_distance = pow(mahalanobis_other[n-1],2)
+        l_ratio = np.sum(1 - chi2.cdf(mahalanobis_other, dof)) / mahalanobis_other.shape[0]
+        isolation_distance = np.partition(mahalanobis_other, n-1)[n-1]
 
     else:
         l_ratio = np.nan 
@@ -607,6 +1464,54 @@ def mahalanobis_metrics(all_pcs, all_labels, this_unit_id):
     return isolation_distance, l_ratio
 
 
+def squared_mahalanobis_distances(points, samples, regularization = 1e-6):
+
+    """ Calculates squared Mahalanobis distances from a Cholesky factor of the sample covariance
+
+    Inputs:
+    -------
+    points : numpy.ndarray (num_points x num_features)
+        Points for which distances are calculated
+    samples : numpy.ndarray (num_samples x num_features)
+        Samples defining the mean and covariance
+    regularization : Float
+        Relative amount (of the mean variance) added to the diagonal if the covariance is
+        rank-deficient; increased tenfold until the factorization succeeds
+
+    Outputs:
+    --------
+    squared_distances : numpy.ndarray (num_points x 0)
+        Squared distance of each point from the sample mean, or None if the
+        covariance could not be factorized
+
+    """
+
+    covariance = np.atleast_2d(np.cov(samples.T))
+    mean_variance = np.mean(np.diag(covariance))
+
+    if not np.all(np.isfinite(covariance)) or mean_variance <= 0:
+        return None
+
+    try:
+        L = np.linalg.cholesky(covariance)
+    except np.linalg.LinAlgError: # rank-deficient
+        L = None
+        for scale in regularization * np.power(10.0, np.arange(7)):
+            try:
+                L = np.linalg.cholesky(covariance + np.eye(covariance.shape[0]) * scale * mean_variance)
+                break
+            except np.linalg.LinAlgError:
+                pass
+
+        if L is None:
+            return None
+
+    # covariance is factorized in double precision; the solve keeps the precision of the points
+    Z = solve_triangular(L.astype(points.dtype, copy=False), (points - np.mean(samples,0)).T, lower=True, check_finite=False)
+
+    return np.einsum('ij,ij->j', Z, Z)
+
+
 
 
 def lda_metrics(all_pcs, all_labels, this_unit_id):
@@ -748,6 +1653,62 @@ def make_index_mask(spike_clusters, unit_id, min_num, max_num):
     return index_mask
 
 
+def get_epoch_slice(spike_times, epoch):
+
+    """ Find the range of spikes that fall strictly within an epoch
+
+    Inputs:
+    -------
+    spike_times : numpy.ndarray (num_spikes x 0)
+        Sorted spike times in seconds
+    epoch : Epoch
+        Epoch with start and end times in seconds
+
+    Output:
+    -------
+    in_epoch : slice
+        Index range of spikes after epoch.start_time and before epoch.end_time
+
+    """
+
+    start_index = np.searchsorted(spike_times, epoch.start_time, side='right')
+    end_index = np.searchsorted(spike_times, epoch.end_time, side='left')
+
+    return slice(start_index, np.max([start_index, end_index]))
+
+
+def make_index_subset(cluster_index, unit_id, min_num, max_num):
+
+    """ Select spike indices for one unit from a ClusterIndex (same sampling as make_index_mask)
+
+    Inputs:
+    -------
+    cluster_index : ClusterIndex
+        Spike indices grouped by cluster ID
+    unit_id : Int
+        ID for this unit
+    min_num : Int
+        Minimum number of spikes to return; if there are not enough spikes for this unit, return none
+    max_num : Int
+        Maximum number of spikes to return; if too many spikes for this unit, return a random subsample
+
+    Output:
+    -------
+    index_subset : numpy.ndarray (int)
+        Sorted spike indices for pc_features array
+
+    """
+
+    inds = cluster_index.spikes_for(unit_id)
+
+    if len(inds) < min_num:
+        return inds[:0]
+
+    order = np.random.permutation(inds.size)
+
+    return np.sort(inds[order[:max_num]])
+
+
 def make_channel_mask(unit_id, pc_feature_ind, channels_to_use):
 
     """ Create a mask for the channel dimension of the pc_features array  
@@ -782,8 +1743,8 @@ def get_unit_pcs(these_pc_features, index_mask, channel_mask):
     -------
     these_pc_features : numpy.ndarray (float)
         Array of pre-computed PC features (num_spikes x num_PCs x num_channels)
-    index_mask : numpy.ndarray (boolean)
-        Mask for spike index dimension of pc_features array
+    index_mask : numpy.ndarray (boolean or int)
+        Mask or indices for spike index dimension of pc_features array
     channel_mask : numpy.ndarray (boolean)
         Mask for channel index dimension of pc_features array
 
@@ -0,0 +1,84 @@
+from argschema import ArgSchemaParser
+import time
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from functools import partial
+
+import numpy as np
+
+from ...common.profiling import profiled
+
+from .__main__ import calculate_quality_metrics
+
+
+@profiled
+def calculate_quality_metrics_for_probes(args):
+
+    """
+    Calculates quality metrics for several probes, sharing one worker pool
+
+    Each probe is processed in its own thread; the per-unit PC-based metrics of all
+    probes are scheduled on the same processes, so the total run time depends on the
+    total number of units rather than on the slowest probe
+
+    Inputs:
+    -------
+    args : dict
+        Validated MultiProbeInputParameters; quality_metrics_params apply to all probes
+
+    Outputs:
+    --------
+    output : dict
+        'execution_time' and 'quality_metrics_output_files' (one per probe, None if
+        the Kilosort files were not found); if args['profile'] is True, also
+        'probe_profiles' (the profile block of each probe)
+
+    """
+
+    print('ecephys spike sorting: multi-probe quality metrics')
+
+    start = time.time()
+
+    probe_args = [dict(probe, quality_metrics_params=args['quality_metrics_params'], profile=args['profile']) for probe in args['probes']]
+
+    pool = multiprocessing.Pool(np.min([args['num_workers'], multiprocessing.cpu_count()]))
+
+    try:
+        with ThreadPool(len(probe_args)) as threads:
+            outputs = threads.map(partial(calculate_quality_metrics, pool=pool), probe_args)
+    finally:
+        pool.close()
+        pool.join()
+
+    execution_time = time.time() - start
+
+    print('total time for ' + str(len(probe_args)) + ' probes: ' + str(np.around(execution_time,2)) + ' seconds')
+    print()
+
+    output = {"execution_time" : execution_time,
+              "quality_metrics_output_files" : [probe_output['quality_metrics_output_file'] for probe_output in outputs]}
+
+    if args['profile']:
+        output['probe_profiles'] = [probe_output.get('profile') for probe_output in outputs]
+
+    return output
+
+
+def main():
+
+    from ._schemas import MultiProbeInputParameters, MultiProbeOutputParameters
+
+    mod = ArgSchemaParser(schema_type=MultiProbeInputParameters,
+                          output_schema_type=MultiProbeOutputParameters)
+
+    output = calculate_quality_metrics_for_probes(mod.args)
+
+    output.update({"input_parameters": mod.args})
+    if "output_json" in mod.args:
+        mod.output(output, indent=2)
+    else:
+        print(mod.get_output_json(output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,440 @@
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+
+from ...common.epoch import Epoch
+from ...common.utils import printProgressBar, get_spike_depths
+
+from .metrics import get_epoch_slice, calculate_pc_metrics, calculate_silhouette_score, \
+    median_depths_by_interval, drift_from_median_depths, amplitude_histogram_edges, \
+    amplitude_histogram_indices, amplitude_cutoffs_from_histograms
+
+
+def calculate_metrics_streaming(spike_times, spike_clusters, amplitudes, channel_map, channel_pos, pc_features, pc_feature_ind, params, epochs = None,
+                                pool = None, channel_shanks = None):
+
+    """ Calculate metrics for all units on one probe, reading spikes in time-ordered chunks
+
+    Same output as calculate_metrics, but per-spike data (which may be memory-mapped)
+    is never loaded all at once. ISI violations, presence ratio, firing rate, amplitude
+    cutoff and drift are calculated from per-unit statistics accumulated over chunks.
+    PC-based metrics and silhouette score are calculated from a random sample of
+    spikes for each unit (a reservoir sample), sized to fit in the memory budget
+
+    Inputs:
+    ------
+    spike_times : numpy.ndarray (num_spikes x 0)
+        Spike times in seconds, in ascending order
+    spike_clusters : numpy.ndarray (num_spikes x 0)
+        Cluster IDs for each spike time
+    amplitudes : numpy.ndarray (num_spikes x 0)
+        Amplitude value for each spike time
+    channel_map : numpy.ndarray (num_channels x 0)
+        Original data channel for pc_feature_ind array
+    channel_pos : numpy.ndarray (num_channels x 2)
+        Original data channel positions in um
+    pc_features : numpy.ndarray or numpy.memmap (num_spikes x num_pcs x num_channels)
+        Pre-computed PCs for blocks of channels around each spike
+    pc_feature_ind : numpy.ndarray (num_units x num_channels)
+        Channel indices of PCs for each unit
+    params : dict of parameters
+        'memory_budget_mb' : approximate memory limit for chunks and samples
+    epochs : list of Epoch objects
+        contains information on Epoch start and stop times
+    pool : multiprocessing.Pool (optional)
+        Worker pool for PC-based metrics (see calculate_metrics)
+    channel_shanks : numpy.ndarray (num_channels x 0) (optional)
+        Shank index for each channel (see calculate_metrics)
+
+    Outputs:
+    --------
+    metrics : pandas.DataFrame
+        one column for each metric
+        one row per unit per epoch
+
+    """
+
+    metrics = pd.DataFrame()
+
+    if epochs is None:
+        epochs = [Epoch('complete_session', 0, np.inf)]
+
+    if np.any(np.diff(spike_times) < 0):
+        raise ValueError('Streaming quality metrics require spike times in ascending order')
+
+    [total_units, num_pc_channels] = pc_feature_ind.shape
+
+    budget = params['memory_budget_mb'] * 1e6
+    pc_row_bytes = pc_features.shape[1] * pc_features.shape[2] * pc_features.dtype.itemsize
+
+    # get_spike_depths holds about 8 arrays of (spikes x channels) per chunk
+    chunk_size = int(np.max([1000, budget / 2 / (num_pc_channels * 32 + 64)]))
+    reservoir_size = int(np.max([params['max_spikes_for_unit'], budget / 2 / (total_units * (2 * pc_row_bytes + 24))]))
+
+    for epoch in epochs:
+
+        in_epoch = get_epoch_slice(spike_times, epoch)
+
+        if spike_times[in_epoch].size == 0:
+            continue
+
+        unit_metrics = accumulate_unit_statistics(spike_times[in_epoch],
+                                                  spike_clusters[in_epoch],
+                                                  amplitudes[in_epoch],
+                                                  pc_features[in_epoch],
+                                                  pc_feature_ind,
+                                                  channel_pos,
+                                                  total_units,
+                                                  params,
+                                                  chunk_size,
+                                                  reservoir_size)
+
+        # PC-based metrics only use the reservoir sample, but units are weighted by their full spike counts
+        sample = unit_metrics.pop('sample')
+        unit_spike_counts = unit_metrics.pop('spike_count')
+        sample_clusters = np.ravel(spike_clusters[in_epoch][sample])
+        sample_pc_features = np.asarray(pc_features[in_epoch][sample])
+
+        print("Calculating PC-based metrics")
+        isolation_distance, l_ratio, d_prime, nn_hit_rate, nn_miss_rate = calculate_pc_metrics(sample_clusters,
+                                                                                                total_units,
+                                                                                                sample_pc_features,
+                                                                                                pc_feature_ind,
+                                                                                                params['num_channels_to_compare'],
+                                                                                                params['max_spikes_for_unit'],
+                                                                                                params['max_spikes_for_nn'],
+                                                                                                params['n_neighbors'],
+                                                                                                num_workers = params['num_workers'],
+                                                                                                dtype = params['precision'],
+                                                                                                pool = pool,
+                                                                                                channel_shanks = channel_shanks,
+                                                                                                unit_spike_counts = unit_spike_counts)
+
+        print("Calculating silhouette score")
+        the_silhouette_score = calculate_silhouette_score(sample_clusters,
+                                                       total_units,
+                                                       sample_pc_features,
+                                                       pc_feature_ind,
+                                                       min(sample.size, params['n_silhouette']),
+                                                       params['silhouette_neighbors_only'],
+                                                       dtype = params['precision'])
+
+        del sample_pc_features
+
+        cluster_ids = np.arange(total_units)
+
+        epoch_name = [epoch.name] * len(cluster_ids)
+
+        metrics = pd.concat((metrics, pd.DataFrame(data= OrderedDict((('cluster_id', cluster_ids),
+                                ('firing_rate' , unit_metrics['firing_rate']),
+                                ('presence_ratio' , unit_metrics['presence_ratio']),
+                                ('isi_viol' , unit_metrics['isi_viol']),
+                                ('amplitude_cutoff' , unit_metrics['amplitude_cutoff']),
+                                ('isolation_distance' , isolation_distance),
+                                ('l_ratio' , l_ratio),
+                                ('d_prime' , d_prime),
+                                ('nn_hit_rate' , nn_hit_rate),
+                                ('nn_miss_rate' , nn_miss_rate),
+                                ('silhouette_score', the_silhouette_score),
+                                ('max_drift', unit_metrics['max_drift']),
+                                ('cumulative_drift', unit_metrics['cumulative_drift']),
+                                ('epoch_name' , epoch_name),
+                                )))))
+
+    return metrics
+
+
+def accumulate_unit_statistics(spike_times,
+                               spike_clusters,
+                               amplitudes,
+                               pc_features,
+                               pc_feature_ind,
+                               channel_pos,
+                               total_units,
+                               params,
+                               chunk_size,
+                               reservoir_size,
+                               num_presence_bins = 100,
+                               num_histogram_bins = 500):
+
+    """ Calculates the non-PC metrics for one epoch from time-ordered chunks of spikes
+
+    Chunks hold at most chunk_size spikes, whatever the drift interval length. Spike depths of
+    a drift interval that continues into the next chunk are kept until the interval ends,
+    so the median depth of every interval is exact (this keeps 8 bytes per spike of the
+    current interval, rather than the whole chunk). Amplitude histograms need the range of
+    each unit, so amplitudes are read a second time
+
+    Inputs:
+    -------
+    spike_times : numpy.ndarray (num_spikes x 0)
+        Spike times in seconds, in ascending order
+    spike_clusters : numpy.ndarray (num_spikes x 0)
+        Cluster IDs for each spike time
+    amplitudes : numpy.ndarray (num_spikes x 0)
+        Amplitude value for each spike time
+    pc_features : numpy.ndarray (num_spikes x num_pcs x num_channels)
+        Pre-computed PCs for blocks of channels around each spike
+    pc_feature_ind : numpy.ndarray (num_units x num_channels)
+        Channel indices of PCs for each unit
+    channel_pos : numpy.ndarray (num_channels x 2)
+        Channel positions in um
+    total_units : Int
+        Number of units
+    params : dict of parameters
+    chunk_size : Int
+        Maximum number of spikes per chunk
+    reservoir_size : Int
+        Maximum number of spikes per unit in the sample for PC-based metrics
+
+    Outputs:
+    --------
+    unit_metrics : dict
+        Array (total_units x 0) for 'firing_rate', 'presence_ratio', 'isi_viol',
+        'amplitude_cutoff', 'max_drift', 'cumulative_drift' and 'spike_count'; 'sample'
+        holds the sorted spike indices of the reservoir sample
+
+    """
+
+    num_spikes = spike_times.size
+
+    min_time = spike_times[0]
+    max_time = spike_times[-1]
+    duration = max_time - min_time
+
+    isi_threshold = params['isi_threshold']
+    min_isi = params['min_isi']
+
+    interval_starts = np.arange(min_time, max_time, params['drift_metrics_interval_s'])
+    interval_ends = interval_starts + params['drift_metrics_interval_s']
+
+    chunk_bounds = np.append(np.arange(0, num_spikes, chunk_size), num_spikes)
+
+    presence_edges = np.linspace(min_time, max_time, num_presence_bins)
+
+    spike_counts = np.zeros((total_units,), dtype='int64')
+    kept_counts = np.zeros((total_units,), dtype='int64')
+    num_violations = np.zeros((total_units,), dtype='int64')
+    last_spike = np.full((total_units,), -np.inf)
+    last_kept_spike = np.full((total_units,), -np.inf)
+    present = np.zeros((total_units, num_presence_bins - 1), dtype='bool')
+    min_amplitude = np.full((total_units,), np.inf)
+    max_amplitude = np.full((total_units,), -np.inf)
+    median_depths = np.full((total_units, interval_starts.size), np.nan)
+
+    # depths of the spikes from pending_start onwards, whose drift intervals have not ended yet
+    pending_start = 0
+    pending_depths = np.zeros((0,))
+    done_intervals = 0
+
+    sample = np.zeros((0,), dtype='int64')
+    sample_clusters = np.zeros((0,), dtype='int64')
+    sample_keys = np.zeros((0,))
+
+    num_chunks = chunk_bounds.size - 1
+
+    print("Accumulating statistics in " + str(num_chunks) + " chunks")
+
+    for chunk in range(num_chunks):
+
+        printProgressBar(chunk + 1, num_chunks)
+
+        start, end = chunk_bounds[chunk], chunk_bounds[chunk + 1]
+
+        if end == start:
+            continue
+
+        times = np.ravel(spike_times[start:end])
+        clusters = np.ravel(spike_clusters[start:end]).astype('int64')
+        chunk_amplitudes = np.ravel(amplitudes[start:end])
+
+        spike_counts += np.bincount(clusters, minlength=total_units)
+
+        # spikes of each unit, in time order
+        order = np.argsort(clusters, kind='stable')
+        c = clusters[order]
+        t = times[order]
+        a = chunk_amplitudes[order]
+
+        group_starts = np.flatnonzero(np.diff(c, prepend=-1))
+        group_ends = np.append(group_starts[1:], c.size) - 1
+        units = c[group_starts]
+
+        # ISI violations (duplicate spikes are removed first, as in isi_violations)
+        previous = np.empty_like(t)
+        previous[1:] = t[:-1]
+        previous[group_starts] = last_spike[units]
+        kept = (t - previous) > min_isi
+        last_spike[units] = t[group_ends]
+
+        kept_c = c[kept]
+        kept_t = t[kept]
+        kept_starts = np.flatnonzero(np.diff(kept_c, prepend=-1))
+        kept_ends = np.append(kept_starts[1:], kept_c.size) - 1
+
+        previous_kept = np.empty_like(kept_t)
+        previous_kept[1:] = kept_t[:-1]
+        previous_kept[kept_starts] = last_kept_spike[kept_c[kept_starts]]
+
+        num_violations += np.bincount(kept_c[(kept_t - previous_kept) < isi_threshold], minlength=total_units)
+        kept_counts += np.bincount(kept_c, minlength=total_units)
+        last_kept_spike[kept_c[kept_ends]] = kept_t[kept_ends]
+
+        # presence ratio (same bins as np.histogram)
+        presence_bin = np.minimum(np.searchsorted(presence_edges, times, side='right') - 1, num_presence_bins - 2)
+        present[clusters, presence_bin] = True
+
+        # amplitude range of each unit
+        min_amplitude[units] = np.minimum(min_amplitude[units], np.minimum.reduceat(a, group_starts))
+        max_amplitude[units] = np.maximum(max_amplitude[units], np.maximum.reduceat(a, group_starts))
+
+        # median depth in each drift interval that ends in this chunk (intervals exclude their start and end times)
+        depths = np.concatenate((pending_depths, get_spike_depths(clusters, pc_features[start:end], pc_feature_ind, channel_pos)))
+
+        if end == num_spikes:
+            last_interval = interval_starts.size
+        else:
+            last_interval = np.searchsorted(interval_ends, times[-1], side='right')
+
+        if last_interval > done_intervals:
+
+            if last_interval < interval_starts.size:
+                split = np.searchsorted(np.ravel(spike_times[pending_start:end]), interval_starts[last_interval], side='right')
+            else:
+                split = depths.size
+
+            median_depths[:, done_intervals:last_interval] = median_depths_by_interval(np.ravel(spike_times[pending_start:pending_start + split]),
+                                                          np.ravel(spike_clusters[pending_start:pending_start + split]),
+                                                          depths[:split],
+                                                          interval_starts[done_intervals:last_interval],
+                                                          interval_ends[done_intervals:last_interval],
+                                                          params['drift_metrics_min_spikes_per_interval'],
+                                                          total_units)
+
+            depths = np.copy(depths[split:])
+            pending_start += split
+            done_intervals = last_interval
+
+        pending_depths = depths
+        del depths
+
+        # reservoir sample: keep the spikes with the lowest random keys for each unit
+        sample, sample_clusters, sample_keys = update_reservoir(sample, sample_clusters, sample_keys,
+                                                                np.arange(start, end), clusters, reservoir_size)
+
+    unit_metrics = {}
+
+    cluster_ids = np.flatnonzero(spike_counts)
+
+    unit_metrics['firing_rate'] = spike_counts / duration
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        violation_rate = num_violations / (2 * kept_counts * (isi_threshold - min_isi))
+        isi_viol = violation_rate / (kept_counts / duration)
+
+    unit_metrics['isi_viol'] = np.zeros((total_units,))
+    unit_metrics['isi_viol'][cluster_ids] = isi_viol[cluster_ids]
+
+    unit_metrics['presence_ratio'] = np.sum(present, 1) / num_presence_bins
+
+    unit_metrics['max_drift'] = np.zeros((total_units,))
+    unit_metrics['cumulative_drift'] = np.zeros((total_units,))
+    unit_metrics['max_drift'][cluster_ids], unit_metrics['cumulative_drift'][cluster_ids] = \
+        drift_from_median_depths(median_depths[cluster_ids, :])
+
+    unit_metrics['amplitude_cutoff'] = accumulate_amplitude_cutoffs(spike_clusters, amplitudes, min_amplitude, max_amplitude,
+                                                                    cluster_ids, chunk_size, num_histogram_bins)
+
+    unit_metrics['sample'] = np.sort(sample)
+    unit_metrics['spike_count'] = spike_counts
+
+    return unit_metrics
+
+
+def update_reservoir(sample, sample_clusters, sample_keys, spike_indices, clusters, reservoir_size):
+
+    """ Adds a chunk of spikes to a per-unit reservoir sample
+
+    Every spike gets a uniform random key; keeping the reservoir_size spikes with the lowest
+    keys for each unit gives a uniform random sample of each unit's spikes
+
+    Inputs:
+    -------
+    sample, sample_clusters, sample_keys : numpy.ndarray
+        Spike indices, cluster IDs and keys of the current sample
+    spike_indices : numpy.ndarray
+        Indices of the new spikes
+    clusters : numpy.ndarray
+        Cluster IDs of the new spikes
+    reservoir_size : Int
+        Maximum number of spikes per unit
+
+    Outputs:
+    --------
+    sample, sample_clusters, sample_keys : numpy.ndarray
+        Updated sample
+
+    """
+
+    sample = np.concatenate((sample, spike_indices))
+    sample_clusters = np.concatenate((sample_clusters, clusters))
+    sample_keys = np.concatenate((sample_keys, np.random.random_sample(spike_indices.size)))
+
+    order = np.lexsort((sample_keys, sample_clusters))
+    sorted_clusters = sample_clusters[order]
+
+    rank = np.arange(order.size) - np.searchsorted(sorted_clusters, sorted_clusters, side='left')
+    keep = order[rank < reservoir_size]
+
+    return sample[keep], sample_clusters[keep], sample_keys[keep]
+
+
+def accumulate_amplitude_cutoffs(spike_clusters, amplitudes, min_amplitude, max_amplitude, cluster_ids, chunk_size, num_histogram_bins = 500):
+
+    """ Calculates the amplitude cutoff of each unit from amplitude histograms accumulated over chunks
+
+    Each unit's histogram has the same bins as np.histogram(amplitudes, num_histogram_bins)
+
+    Inputs:
+    -------
+    spike_clusters : numpy.ndarray (num_spikes x 0)
+        Cluster IDs for each spike
+    amplitudes : numpy.ndarray (num_spikes x 0)
+        Amplitude value for each spike
+    min_amplitude, max_amplitude : numpy.ndarray (num_units x 0)
+        Range of amplitudes of each unit
+    cluster_ids : numpy.ndarray
+        IDs of units with spikes
+    chunk_size : Int
+        Number of spikes to read at once
+    num_histogram_bins : Int
+        Number of bins per histogram
+
+    Outputs:
+    --------
+    amplitude_cutoffs : numpy.ndarray (num_units x 0)
+        Amplitude cutoff for each unit (0 for units without spikes)
+
+    """
+
+    total_units = min_amplitude.size
+
+    bin_edges = amplitude_histogram_edges(min_amplitude, max_amplitude, num_histogram_bins)
+
+    counts = np.zeros((total_units * num_histogram_bins,), dtype='int64')
+
+    for start in range(0, spike_clusters.size, chunk_size):
+
+        clusters = np.ravel(spike_clusters[start:start + chunk_size]).astype('int64')
+        values = np.ravel(amplitudes[start:start + chunk_size])
+
+        indices = amplitude_histogram_indices(values, clusters, bin_edges)
+
+        counts += np.bincount(clusters * num_histogram_bins + indices, minlength=counts.size)
+
+    counts = np.reshape(counts, (total_units, num_histogram_bins))
+
+    amplitude_cutoffs = np.zeros((total_units,))
+    amplitude_cutoffs[cluster_ids] = amplitude_cutoffs_from_histograms(counts[cluster_ids], bin_edges[cluster_ids])
+
+    return amplitude_cutoffs
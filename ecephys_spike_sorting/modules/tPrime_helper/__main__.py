@@ -9,8 +9,10 @@ import fnmatch
 import numpy as np
 
 from ...common.utils import catGT_ex_params_from_str
+from ...common.profiling import profiled
 
 
+@profiled
 def call_TPrime(args):
 
     # Run TPrime on a "standard" multiprobe + NI, using NP 1.0 or 2.0, with run
@@ -209,6 +211,7 @@ def call_TPrime(args):
     return {"execution_time": execution_time}  # output manifest
 
 
+@profiled
 def call_TPrime_3A(args):
 
     # call TPrime for 3A data
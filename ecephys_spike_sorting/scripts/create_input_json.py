@@ -41,7 +41,8 @@ def createInputJson(output_file,
                     whiteningRange = 32,
                     CSBseed = 1,
                     LTseed = 1,
-                    nNeighbors = 32
+                    nNeighbors = 32,
+                    profile = False
                     ):
 
     # hard coded paths to code on your computer and system
@@ -319,7 +320,9 @@ def createInputJson(output_file,
                 
         "psth_events": {
                 "event_ex_param_str": event_ex_param_str
-                }
+                },
+
+        "profile" : profile
         
     }
 
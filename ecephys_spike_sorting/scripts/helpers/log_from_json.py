@@ -72,6 +72,55 @@ def writeHeader(logFullPath):
         log.write('session_id,ntot,nTemplate,KS2_time,KS_postprocess_time,noise_template_time,mean_waveform_time,QC_time\n')
 
 
+# write header to the profile log (one row per module stage)
+def writeProfileHeader(profileLogPath):
+    with open(profileLogPath, 'w') as log:
+        log.write('session_id,module,stage,wall_time_s,cpu_time_s,peak_rss_mb,read_bytes,write_bytes\n')
+
+
+# Add the profile block of each module's output json to the profile log;
+# modules that were run without profile = True are skipped
+#
+def addProfileEntries(modules, jsondir, session_id, profileLogPath):
+
+    sep = ','
+    columns = ['wall_time_s', 'cpu_time_s', 'peak_rss_mb', 'read_bytes', 'write_bytes']
+
+    with open(profileLogPath, 'a') as log:
+        for module in modules:
+            jsonFile = os.path.join(jsondir, session_id + '-' + module + '-output.json')
+            if not os.path.exists(jsonFile):
+                continue
+            with open(jsonFile) as currJson:
+                modData = json.load(currJson)
+            if 'profile' not in modData:
+                continue
+            stages = [dict(modData['profile']['total'], stage='total')] + modData['profile']['stages']
+            for stage in stages:
+                values = ['None' if stage[col] is None else repr(stage[col]) for col in columns]
+                log.write(sep.join([session_id, module, stage['stage']] + values) + '\n')
+
+
+# Summarize a profile log: total and mean of each column for each module stage
+# (over all sessions), sorted by total wall time
+#
+def aggregateProfiles(profileLogPath):
+
+    import pandas as pd
+
+    profiles = pd.read_csv(profileLogPath, na_values=['None'])
+    summary = profiles.groupby(['module', 'stage']).agg(
+                sessions = ('session_id', 'nunique'),
+                wall_time_s = ('wall_time_s', 'sum'),
+                mean_wall_time_s = ('wall_time_s', 'mean'),
+                cpu_time_s = ('cpu_time_s', 'sum'),
+                max_peak_rss_mb = ('peak_rss_mb', 'max'),
+                read_bytes = ('read_bytes', 'sum'),
+                write_bytes = ('write_bytes', 'sum'))
+
+    return summary.sort_values('wall_time_s', ascending=False)
+
+
 # For testing, prompt user for kilosort_helper-out.json,
 # get directory and session name, parse make an output log file
 #
@@ -96,6 +145,11 @@ def main():
     modules = ['kilosort_helper','kilosort_postprocessing','noise_templates','mean_waveforms','quality_metrics']
     addEntry(modules, jsondir, session_id, testLogPath)
 
+    profileLogPath = os.path.join(jsondir, 'testprofile.csv')
+    writeProfileHeader(profileLogPath)
+    addProfileEntries(modules, jsondir, session_id, profileLogPath)
+    print(aggregateProfiles(profileLogPath))
+
 
 if __name__ == "__main__":
     main()
@@ -35,4 +35,7 @@ setup(
         'xarray',
         'scikit-learn',
     ],
+    extras_require={
+        'columnar': ['pyarrow'],
+    },
 )
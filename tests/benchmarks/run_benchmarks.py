@@ -0,0 +1,217 @@
+import os
+import io
+import time
+import shutil
+import tempfile
+import contextlib
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from argschema import ArgSchema, ArgSchemaParser
+from argschema.fields import String, Int, Float, NumpyArray, Bool
+
+from tests.benchmarks.synthetic_dataset import make_synthetic_dataset
+
+
+class BenchmarkParams(ArgSchema):
+    output_dir = String(required=False, default=os.path.join(tempfile.gettempdir(), 'ecephys_benchmarks'), help='Directory for synthetic datasets and results')
+    durations = NumpyArray(required=False, default=[30., 60., 120.], help='Recording durations (s) of the synthetic datasets')
+    num_units = Int(required=False, default=100, help='Number of units in each synthetic dataset')
+    num_channels = Int(required=False, default=384, help='Number of channels in each synthetic dataset')
+    mean_firing_rate = Float(required=False, default=5., help='Mean firing rate (Hz) of the synthetic units')
+    modules = NumpyArray(dtype='str', required=False, default=['noise_templates', 'quality_metrics', 'mean_waveforms', 'kilosort_postprocessing'], help='Modules to benchmark, in order')
+    seed = Int(required=False, default=0, help='Random seed for the synthetic datasets')
+    keep_data = Bool(required=False, default=False, help='Keep the synthetic datasets after benchmarking')
+    plot = Bool(required=False, default=True, help='Save a plot of run time against number of spikes')
+
+
+def module_args(module, folder, info):
+
+    """
+    Input parameters for one module entry point, with the module's defaults filled in by its schema
+
+    Inputs:
+    -------
+    module : String
+        Module name (e.g. 'quality_metrics')
+    folder : String
+        Synthetic Kilosort output directory
+    info : dict
+        Output of make_synthetic_dataset
+
+    Outputs:
+    --------
+    run : function
+        Entry point of the module
+    args : dict
+        Validated input parameters
+
+    """
+
+    ephys_params = {'sample_rate' : info['sample_rate'],
+                    'num_channels' : info['num_channels'],
+                    'ap_band_file' : info['ap_band_file']}
+
+    directories = {'kilosort_output_directory' : folder}
+
+    cluster_metrics = {'cluster_metrics_file' : os.path.join(folder, 'metrics.csv')}
+    waveform_metrics = {'waveform_metrics_file' : os.path.join(folder, 'waveform_metrics.csv')}
+
+    if module == 'quality_metrics':
+        from ecephys_spike_sorting.modules.quality_metrics.__main__ import calculate_quality_metrics as run
+        from ecephys_spike_sorting.modules.quality_metrics._schemas import InputParameters
+        input_data = {'quality_metrics_params' : {},
+                      'cluster_metrics' : cluster_metrics,
+                      'waveform_metrics' : waveform_metrics}
+
+    elif module == 'mean_waveforms':
+        from ecephys_spike_sorting.modules.mean_waveforms.__main__ import calculate_mean_waveforms as run
+        from ecephys_spike_sorting.modules.mean_waveforms._schemas import InputParameters
+        input_data = {'mean_waveform_params' : {'mean_waveforms_file' : os.path.join(folder, 'mean_waveforms.npy')},
+                      'cluster_metrics' : cluster_metrics,
+                      'waveform_metrics' : waveform_metrics}
+
+    elif module == 'noise_templates':
+        from ecephys_spike_sorting.modules.noise_templates.__main__ import classify_noise_templates as run
+        from ecephys_spike_sorting.modules.noise_templates._schemas import InputParameters
+        input_data = {'noise_waveform_params' : {'classifier_path' : '', 'use_random_forest' : False}}
+
+    elif module == 'kilosort_postprocessing':
+        from ecephys_spike_sorting.modules.kilosort_postprocessing.__main__ import run_postprocessing as run
+        from ecephys_spike_sorting.modules.kilosort_postprocessing._schemas import InputParameters
+        input_data = {'ks_postprocessing_params' : {}}
+
+    else:
+        raise ValueError('Unknown module: ' + module)
+
+    input_data.update({'ephys_params' : ephys_params, 'directories' : directories})
+
+    args = ArgSchemaParser(input_data=input_data, schema_type=InputParameters, args=[]).args
+
+    return run, args
+
+
+def benchmark_module(module, folder, info):
+
+    """
+    Runs one module on a synthetic dataset and measures run time and peak memory
+
+    Peak memory is the largest amount allocated through Python (including numpy arrays)
+    in this process; memory-mapped files and worker processes are not included
+
+    Outputs:
+    --------
+    result : dict
+        One row of the benchmark table
+
+    """
+
+    run, args = module_args(module, folder, info)
+
+    tracemalloc.start()
+    start = time.perf_counter()
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        run(args)
+
+    execution_time = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {'module' : module,
+            'duration_s' : info['duration'],
+            'num_units' : info['num_units'],
+            'num_spikes' : info['num_spikes'],
+            'execution_time_s' : execution_time,
+            'peak_memory_mb' : peak / 1e6,
+            'spikes_per_s' : info['num_spikes'] / execution_time}
+
+
+def run_benchmarks(args):
+
+    """
+    Benchmarks each module on synthetic datasets of increasing size
+
+    Writes benchmark_results.csv (one row per module per dataset) and, optionally,
+    benchmark_scaling.png (run time against number of spikes) to the output directory
+
+    """
+
+    os.makedirs(args['output_dir'], exist_ok=True)
+
+    results = []
+
+    for duration in args['durations']:
+
+        folder = os.path.join(args['output_dir'], 'synthetic_' + str(int(duration)) + 's')
+
+        print('Generating ' + str(duration) + ' s dataset...')
+
+        info = make_synthetic_dataset(folder,
+                                      num_units = args['num_units'],
+                                      duration = float(duration),
+                                      num_channels = args['num_channels'],
+                                      mean_firing_rate = args['mean_firing_rate'],
+                                      seed = args['seed'])
+
+        for module in args['modules']:
+
+            print('  ' + module + '...')
+
+            result = benchmark_module(str(module), folder, info)
+            results.append(result)
+
+            print('    ' + str(np.around(result['execution_time_s'], 2)) + ' s, ' +
+                  str(np.around(result['peak_memory_mb'], 1)) + ' MB, ' +
+                  str(int(result['spikes_per_s'])) + ' spikes/s')
+
+        if not args['keep_data']:
+            shutil.rmtree(folder)
+
+    results = pd.DataFrame(results)
+    results.to_csv(os.path.join(args['output_dir'], 'benchmark_results.csv'))
+
+    if args['plot']:
+        plot_scaling(results, os.path.join(args['output_dir'], 'benchmark_scaling.png'))
+
+    return results
+
+
+def plot_scaling(results, filename):
+
+    """ Saves log-log plots of run time and peak memory against number of spikes for each module """
+
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    fig, axes = plt.subplots(1, 2, figsize=(10, 4))
+
+    for module, module_results in results.groupby('module'):
+        axes[0].loglog(module_results['num_spikes'], module_results['execution_time_s'], '.-', label=module)
+        axes[1].loglog(module_results['num_spikes'], module_results['peak_memory_mb'], '.-', label=module)
+
+    axes[0].set_ylabel('Run time (s)')
+    axes[1].set_ylabel('Peak memory (MB)')
+
+    for ax in axes:
+        ax.set_xlabel('Number of spikes')
+
+    axes[0].legend()
+
+    fig.tight_layout()
+    fig.savefig(filename)
+    plt.close(fig)
+
+
+def main():
+
+    mod = ArgSchemaParser(schema_type=BenchmarkParams)
+
+    print(run_benchmarks(mod.args))
+
+
+if __name__ == "__main__":
+    main()
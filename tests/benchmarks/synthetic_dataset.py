@@ -0,0 +1,265 @@
+import os
+
+import numpy as np
+
+
+def make_probe_geometry(num_channels):
+
+    """
+    Neuropixels 1.0 site layout (four staggered columns, 20 um vertical spacing)
+
+    Outputs:
+    --------
+    channel_pos : numpy.ndarray (num_channels x 2)
+        X and Y position of each channel, in um
+
+    """
+
+    x = np.tile([43., 11., 59., 27.], int(np.ceil(num_channels / 4)))[:num_channels]
+    y = np.arange(num_channels) // 2 * 20.
+
+    return np.stack((x, y), 1)
+
+
+def make_templates(peak_channels, channel_pos, num_samples = 82, zero_padding = 21, spatial_decay_um = 40.):
+
+    """
+    Biphasic spike templates with an exponential spatial footprint
+
+    Outputs:
+    --------
+    templates : numpy.ndarray (num_units x num_samples x num_channels)
+        Templates with peak amplitude 1 on the peak channel
+
+    """
+
+    num_units = peak_channels.size
+    t = np.arange(num_samples - zero_padding)
+
+    trough = 20
+    widths = np.linspace(3., 6., num_units)[:, np.newaxis]
+
+    waveforms = -np.exp(-(t[np.newaxis, :] - trough) ** 2 / (2 * (widths / 2) ** 2)) + \
+                0.35 * np.exp(-(t[np.newaxis, :] - trough - 2.5 * widths) ** 2 / (2 * widths ** 2))
+    waveforms /= np.max(np.abs(waveforms), 1, keepdims=True)
+
+    distance = np.linalg.norm(channel_pos[np.newaxis, :, :] - channel_pos[peak_channels, np.newaxis, :], axis=2)
+    footprint = np.exp(-distance / spatial_decay_um)
+
+    templates = np.zeros((num_units, num_samples, channel_pos.shape[0]), dtype='float32')
+    templates[:, zero_padding:, :] = waveforms[:, :, np.newaxis] * footprint[:, np.newaxis, :]
+
+    return templates
+
+
+def make_spike_trains(firing_rates, duration, sample_rate, refractory_period = 0.002, rng = None):
+
+    """
+    Poisson spike trains with a refractory period, merged in time order
+
+    Outputs:
+    --------
+    spike_times : numpy.ndarray (num_spikes x 0)
+        Spike times in samples (sorted)
+    spike_clusters : numpy.ndarray (num_spikes x 0)
+        Unit ID for each spike
+
+    """
+
+    if rng is None:
+        rng = np.random.RandomState(0)
+
+    times = []
+    clusters = []
+
+    for unit, rate in enumerate(firing_rates):
+
+        num_spikes = rng.poisson(rate * duration)
+        isis = rng.exponential(1 / rate, num_spikes) + refractory_period
+        train = np.cumsum(isis)
+        train = train[train < duration]
+
+        times.append(np.round(train * sample_rate).astype('uint64'))
+        clusters.append(np.full(train.shape, unit, dtype='int32'))
+
+    times = np.concatenate(times)
+    clusters = np.concatenate(clusters)
+
+    order = np.argsort(times, kind='stable')
+
+    return times[order], clusters[order]
+
+
+def make_synthetic_dataset(folder,
+                           num_units = 100,
+                           duration = 60.,
+                           num_channels = 384,
+                           sample_rate = 30000.,
+                           mean_firing_rate = 5.,
+                           num_pc_channels = 32,
+                           num_pcs = 3,
+                           noise_std = 20.,
+                           write_binary = True,
+                           seed = 0):
+
+    """
+    Writes a deterministic synthetic Kilosort output directory (and AP band binary file)
+
+    Spike trains, templates, amplitudes and PC features are generated from a simple
+    model of units on a Neuropixels 1.0 probe, so every module can run on the output
+
+    Inputs:
+    -------
+    folder : String
+        Output directory (created if it does not exist)
+    num_units : Int
+        Number of units
+    duration : Float
+        Recording duration in seconds
+    num_channels : Int
+        Number of channels (in the binary file and the channel map)
+    sample_rate : Float
+        AP band sample rate in Hz
+    mean_firing_rate : Float
+        Mean firing rate of the units in Hz (rates are log-normally distributed)
+    num_pc_channels : Int
+        Number of channels with PC features for each unit
+    num_pcs : Int
+        Number of PCs per channel
+    noise_std : Float
+        Standard deviation of the background noise in the binary file (in bits)
+    write_binary : Bool
+        Write continuous.dat (int16, samples x channels)
+    seed : Int
+        Random seed
+
+    Outputs:
+    --------
+    info : dict
+        'num_spikes', 'num_units', 'duration', 'num_channels', 'sample_rate' and
+        'ap_band_file' (None if write_binary is False)
+
+    """
+
+    rng = np.random.RandomState(seed)
+
+    os.makedirs(folder, exist_ok=True)
+
+    channel_pos = make_probe_geometry(num_channels)
+    channel_map = np.arange(num_channels, dtype='int32')
+
+    peak_channels = np.sort(rng.randint(0, num_channels, num_units))
+
+    templates = make_templates(peak_channels, channel_pos)
+
+    # Kilosort templates are whitened; whitening_mat_inv maps them back to the raw data
+    whitening_mat_inv = np.diag(rng.uniform(0.8, 1.2, num_channels))
+
+    firing_rates = rng.lognormal(np.log(mean_firing_rate) - 0.5, 1.0, num_units)
+    spike_times, spike_clusters = make_spike_trains(firing_rates, duration, sample_rate, rng=rng)
+    num_spikes = spike_times.size
+
+    unit_amplitudes = rng.uniform(10., 40., num_units)
+    amplitudes = unit_amplitudes[spike_clusters] * rng.lognormal(0., 0.15, num_spikes)
+
+    # PC channels are the closest channels to the peak, in order of distance
+    distance = np.linalg.norm(channel_pos[np.newaxis, :, :] - channel_pos[peak_channels, np.newaxis, :], axis=2)
+    pc_feature_ind = np.argsort(distance, axis=1, kind='stable')[:, :num_pc_channels].astype('uint32')
+
+    pc_means = np.zeros((num_units, num_pcs, num_pc_channels), dtype='float32')
+    pc_means[:, 0, :] = np.exp(-np.take_along_axis(distance, pc_feature_ind.astype('int64'), 1) / 40.) * unit_amplitudes[:, np.newaxis]
+    pc_means[:, 1:, :] = rng.randn(num_units, num_pcs - 1, num_pc_channels) * 2
+
+    pc_features = np.empty((num_spikes, num_pcs, num_pc_channels), dtype='float32')
+
+    for start in range(0, num_spikes, 100000):
+        chunk = slice(start, start + 100000)
+        pc_features[chunk] = pc_means[spike_clusters[chunk]] + rng.randn(*pc_features[chunk].shape).astype('float32')
+
+    # nearest templates (by peak channel distance) for the template features
+    template_feature_ind = np.argsort(distance[:, peak_channels], axis=1, kind='stable')[:, :num_pc_channels].astype('uint32')
+    template_features = np.abs(rng.randn(num_spikes, template_feature_ind.shape[1])).astype('float32')
+
+    np.save(os.path.join(folder, 'spike_times.npy'), spike_times[:, np.newaxis])
+    np.save(os.path.join(folder, 'spike_clusters.npy'), spike_clusters)
+    np.save(os.path.join(folder, 'spike_templates.npy'), spike_clusters.astype('uint32')[:, np.newaxis])
+    np.save(os.path.join(folder, 'amplitudes.npy'), amplitudes[:, np.newaxis])
+    np.save(os.path.join(folder, 'templates.npy'), templates)
+    np.save(os.path.join(folder, 'whitening_mat_inv.npy'), whitening_mat_inv)
+    np.save(os.path.join(folder, 'whitening_mat.npy'), np.linalg.inv(whitening_mat_inv))
+    np.save(os.path.join(folder, 'channel_map.npy'), channel_map[:, np.newaxis])
+    np.save(os.path.join(folder, 'channel_positions.npy'), channel_pos)
+    np.save(os.path.join(folder, 'pc_features.npy'), pc_features)
+    np.save(os.path.join(folder, 'pc_feature_ind.npy'), pc_feature_ind)
+    np.save(os.path.join(folder, 'template_features.npy'), template_features)
+    np.save(os.path.join(folder, 'template_feature_ind.npy'), template_feature_ind)
+
+    with open(os.path.join(folder, 'cluster_Amplitude.tsv'), 'w') as f:
+        f.write('cluster_id\tAmplitude\n')
+        for unit, amplitude in enumerate(unit_amplitudes):
+            f.write('%d\t%.1f\n' % (unit, amplitude))
+
+    ap_band_file = None
+
+    if write_binary:
+
+        ap_band_file = os.path.join(folder, 'continuous.dat')
+        write_binary_file(ap_band_file, spike_times, spike_clusters, amplitudes,
+                          templates @ whitening_mat_inv.astype('float32'), int(duration * sample_rate), noise_std, rng)
+
+        with open(os.path.join(folder, 'params.py'), 'w') as f:
+            f.write("dat_path = 'continuous.dat'\n")
+            f.write('n_channels_dat = %d\n' % num_channels)
+            f.write("dtype = 'int16'\n")
+            f.write('offset = 0\n')
+            f.write('sample_rate = %.1f\n' % sample_rate)
+            f.write('hp_filtered = True\n')
+
+    return {'num_spikes' : num_spikes,
+            'num_units' : num_units,
+            'duration' : duration,
+            'num_channels' : num_channels,
+            'sample_rate' : sample_rate,
+            'ap_band_file' : ap_band_file}
+
+
+def write_binary_file(filename, spike_times, spike_clusters, amplitudes, unwhitened_templates, num_samples, noise_std, rng,
+                      zero_padding = 21, pre_samples = 20, samples_per_chunk = 30000):
+
+    """
+    Writes background noise plus a scaled template at each spike time, in chunks (int16, samples x channels)
+
+    The template trough (pre_samples after the zero padding) is aligned to the spike time
+
+    """
+
+    num_units, num_template_samples, num_channels = unwhitened_templates.shape
+    waveform = unwhitened_templates[:, zero_padding:, :]
+    waveform_length = waveform.shape[1]
+
+    data = np.memmap(filename, dtype='int16', mode='w+', shape=(num_samples, num_channels))
+
+    spike_starts = spike_times.astype('int64') - pre_samples
+    carry = np.zeros((waveform_length, num_channels), dtype='float32')
+
+    for start in range(0, num_samples, samples_per_chunk):
+
+        end = np.min([start + samples_per_chunk, num_samples])
+
+        chunk = np.zeros((end - start + waveform_length, num_channels), dtype='float32')
+        chunk[:end - start] = rng.randn(end - start, num_channels) * noise_std
+        chunk[:waveform_length] += carry
+
+        first, last = np.searchsorted(spike_starts, [start, end])
+
+        for spike in range(first, last):
+            offset = np.max([spike_starts[spike] - start, 0])
+            chunk[offset:offset + waveform_length, :] += waveform[spike_clusters[spike]] * (amplitudes[spike] * 10)
+
+        data[start:end, :] = np.clip(chunk[:end - start], -32768, 32767).astype('int16')
+
+        # waveforms that continue into the next chunk
+        carry = chunk[end - start:]
+
+    data.flush()
+    del data
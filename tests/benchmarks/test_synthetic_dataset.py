@@ -0,0 +1,30 @@
+import numpy as np
+
+from ecephys_spike_sorting.common.utils import load_kilosort_data
+
+from tests.benchmarks.synthetic_dataset import make_synthetic_dataset
+
+
+def test_make_synthetic_dataset(tmpdir):
+
+	folder = str(tmpdir)
+
+	info = make_synthetic_dataset(folder, num_units=10, duration=2., num_channels=64, write_binary=True, seed=1)
+
+	spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, \
+		channel_pos, clusterIDs, cluster_quality, cluster_amplitude, pc_features, pc_feature_ind, \
+		template_features = load_kilosort_data(folder, info['sample_rate'], include_pcs=True)
+
+	assert(spike_times.size == info['num_spikes'])
+	assert(np.all(np.diff(spike_times) >= 0))
+	assert(np.max(spike_times) < info['duration'])
+	assert(templates.shape == (10, 61, 64))
+	assert(pc_features.shape[0] == info['num_spikes'])
+
+	data = np.memmap(info['ap_band_file'], dtype='int16', mode='r')
+	assert(data.size == int(info['duration'] * info['sample_rate']) * 64)
+
+	# the generator is deterministic
+	repeat_folder = str(tmpdir.mkdir('repeat'))
+	make_synthetic_dataset(repeat_folder, num_units=10, duration=2., num_channels=64, write_binary=False, seed=1)
+	assert(np.array_equal(np.load(folder + '/pc_features.npy'), np.load(repeat_folder + '/pc_features.npy')))
@@ -0,0 +1,55 @@
+import numpy as np
+
+from ecephys_spike_sorting.common.cluster_index import ClusterIndex
+
+
+def test_cluster_index():
+
+	spike_clusters = np.array([3, 0, 3, 1, 0, 3])
+
+	index = ClusterIndex(spike_clusters, total_units=5)
+
+	assert(np.array_equal(index.cluster_ids, np.unique(spike_clusters)))
+
+	for cluster_id in range(5):
+		assert(np.array_equal(index.spikes_for(cluster_id), np.where(spike_clusters == cluster_id)[0]))
+		assert(index.count(cluster_id) == np.sum(spike_clusters == cluster_id))
+
+	assert(index.spikes_for(10).size == 0)
+
+	assert(np.array_equal(index.select([4, 3, 1, 10]), [1, 3]))
+
+
+def test_cluster_fingerprints():
+
+	before = ClusterIndex(np.array([0, 1, 2, 1, 0, 2]), total_units=4).fingerprints()
+	after = ClusterIndex(np.array([0, 1, 1, 1, 0, 1]), total_units=4).fingerprints() # merge 2 into 1
+
+	assert(len(before) == 4)
+	assert(before[0] == after[0])
+	assert(before[1] != after[1])
+	assert(before[2] != '' and after[2] == '')
+	assert(before[3] == after[3] == '')
+
+
+def test_cluster_index_grouped():
+
+	spike_clusters = np.array([3, 0, 3, 1, 0, 3])
+
+	index = ClusterIndex(spike_clusters, total_units=5)
+
+	spike_indices, groups = index.grouped([3, 2, 0, 10])
+
+	assert(np.array_equal(spike_indices, [0, 2, 5, 1, 4]))
+	assert(np.array_equal(groups, [0, 0, 0, 2, 2]))
+
+
+def test_cluster_index_remapped():
+
+	index = ClusterIndex(np.array([1, 0, 1, 0]), total_units=3)
+	remapped = index.remapped(np.array([10, 11, 12, 13]))
+
+	assert(np.array_equal(remapped.spikes_for(0), [11, 13]))
+	assert(np.array_equal(remapped.spikes_for(1), [10, 12]))
+	assert(np.array_equal(index.spikes_for(1), [0, 2]))
+	assert(remapped.count(1) == 2)
@@ -0,0 +1,21 @@
+from ecephys_spike_sorting.common.lru_cache import LRUCache
+
+
+def test_lru_cache():
+
+	cache = LRUCache(2)
+	built = []
+
+	def build(key):
+		built.append(key)
+		return key * 2
+
+	assert(cache.get(1, lambda: build(1)) == 2)
+	assert(cache.get(2, lambda: build(2)) == 4)
+	assert(cache.get(1, lambda: build(1)) == 2) # 1 is now the most recently used
+	assert(cache.get(3, lambda: build(3)) == 6) # evicts 2
+	assert(cache.get(2, lambda: build(2)) == 4)
+
+	assert(built == [1, 2, 3, 2])
+	assert(len(cache) == 2)
+	assert((cache.hits, cache.misses) == (1, 4))
@@ -0,0 +1,32 @@
+import numpy as np
+
+from ecephys_spike_sorting.common.profiling import profiled, profile_stage, active_profiler
+
+
+@profiled
+def run_module(args):
+
+	with profile_stage('loading'):
+		data = np.ones(1000000)
+
+	with profile_stage('compute'):
+		with profile_stage('sum'):
+			total = data.sum()
+
+	return {'execution_time' : 0.0, 'total' : total}
+
+
+def test_profiled():
+
+	output = run_module({'profile' : True})
+
+	stages = [stage['stage'] for stage in output['profile']['stages']]
+
+	assert(stages == ['loading', 'compute/sum', 'compute'])
+	assert(output['profile']['total']['wall_time_s'] >= output['profile']['stages'][0]['wall_time_s'])
+	assert(output['total'] == 1000000)
+	assert(active_profiler() is None)
+
+	output = run_module({'profile' : False})
+
+	assert('profile' not in output)
@@ -0,0 +1,97 @@
+import numpy as np
+import os
+import sys
+import pickle
+import subprocess
+import multiprocessing
+
+import pytest
+
+import ecephys_spike_sorting
+
+from ecephys_spike_sorting.common import shared_array
+from ecephys_spike_sorting.common.shared_array import SharedArray
+
+
+def test_shared_array_in_memory():
+
+	data = np.random.rand(100, 3, 8).astype('float32')
+
+	shared = SharedArray(data)
+	copy = pickle.loads(pickle.dumps(shared))
+
+	assert(copy.filename is None)
+	assert(np.array_equal(copy.attach(), data))
+
+	copy.release()
+	shared.release()
+
+def test_shared_array_memmap(tmpdir):
+
+	data = np.random.rand(100, 3, 8).astype('float32')
+	filename = os.path.join(str(tmpdir), 'pc_features.npy')
+	np.save(filename, data)
+
+	view = np.load(filename, mmap_mode='r')[17:60]
+
+	copy = pickle.loads(pickle.dumps(SharedArray(view)))
+
+	assert(copy.filename is not None)
+	assert(np.array_equal(copy.attach(), data[17:60]))
+
+def sum_and_release(shared):
+
+	total = np.sum(shared.attach())
+	shared.release()
+
+	return total
+
+def test_shared_array_worker_release():
+
+	if shared_array.shared_memory is None:
+		pytest.skip('shared memory requires Python 3.8')
+
+	data = np.random.rand(100, 3, 8)
+
+	shared = SharedArray(data)
+
+	pool = multiprocessing.Pool(2)
+	totals = pool.map(sum_and_release, [shared] * 4)
+	pool.close()
+	pool.join()
+
+	assert(np.allclose(totals, np.sum(data)))
+
+	# a process that was not started by this one has its own resource tracker
+	# (reading its stderr to the end also waits for that tracker to exit)
+	worker = subprocess.run([sys.executable, '-c', 'import pickle, sys; shared = pickle.load(sys.stdin.buffer); shared.attach(); shared.release()'],
+							input=pickle.dumps(shared), stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+							cwd=os.path.dirname(os.path.dirname(ecephys_spike_sorting.__file__)))
+
+	assert(worker.returncode == 0)
+	assert(b'leaked' not in worker.stderr)
+
+	# the block is still there after the workers have closed it and exited
+	block = shared_array.shared_memory.SharedMemory(name=shared.shm_name)
+	assert(np.array_equal(np.ndarray(data.shape, dtype=data.dtype, buffer=block.buf), data))
+	block.close()
+
+	shared.release()
+
+def test_shared_array_without_shared_memory(monkeypatch):
+
+	monkeypatch.setattr(shared_array, 'shared_memory', None)
+
+	data = np.random.rand(100, 3, 8).astype('float32')
+
+	shared = SharedArray(data)
+	copy = pickle.loads(pickle.dumps(shared))
+
+	assert(copy.filename is not None)
+	assert(np.array_equal(copy.attach(), data))
+
+	copy.release()
+	assert(os.path.exists(shared.filename))
+
+	shared.release()
+	assert(not os.path.exists(shared.filename))
@@ -46,3 +46,74 @@ def test_find_range():
 	output = utils.find_range(data, 20, 30)
 
 	assert(np.array_equal(output, np.arange(20,31)))
+
+def test_kilosort_dataset(tmpdir):
+
+	folder = str(tmpdir)
+
+	np.save(os.path.join(folder, 'spike_times.npy'), np.array([[30], [60], [90]], dtype='uint64'))
+	np.save(os.path.join(folder, 'spike_clusters.npy'), np.array([1, 0, 1], dtype='int32'))
+	np.save(os.path.join(folder, 'pc_features.npy'), np.random.rand(3, 3, 4).astype('float32'))
+	np.save(os.path.join(folder, 'templates.npy'), np.random.rand(2, 61, 4).astype('float32'))
+	np.save(os.path.join(folder, 'whitening_mat_inv.npy'), np.eye(4) * 2)
+	np.save(os.path.join(folder, 'channel_map.npy'), np.array([[0], [1], [2], [5]]))
+
+	kilosort_data = utils.KilosortDataset(folder, 30.0)
+
+	assert(np.array_equal(kilosort_data.spike_times, [1.0, 2.0, 3.0]))
+	assert(isinstance(kilosort_data.pc_features, np.memmap))
+	assert(np.array_equal(kilosort_data.cluster_ids, [0, 1]))
+	assert(np.array_equal(kilosort_data.cluster_index.spikes_for(1), [0, 2]))
+	assert(kilosort_data.templates.shape == (2, 40, 4))
+	assert(kilosort_data.peak_channels.shape == (2,))
+	assert(kilosort_data.cluster_index is kilosort_data.cluster_index)
+	assert('cluster_index' in kilosort_data.__dict__)
+
+def test_get_unwhitened_templates(tmpdir):
+
+	folder = str(tmpdir)
+
+	templates = np.random.rand(5, 82, 6).astype('float32')
+	w_inv = np.random.rand(6, 6)
+	channel_map = np.array([[0], [1], [2], [3], [6], [7]])
+
+	np.save(os.path.join(folder, 'templates.npy'), templates)
+	np.save(os.path.join(folder, 'whitening_mat_inv.npy'), w_inv)
+	np.save(os.path.join(folder, 'channel_map.npy'), channel_map)
+
+	unwhitened_templates, peak_channels = utils.get_unwhitened_templates(folder)
+
+	for i in range(templates.shape[0]):
+		unwhitened = np.dot(templates[i,:,:], w_inv)
+		assert(np.allclose(unwhitened_templates[i,:,:], unwhitened))
+		assert(peak_channels[i] == channel_map[np.argmax(np.max(unwhitened,0) - np.min(unwhitened,0)), 0])
+
+	assert(os.path.exists(os.path.join(folder, 'template_peak_channels.npy')))
+
+
+def test_metrics_table(tmpdir):
+
+	pytest.importorskip('pyarrow')
+
+	import pandas as pd
+
+	filename = os.path.join(str(tmpdir), 'metrics.csv')
+
+	metrics = pd.DataFrame({'cluster_id' : np.arange(3, dtype='int32'),
+							'firing_rate' : [1.5, np.nan, 3.0],
+							'epoch_name' : ['complete_session'] * 3}, index=[5, 6, 7])
+
+	utils.write_metrics_table(metrics, filename, 'parquet')
+
+	table = utils.read_metrics_table(filename)
+
+	assert(table['cluster_id'].dtype == 'int64')
+	assert(table['firing_rate'].dtype == 'float64')
+	assert(np.array_equal(table['epoch_name'], metrics['epoch_name']))
+	assert(np.allclose(table['firing_rate'], metrics['firing_rate'], equal_nan=True))
+
+	# a CSV-only run removes the parquet copy, which would no longer match
+	utils.write_metrics_table(metrics.iloc[:2], filename)
+
+	assert(not os.path.exists(os.path.join(str(tmpdir), 'metrics.parquet')))
+	assert(len(utils.read_metrics_table(filename)) == 2)
@@ -2,7 +2,13 @@ import pytest
 import numpy as np
 import os
 
-from ecephys_spike_sorting.modules.mean_waveforms.extract_waveforms import extract_waveforms
+from ecephys_spike_sorting.modules.mean_waveforms.extract_waveforms import extract_waveforms, gather_waveforms, select_spikes_for_waveforms, WaveformAccumulator
+from ecephys_spike_sorting.modules.mean_waveforms.parallel_waveforms import calculate_mean_waveforms_parallel
+from ecephys_spike_sorting.modules.mean_waveforms.metrics_from_file import metrics_from_file
+from ecephys_spike_sorting.modules.mean_waveforms.snippet_store import write_snippet_store, SnippetStoreWriter
+from ecephys_spike_sorting.common.snippet_store import SnippetStore
+from ecephys_spike_sorting.modules.mean_waveforms.waveform_metrics import calculate_waveform_metrics_batch, calculate_waveform_metrics_from_avg
+from ecephys_spike_sorting.common.epoch import Epoch
 import ecephys_spike_sorting.common.utils as utils
 
 DATA_DIR = os.environ.get('ECEPHYS_SPIKE_SORTING_DATA', False)
@@ -29,4 +35,220 @@ def test_extract_waveforms():
     
     data, spike_counts, coords, labels = extract_waveforms(data, spike_times, spike_clusters, cluster_ids, cluster_quality, bit_volts, sample_rate, params)
 
-    print(labels)
\ No newline at end of file
+    print(labels)
+
+
+def test_gather_waveforms():
+
+    raw_data = np.arange(1000 * 4, dtype='int16').reshape(1000, 4)
+    spike_times = np.array([5, 30, 31, 500, 995])
+
+    positions = []
+    snippets = []
+
+    for chunk_positions, chunk_snippets in gather_waveforms(raw_data, spike_times, 10, 20, samples_per_chunk=100):
+        positions.append(chunk_positions)
+        snippets.append(chunk_snippets)
+
+    # the first and last spikes are too close to the edges; 500 is read in a separate block
+    assert(len(positions) == 2)
+    assert(np.array_equal(np.concatenate(positions), [1, 2, 3]))
+
+    for position, snippet in zip(np.concatenate(positions), np.concatenate(snippets)):
+        start = spike_times[position] - 10
+        assert(np.array_equal(snippet, raw_data[start:start+20, :]))
+
+
+def test_select_spikes_for_waveforms():
+
+    spike_clusters = np.array([0, 1, 0, 0, 2, 0, 1, 0])
+    spike_times = np.arange(8) * 30000
+
+    epochs = [Epoch('first', -1, 3.5), Epoch('second', 3.5, np.inf)]
+
+    selected, group_offsets = select_spikes_for_waveforms(spike_times, spike_clusters, 3, epochs, 30000., 2)
+
+    assert(np.array_equal(np.diff(group_offsets), [2, 1, 0, 2, 1, 1]))
+    assert(np.array_equal(np.sort(selected[group_offsets[1]:group_offsets[2]]), [1]))
+    assert(np.all(np.isin(selected[group_offsets[3]:group_offsets[4]], [5, 7])))
+
+
+def test_waveform_accumulator():
+
+    snippets = np.random.randn(50, 3, 10) * 100 + 1000
+    groups = np.random.randint(0, 4, 50)
+    groups[:4] = np.arange(4)
+
+    accumulator = WaveformAccumulator(5, 3, 10)
+
+    for batch in np.array_split(np.arange(50), 7):
+        accumulator.add(snippets[batch], groups[batch])
+
+    for group in range(4):
+        assert(accumulator.count[group] == np.sum(groups == group))
+        assert(np.allclose(accumulator.mean[group], np.mean(snippets[groups == group], 0)))
+        assert(np.allclose(np.sqrt(accumulator.sum_of_squares[group] / accumulator.count[group]), np.std(snippets[groups == group], 0)))
+
+    assert(accumulator.count[4] == 0)
+
+
+def test_calculate_mean_waveforms_parallel(tmp_path):
+
+    raw_data = np.random.randint(-100, 100, (5000, 6)).astype('int16')
+    raw_data_file = os.path.join(str(tmp_path), 'continuous.dat')
+    raw_data.tofile(raw_data_file)
+
+    spike_times = np.arange(100, 4900, 50)
+    spike_clusters = np.arange(spike_times.size) % 4 # cluster 3 has no template (merged after sorting)
+
+    params = {'samples_per_spike' : 20, 'pre_samples' : 5, 'spikes_per_epoch' : 1000, 'snr_radius' : 1, 'num_workers' : 2,
+              'upsampling_factor' : 200/82, 'spread_threshold' : 0.12, 'site_range' : 16}
+
+    calculate_mean_waveforms_parallel(raw_data_file, 6, spike_times, spike_clusters, np.array([0, 2, 5]), np.arange(6),
+                                      0.5, 30000., params, str(tmp_path))
+
+    mean_waveforms = np.load(os.path.join(str(tmp_path), 'mean_waveforms.npy'))
+    cluster_snr = np.load(os.path.join(str(tmp_path), 'cluster_snr.npy'))
+
+    for cluster in range(4):
+        snippets = np.array([raw_data[t-5:t+15, :].T for t in spike_times[spike_clusters == cluster]]) * 0.5
+        assert(np.allclose(mean_waveforms[cluster], np.mean(snippets, 0), atol=1e-4))
+        assert(cluster_snr[cluster, 1] == snippets.shape[0])
+
+    assert(np.all(cluster_snr[:, 0] > 0))
+
+    metrics = metrics_from_file(os.path.join(str(tmp_path), 'mean_waveforms.npy'), os.path.join(str(tmp_path), 'cluster_snr.npy'),
+                                spike_times, spike_clusters, np.array([0, 2, 5]), np.arange(6), 0.5, 30000., 10e-6, params)
+
+    assert(np.array_equal(metrics['cluster_id'], np.arange(4)))
+
+
+def test_calculate_mean_waveforms_parallel_messages(tmp_path):
+
+    np.random.seed(0)
+
+    raw_data = np.random.randint(-100, 100, (20000, 4)).astype('int16')
+    raw_data_file = os.path.join(str(tmp_path), 'continuous.dat')
+    raw_data.tofile(raw_data_file)
+
+    # more clusters than one message holds, so each process sends its moments several times
+    spike_times = np.sort(np.random.choice(np.arange(10, 19980), 3000, replace=False))
+    spike_clusters = np.random.randint(0, 600, spike_times.size)
+
+    params = {'samples_per_spike' : 10, 'pre_samples' : 3, 'spikes_per_epoch' : 1000, 'snr_radius' : 1}
+
+    for num_workers in (1, 3):
+
+        params['num_workers'] = num_workers
+
+        calculate_mean_waveforms_parallel(raw_data_file, 4, spike_times, spike_clusters, np.zeros((600,), dtype='int64'), np.arange(4),
+                                          1.0, 30000., params, str(tmp_path), worker_memory_mb = 0)
+
+        mean_waveforms = np.load(os.path.join(str(tmp_path), 'mean_waveforms.npy'))
+        cluster_snr = np.load(os.path.join(str(tmp_path), 'cluster_snr.npy'))
+
+        for cluster in range(600):
+            snippets = np.array([raw_data[t-3:t+7, :].T for t in spike_times[spike_clusters == cluster]])
+            assert(cluster_snr[cluster, 1] == snippets.shape[0])
+            if snippets.shape[0] > 0:
+                assert(np.allclose(mean_waveforms[cluster], np.mean(snippets, 0), atol=1e-4))
+
+
+def test_calculate_waveform_metrics_batch():
+
+    num_channels = 32
+    timestamps = np.arange(82) - 20
+    channels = np.arange(num_channels)
+
+    mean_waveforms = np.zeros((4, num_channels, 82))
+
+    for unit, peak in enumerate([5, 10, 16, 25]):
+        amplitude = np.exp(-((channels - peak) / (2. + unit)) ** 2)
+        shape = -np.exp(-(timestamps / 3.) ** 2) + (0.3 + 0.1 * unit) * np.exp(-((timestamps - 12 - unit) / 6.) ** 2)
+        delay = np.abs(channels - peak)[:, np.newaxis] * 0.3
+        mean_waveforms[unit] = amplitude[:, np.newaxis] * np.interp(timestamps - delay, timestamps, shape) * 100
+
+    peak_channels = np.array([5, 10, 16, 25])
+    snr = np.array([2., 3., 4., 5.])
+
+    metrics = calculate_waveform_metrics_batch(mean_waveforms, snr, np.arange(4), peak_channels, channels,
+                                               30000., 200, 0.12, 16, 10e-6)
+
+    for unit in range(4):
+        expected = calculate_waveform_metrics_from_avg(mean_waveforms[unit], snr[unit], unit, peak_channels[unit], channels,
+                                                       30000., 200, 0.12, 16, 10e-6)
+        assert(np.allclose(metrics.iloc[unit][expected.columns[3:]].values.astype('float'),
+                           expected.iloc[0][expected.columns[3:]].values.astype('float'), equal_nan=True))
+
+
+def test_snippet_store(tmp_path):
+
+    raw_data = np.random.randint(-100, 100, (5000, 10)).astype('int16')
+
+    spike_times = np.arange(10, 5000, 40)
+    spike_clusters = np.arange(spike_times.size) % 3
+
+    params = {'samples_per_spike' : 20, 'pre_samples' : 5, 'snippets_per_unit' : 30, 'snippet_channels' : 4}
+
+    write_snippet_store(raw_data, spike_times, spike_clusters, np.array([0, 5, 9]), np.arange(10),
+                        0.5, 30000., params, str(tmp_path))
+
+    store = SnippetStore(str(tmp_path))
+
+    assert(store.num_units == 3)
+    assert(np.array_equal(store.channels(0), [0, 1, 2, 3]))
+    assert(np.array_equal(store.channels(2), [6, 7, 8, 9]))
+
+    for cluster in range(3):
+
+        times = store.spike_times(cluster)
+        snippets = store.snippets(cluster)
+
+        assert(times.size == 30)
+        assert(np.all(np.diff(times) > 0))
+        assert(np.all(np.isin(times, spike_times[spike_clusters == cluster])))
+
+        expected = np.array([raw_data[t-5:t+15, store.channels(cluster)].T for t in times])
+
+        assert(np.array_equal(snippets, expected))
+        assert(np.allclose(store.mean_waveform(cluster), np.mean(expected, 0) * 0.5))
+
+
+def test_snippet_store_in_waveform_pass(tmp_path):
+
+    raw_data = np.random.randint(-100, 100, (5000, 10)).astype('int16')
+    raw_data_file = os.path.join(str(tmp_path), 'continuous.dat')
+    raw_data.tofile(raw_data_file)
+
+    spike_times = np.arange(10, 5000, 40)
+    spike_clusters = np.arange(spike_times.size) % 3
+
+    params = {'samples_per_spike' : 20, 'pre_samples' : 5, 'spikes_per_epoch' : 8, 'snr_radius' : 1, 'num_workers' : 2,
+              'snippets_per_unit' : 30, 'snippet_channels' : 4}
+
+    store_dir = os.path.join(str(tmp_path), 'snippet_store')
+
+    writer = SnippetStoreWriter(store_dir, spike_times, spike_clusters, np.array([0, 5, 9]), np.arange(10),
+                                5000, 10, 0.5, 30000., params)
+
+    np.random.seed(0)
+    calculate_mean_waveforms_parallel(raw_data_file, 10, spike_times, spike_clusters, np.array([0, 5, 9]), np.arange(10),
+                                      0.5, 30000., params, str(tmp_path), snippet_store = writer)
+    writer.finish()
+
+    with_store = np.load(os.path.join(str(tmp_path), 'mean_waveforms.npy'))
+
+    np.random.seed(0)
+    calculate_mean_waveforms_parallel(raw_data_file, 10, spike_times, spike_clusters, np.array([0, 5, 9]), np.arange(10),
+                                      0.5, 30000., params, str(tmp_path))
+
+    # the store does not change which spikes are averaged
+    assert(np.array_equal(with_store, np.load(os.path.join(str(tmp_path), 'mean_waveforms.npy'))))
+
+    store = SnippetStore(store_dir)
+
+    for cluster in range(3):
+        times = store.spike_times(cluster)
+        expected = np.array([raw_data[t-5:t+15, store.channels(cluster)].T for t in times])
+        assert(times.size == 30)
+        assert(np.array_equal(store.snippets(cluster), expected))
@@ -31,6 +31,454 @@ def te_st_quality_metrics():
 
 	print(metrics)
 
+
+def test_pairwise_silhouette_scores():
+
+	from sklearn.metrics import silhouette_score
+	from ecephys_spike_sorting.modules.quality_metrics.metrics import pairwise_silhouette_scores
+
+	np.random.seed(0)
+
+	labels = np.concatenate((np.repeat([2, 5, 7, 9], [40, 25, 1, 2]), [11]))
+	X = np.random.randn(labels.size, 6) + labels[:, np.newaxis] * 0.3
+
+	cluster_ids, pair_scores = pairwise_silhouette_scores(X, labels, max_distances_per_chunk=100)
+
+	assert(np.array_equal(cluster_ids, np.unique(labels)))
+
+	scores = np.empty(pair_scores.shape)
+	scores[:] = np.nan
+	scores[pair_scores.row, pair_scores.col] = pair_scores.data
+
+	for i, cluster_i in enumerate(cluster_ids):
+		for j, cluster_j in enumerate(cluster_ids):
+			in_pair = np.isin(labels, [cluster_i, cluster_j])
+			if j > i and np.sum(in_pair) > 2:
+				assert(np.isclose(scores[i, j], silhouette_score(X[in_pair, :], labels[in_pair])))
+			else:
+				assert(np.isnan(scores[i, j]))
+
+
+def test_neighbor_silhouette_scores():
+
+	from ecephys_spike_sorting.modules.quality_metrics.metrics import pairwise_silhouette_scores, find_channel_neighbors
+
+	np.random.seed(1)
+
+	pc_feature_ind = np.array([[0, 1, 2], [2, 3, 4], [5, 6, 7], [7, 8, 9]])
+	labels = np.repeat(np.arange(4), [30, 20, 25, 15])
+	X = np.random.randn(labels.size, 5) + labels[:, np.newaxis]
+
+	neighbors = find_channel_neighbors(pc_feature_ind)
+
+	assert(np.array_equal(neighbors.toarray(), np.array([[1, 1, 0, 0], [1, 1, 0, 0], [0, 0, 1, 1], [0, 0, 1, 1]], dtype='bool')))
+
+	_, all_pairs = pairwise_silhouette_scores(X, labels)
+	_, neighbor_pairs = pairwise_silhouette_scores(X, labels, neighbors)
+
+	assert(np.array_equal(neighbor_pairs.row, [0, 2]))
+	assert(np.array_equal(neighbor_pairs.col, [1, 3]))
+	assert(np.allclose(neighbor_pairs.toarray()[[0, 2], [1, 3]], all_pairs.toarray()[[0, 2], [1, 3]]))
+
+
+def test_median_depths_by_interval():
+
+	from ecephys_spike_sorting.modules.quality_metrics.metrics import median_depths_by_interval
+
+	np.random.seed(2)
+
+	spike_times = np.sort(np.random.rand(2000) * 100)
+	spike_times[:3] = [10.0, 20.0, 20.0]
+	spike_times = np.sort(spike_times)
+	spike_clusters = np.random.randint(0, 5, spike_times.size)
+	depths = np.random.rand(spike_times.size) * 1000
+	depths[::97] = np.nan
+
+	interval_starts = np.arange(0, 100, 10.0)
+	interval_ends = interval_starts + 10.0
+
+	median_depths = median_depths_by_interval(spike_times, spike_clusters, depths, interval_starts, interval_ends, 30, 6)
+
+	for unit in range(6):
+		for idx, (t1, t2) in enumerate(zip(interval_starts, interval_ends)):
+			in_range = (spike_clusters == unit) * (spike_times > t1) * (spike_times < t2)
+			expected = np.median(depths[in_range]) if np.sum(in_range) >= 30 else np.nan
+			assert(np.allclose(median_depths[unit, idx], expected, equal_nan=True))
+
+
+def test_get_epoch_slice():
+
+	from ecephys_spike_sorting.modules.quality_metrics.metrics import get_epoch_slice
+	from ecephys_spike_sorting.common.epoch import Epoch
+
+	spike_times = np.array([0.0, 1.0, 1.0, 2.5, 3.0, 4.0, 4.0, 7.0])
+
+	for epoch in [Epoch('a', 1.0, 4.0), Epoch('b', 0, np.inf), Epoch('c', 5.0, 6.0), Epoch('d', 4.0, 1.0)]:
+		in_epoch = (spike_times > epoch.start_time) * (spike_times < epoch.end_time)
+		assert(np.array_equal(spike_times[get_epoch_slice(spike_times, epoch)], spike_times[in_epoch]))
+
+
+def test_neighborhood_hit_miss_rates():
+
+	from sklearn.neighbors import NearestNeighbors
+	from ecephys_spike_sorting.modules.quality_metrics.metrics import nearest_neighbors_metrics, neighborhood_hit_miss_rates
+
+	np.random.seed(0)
+	all_pcs = np.concatenate((np.random.randn(200, 6), np.random.randn(150, 6) + 1.5, np.random.randn(100, 6) - 1.0))
+	all_labels = np.concatenate((np.zeros((200,)), np.ones((150,)), np.ones((100,)) * 7))
+
+	indices = NearestNeighbors(n_neighbors=4, algorithm='ball_tree').fit(all_pcs).kneighbors(all_pcs)[1]
+
+	for unit_id in (0, 1, 7):
+		expected = nearest_neighbors_metrics(all_pcs, all_labels, unit_id, max_spikes_for_nn=10000, n_neighbors=4)
+		assert(np.allclose(neighborhood_hit_miss_rates(all_labels, indices, unit_id), expected))
+
+
+def test_pc_metrics_for_neighborhood(monkeypatch):
+
+	from ecephys_spike_sorting.common.cluster_index import ClusterIndex
+	import ecephys_spike_sorting.modules.quality_metrics.metrics as metrics
+
+	np.random.seed(0)
+
+	# three units with the same peak channel; units 0 and 1 are small enough to be compared using all spikes
+	spike_clusters = np.repeat([0, 1, 2], [50, 80, 2000])
+	pc_feature_ind = np.array([np.arange(0, 8), np.arange(0, 8), np.arange(0, 8)])
+	pc_features = np.random.randn(spike_clusters.size, 3, 8)
+	pc_features[:, 0, 3] += 5
+	pc_features[:, 1, :] += spike_clusters[:, np.newaxis] * 0.5
+
+	cluster_index = ClusterIndex(spike_clusters, 3)
+
+	unit_selections = [metrics.select_pcs_for_unit(cluster_id, np.array([3, 3, 3]), pc_feature_ind, 2, 100, cluster_index)
+					   for cluster_id in range(3)]
+
+	assert([all_spikes for cluster_id, selections, num_channels, all_spikes in unit_selections] == [True, True, False])
+
+	searches = []
+	nearest_neighbor_indices = metrics.nearest_neighbor_indices
+	monkeypatch.setattr(metrics, 'nearest_neighbor_indices', lambda *args: searches.append(1) or nearest_neighbor_indices(*args))
+
+	for max_spikes_for_nn, num_searches in ((5000, 1), (1000, 0)):
+
+		del searches[:]
+		unit_metrics = metrics.pc_metrics_for_neighborhood(pc_features, max_spikes_for_nn, 4, 'float64', unit_selections)
+
+		# units 0 and 1 share one search, unless their spikes need to be subsampled
+		assert(len(searches) == num_searches)
+
+		for (cluster_id, selections, num_channels, all_spikes), (cluster_id2, num_pcs, values) in zip(unit_selections, unit_metrics):
+
+			all_pcs = np.concatenate([metrics.get_unit_pcs(pc_features, index_mask, channel_mask)
+									  for unit_id, index_mask, channel_mask in selections], 0)
+			all_pcs = np.reshape(all_pcs, (all_pcs.shape[0], -1))
+			all_labels = np.concatenate([np.ones((index_mask.size,)) * unit_id for unit_id, index_mask, channel_mask in selections])
+
+			expected = metrics.nearest_neighbors_metrics(all_pcs, all_labels, cluster_id, max_spikes_for_nn, 4)
+			assert(np.allclose(values[3:], expected))
+
+
+def test_squared_mahalanobis_distances():
+
+	from scipy.spatial.distance import cdist
+	from ecephys_spike_sorting.modules.quality_metrics.metrics import squared_mahalanobis_distances
+
+	np.random.seed(0)
+	samples = np.random.randn(300, 5) * np.arange(1, 6)
+	points = np.random.randn(50, 5) * 3
+
+	VI = np.linalg.inv(np.cov(samples.T))
+	expected = cdist(np.mean(samples, 0, keepdims=True), points, 'mahalanobis', VI=VI)[0] ** 2
+
+	assert(np.allclose(squared_mahalanobis_distances(points, samples), expected))
+
+	# rank-deficient covariance (constant feature) falls back to a regularized covariance
+	samples[:, 2] = 0
+
+	assert(np.all(np.isfinite(squared_mahalanobis_distances(points, samples))))
+
+
+def test_update_reservoir():
+
+	from ecephys_spike_sorting.modules.quality_metrics.streaming import update_reservoir
+
+	np.random.seed(0)
+	clusters = np.random.randint(0, 4, 5000)
+
+	sample = np.zeros((0,), dtype='int64')
+	sample_clusters = np.zeros((0,), dtype='int64')
+	sample_keys = np.zeros((0,))
+
+	for start in range(0, clusters.size, 700):
+		spike_indices = np.arange(start, np.min([start + 700, clusters.size]))
+		sample, sample_clusters, sample_keys = update_reservoir(sample, sample_clusters, sample_keys,
+																spike_indices, clusters[spike_indices], 100)
+
+	assert(np.array_equal(np.bincount(sample_clusters), [100, 100, 100, 100]))
+	assert(np.array_equal(clusters[sample], sample_clusters))
+	assert(np.unique(sample).size == sample.size)
+
+
+def test_accumulate_amplitude_cutoffs():
+
+	from ecephys_spike_sorting.modules.quality_metrics.metrics import amplitude_cutoff
+	from ecephys_spike_sorting.modules.quality_metrics.streaming import accumulate_amplitude_cutoffs
+
+	np.random.seed(0)
+	spike_clusters = np.random.randint(0, 3, 3000)
+	amplitudes = np.random.randn(3000) * 5 + 20 + spike_clusters * 10
+	amplitudes[spike_clusters == 2] = 7.0 # single amplitude value
+
+	min_amplitude = np.array([np.min(amplitudes[spike_clusters == i]) for i in range(3)] + [np.inf])
+	max_amplitude = np.array([np.max(amplitudes[spike_clusters == i]) for i in range(3)] + [-np.inf])
+
+	cutoffs = accumulate_amplitude_cutoffs(spike_clusters, amplitudes, min_amplitude, max_amplitude,
+										   np.arange(3), chunk_size=1000)
+
+	for i in range(3):
+		assert(np.isclose(cutoffs[i], amplitude_cutoff(amplitudes[spike_clusters == i])))
+
+	assert(cutoffs[3] == 0)
+
+
+def test_streaming_drift_chunks():
+
+	from ecephys_spike_sorting.modules.quality_metrics.metrics import calculate_drift_metrics
+	from ecephys_spike_sorting.modules.quality_metrics.streaming import accumulate_unit_statistics
+
+	np.random.seed(0)
+
+	# most spikes fall in one drift interval, which is split over many chunks
+	num_spikes = 3000
+	spike_times = np.sort(np.concatenate((np.random.rand(2500) * 10 + 20, np.random.rand(500) * 100)))
+	spike_clusters = np.random.randint(0, 3, num_spikes)
+	amplitudes = np.random.rand(num_spikes) + 1
+	pc_feature_ind = np.array([np.arange(0, 8), np.arange(2, 10), np.arange(4, 12)])
+	pc_features = np.abs(np.random.randn(num_spikes, 3, 8))
+	channel_pos = np.zeros((12, 2))
+	channel_pos[:, 1] = np.arange(12) * 20
+
+	params = {'isi_threshold' : 0.0015, 'min_isi' : 0, 'drift_metrics_interval_s' : 25,
+			  'drift_metrics_min_spikes_per_interval' : 5}
+
+	max_drift, cumulative_drift = calculate_drift_metrics(spike_times, spike_clusters, 3, pc_features, pc_feature_ind, channel_pos,
+														  params['drift_metrics_interval_s'], params['drift_metrics_min_spikes_per_interval'])
+
+	for chunk_size in (100, 1000, num_spikes):
+		unit_metrics = accumulate_unit_statistics(spike_times, spike_clusters, amplitudes, pc_features, pc_feature_ind, channel_pos,
+												  3, params, chunk_size, 100)
+		assert(np.allclose(unit_metrics['max_drift'], max_drift))
+		assert(np.allclose(unit_metrics['cumulative_drift'], cumulative_drift))
+
+
+def test_calculate_amplitude_cutoff():
+
+	from ecephys_spike_sorting.modules.quality_metrics.metrics import amplitude_cutoff, calculate_amplitude_cutoff
+
+	np.random.seed(1)
+	spike_clusters = np.random.randint(0, 20, 20000)
+	spike_clusters[spike_clusters == 5] = 4 # unit without spikes
+	amplitudes = np.abs(np.random.randn(20000) * 5 + 10 + spike_clusters)
+	amplitudes[spike_clusters == 7] = 3.0 # single amplitude value
+
+	cutoffs = calculate_amplitude_cutoff(spike_clusters, amplitudes, 21)
+
+	for i in range(21):
+		if np.any(spike_clusters == i):
+			assert(np.isclose(cutoffs[i], amplitude_cutoff(amplitudes[spike_clusters == i])))
+		else:
+			assert(cutoffs[i] == 0)
+
+	cutoffs = calculate_amplitude_cutoff(spike_clusters, amplitudes[:, np.newaxis], 21, cluster_ids=[3, 5])
+
+	assert(np.isclose(cutoffs[3], amplitude_cutoff(amplitudes[spike_clusters == 3])))
+	assert(np.sum(cutoffs != 0) == 1)
+
+
+def test_pc_metrics_shared_pool():
+
+	import multiprocessing
+	from ecephys_spike_sorting.modules.quality_metrics.metrics import calculate_pc_metrics
+
+	np.random.seed(0)
+	num_units = 6
+	spike_clusters = np.random.randint(0, num_units, 3000)
+	pc_feature_ind = np.array([np.arange(unit, unit + 8) for unit in range(num_units)])
+	pc_features = np.random.randn(3000, 3, 8) + spike_clusters[:, np.newaxis, np.newaxis] * 0.5
+	pc_features[:, 0, :] += np.exp(-np.abs(np.arange(8) - 3))
+
+	def run(pc_features, pool):
+		np.random.seed(1)
+		return calculate_pc_metrics(spike_clusters, num_units, pc_features, pc_feature_ind, 5, 200, 1000, 4, pool=pool)
+
+	serial = [run(pc_features, None), run(pc_features * 2, None)]
+
+	# two probes on the same workers
+	with multiprocessing.Pool(2) as pool:
+		shared = [run(pc_features, pool), run(pc_features * 2, pool)]
+
+	for a, b in zip(serial, shared):
+		for x, y in zip(a, b):
+			assert(np.allclose(x, y, equal_nan=True))
+
+
+def test_pc_metrics_shanks():
+
+	from ecephys_spike_sorting.modules.quality_metrics.metrics import calculate_pc_metrics
+
+	np.random.seed(0)
+	spike_clusters = np.repeat([0, 1], 500)
+	pc_feature_ind = np.array([np.arange(0, 8), np.arange(0, 8)])
+	pc_features = np.random.randn(1000, 3, 8)
+	pc_features[:500, 0, 2] += 10 # unit 0 peaks on channel 2
+	pc_features[500:, 0, 4] += 10 # unit 1 peaks on channel 4
+
+	isolation_distance, l_ratio, d_prime, nn_hit_rate, nn_miss_rate = \
+		calculate_pc_metrics(spike_clusters, 2, pc_features, pc_feature_ind, 5, 500, 1000, 4)
+
+	assert(np.all(np.isfinite(d_prime)))
+
+	# channels 0-3 and 4-7 are on different shanks, so neither unit has anything to compare with
+	isolation_distance, l_ratio, d_prime, nn_hit_rate, nn_miss_rate = \
+		calculate_pc_metrics(spike_clusters, 2, pc_features, pc_feature_ind, 5, 500, 1000, 4,
+							 channel_shanks=np.repeat([0, 1], 4))
+
+	assert(np.all(np.isnan(d_prime)))
+
+
+
+def test_incremental_silhouette_score():
+
+	from ecephys_spike_sorting.modules.quality_metrics.metrics import calculate_metrics
+
+	np.random.seed(0)
+
+	# units 0-1 and 2-3 have PCs on channels that do not overlap
+	num_spikes = 2000
+	spike_clusters = np.random.randint(0, 4, num_spikes)
+	spike_times = np.sort(np.random.rand(num_spikes) * 100)
+	amplitudes = np.random.rand(num_spikes) + 1
+	pc_feature_ind = np.array([np.arange(0, 8), np.arange(0, 8), np.arange(20, 28), np.arange(20, 28)])
+	pc_features = np.random.randn(num_spikes, 3, 8) + spike_clusters[:, np.newaxis, np.newaxis]
+	channel_pos = np.zeros((28, 2))
+	channel_pos[:, 1] = np.arange(28) * 20
+
+	params = {'isi_threshold' : 0.0015, 'min_isi' : 0, 'num_channels_to_compare' : 5, 'max_spikes_for_unit' : 200,
+			  'max_spikes_for_nn' : 1000, 'n_neighbors' : 4, 'num_workers' : 1, 'precision' : 'float64',
+			  'n_silhouette' : 1000, 'drift_metrics_interval_s' : 50, 'drift_metrics_min_spikes_per_interval' : 10}
+
+	for neighbors_only in (False, True):
+
+		params['silhouette_neighbors_only'] = neighbors_only
+
+		# stale values from a previous run, before unit 0 changed
+		previous_metrics = calculate_metrics(spike_times, spike_clusters, amplitudes, np.arange(28), channel_pos,
+											 pc_features, pc_feature_ind, params)
+		previous_metrics['nn_hit_rate'] = -5.0
+		previous_metrics['silhouette_score'] = -5.0
+
+		metrics = calculate_metrics(spike_times, spike_clusters, amplitudes, np.arange(28), channel_pos,
+									pc_features, pc_feature_ind, params,
+									previous_metrics=previous_metrics, changed_units=np.array([0]))
+
+		# units 2 and 3 share no channels with unit 0
+		assert(np.array_equal(metrics['nn_hit_rate'].values == -5.0, [False, False, True, True]))
+
+		if neighbors_only:
+			assert(np.array_equal(metrics['silhouette_score'].values == -5.0, [False, False, True, True]))
+		else:
+			# their worst silhouette score can still come from a pair with unit 0
+			assert(np.all(np.isfinite(metrics['silhouette_score'].values)))
+			assert(not np.any(metrics['silhouette_score'].values == -5.0))
+
+
+def test_select_pcs_for_unit_sample_counts():
+
+	from ecephys_spike_sorting.common.cluster_index import ClusterIndex
+	from ecephys_spike_sorting.modules.quality_metrics.metrics import select_pcs_for_unit
+
+	np.random.seed(0)
+
+	# a sample of 100 spikes from each unit, which have 100 and 1000 spikes in total
+	cluster_index = ClusterIndex(np.repeat([0, 1], 100), 2)
+	pc_feature_ind = np.array([np.arange(0, 8), np.arange(0, 8)])
+	peak_channels = np.array([3, 3])
+
+	cluster_id, selections, num_channels, all_spikes = \
+		select_pcs_for_unit(0, peak_channels, pc_feature_ind, 2, 50, cluster_index)
+
+	assert([index_mask.size for cluster_id2, index_mask, channel_mask in selections] == [50, 50])
+
+	cluster_id, selections, num_channels, all_spikes = \
+		select_pcs_for_unit(0, peak_channels, pc_feature_ind, 2, 50, cluster_index, unit_spike_counts=np.array([100, 1000]))
+
+	# unit 1 needs 10 times as many spikes as unit 0, but only 100 are available
+	assert([index_mask.size for cluster_id2, index_mask, channel_mask in selections] == [10, 100])
+
+def test_grouped_isi_violations_and_presence_ratios():
+
+	from ecephys_spike_sorting.modules.quality_metrics.metrics import isi_violations, presence_ratio, \
+		calculate_isi_violations, calculate_presence_ratio
+
+	np.random.seed(2)
+	spike_clusters = np.random.randint(0, 8, 5000)
+	spike_clusters[spike_clusters == 6] = 7 # unit without spikes
+	spike_times = np.sort(np.random.rand(5000) * 100)
+	spike_times[spike_clusters == 3] = np.sort(np.random.rand(np.sum(spike_clusters == 3)) * 20) # present in the first 20 s only
+	spike_times[100:110] = spike_times[99] # duplicate spikes
+
+	viol_rates = calculate_isi_violations(spike_times, spike_clusters, 9, 0.1, 0.0005)
+	ratios = calculate_presence_ratio(spike_times, spike_clusters, 9)
+
+	for i in range(9):
+		train = spike_times[spike_clusters == i]
+		if train.size > 0:
+			assert(np.isclose(viol_rates[i], isi_violations(train, np.min(spike_times), np.max(spike_times), 0.1, 0.0005)[0]))
+			assert(np.isclose(ratios[i], presence_ratio(train, np.min(spike_times), np.max(spike_times))))
+		else:
+			assert(viol_rates[i] == 0 and ratios[i] == 0)
+
+def test_unsorted_spike_times():
+
+	from ecephys_spike_sorting.modules.quality_metrics.metrics import calculate_metrics
+	from ecephys_spike_sorting.common.epoch import Epoch
+
+	np.random.seed(0)
+
+	num_spikes = 2000
+	spike_clusters = np.random.randint(0, 4, num_spikes)
+	spike_times = np.sort(np.random.rand(num_spikes) * 100)
+	amplitudes = np.random.rand(num_spikes) + 1
+	pc_feature_ind = np.array([np.arange(0, 8), np.arange(0, 8), np.arange(2, 10), np.arange(2, 10)])
+	pc_features = np.abs(np.random.randn(num_spikes, 3, 8)) + spike_clusters[:, np.newaxis, np.newaxis]
+	pc_features[:, 0, 4] += 5
+	channel_pos = np.zeros((10, 2))
+	channel_pos[:, 1] = np.arange(10) * 20
+
+	params = {'isi_threshold' : 0.0015, 'min_isi' : 0, 'num_channels_to_compare' : 5, 'max_spikes_for_unit' : 200,
+			  'max_spikes_for_nn' : 1000, 'n_neighbors' : 4, 'num_workers' : 1, 'precision' : 'float64',
+			  'n_silhouette' : 500, 'silhouette_neighbors_only' : False, 'drift_metrics_interval_s' : 10,
+			  'drift_metrics_min_spikes_per_interval' : 5}
+
+	epochs = [Epoch('first', 0, 50), Epoch('second', 50, 100)]
+
+	np.random.seed(1)
+	expected = calculate_metrics(spike_times, spike_clusters, amplitudes, np.arange(10), channel_pos,
+								 pc_features, pc_feature_ind, params, epochs)
+
+	# pc_features are read through the sort order, not reordered
+	shuffle = np.random.permutation(num_spikes)
+	pc_features = pc_features[shuffle]
+	pc_features.flags.writeable = False
+
+	np.random.seed(1)
+	metrics = calculate_metrics(spike_times[shuffle], spike_clusters[shuffle], amplitudes[shuffle], np.arange(10), channel_pos,
+								pc_features, pc_feature_ind, params, epochs)
+
+	columns = [column for column in expected.columns if column != 'epoch_name']
+	assert(np.allclose(metrics[columns].values.astype('float64'), expected[columns].values.astype('float64'), equal_nan=True))
+
+
 if __name__ == "__main__":
     #test_quality_metrics()
-    pass
\ No newline at end of file
+    pass